@@ -0,0 +1,399 @@
+"""
+Benchmarks of the hot paths of the simulation at several grid sizes.
+
+From the command line, in the Simulation Folder:
+
+    python Benchmark_3d.py --sizes 20 50 100 --repeat 5 --output bench.json
+    python Benchmark_3d.py --sizes 20 50 100 --baseline bench.json --output new.json
+
+Every benchmark is set up once per grid size (size^3 positions, a fraction
+--density of them alive), called once untimed to compile the numba kernels, and
+then timed --repeat times. Benchmarks that change the state they run on restore it
+before every repeat, so each repeat does the same work. Memory is measured in one
+extra call with tracemalloc (numpy arrays are included, numba's internal
+allocations are not).
+
+The results are written as JSON. With --baseline the medians are compared with
+those of an earlier results file, and the command exits with status 1 when a
+benchmark got slower than --tolerance allows, so regressions can be caught.
+--only runs the benchmarks whose name contains one of the given strings.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+import numpy as np
+import numba
+from BookKeepers_3d import Bookkeeper
+from Efficient_Resource_Manager_3d import (ResourceManager, diffusion_step_food_numba,
+                                           diffusion_step_antibiotics_numba,
+                                           diffusion_steps_antibiotics_FAST,
+                                           diffusion_steps_antibiotics_FAST_optimized)
+from Simulation_3d import simulate
+from Trial_Runner_3d import seed_everything
+
+BENCHMARK_VERSION = 1
+
+# Parameters of the benchmarked grids; the resources follow the notebook.
+GRID_PARAMETERS = dict(
+    steps_per_time_unit=2, grid_history_interval=None, antibiotics_interval=1000,
+    antibiotics_steps=[10], dump_strat="middle", dump_size=10, concentration=0.3,
+    antibiotics_concentrations=[0.5], food_interval=75, food_dump_strat="",
+    food_dump_size=40, amount=10, dx=0.000002, D_antibiotics=0.0000000001, D_food=1,
+    D_antibiotics_multiplyer=0.5, D_food_multiplyer=0.5)
+
+
+def random_states(size, density, seed):
+    """
+    Grid of size^3 positions where a fraction `density` holds good or bad cells.
+    """
+    rng = np.random.default_rng(seed)
+    states = np.zeros(size**3, dtype=int)
+    alive = rng.random(size**3) < density
+    states[alive] = rng.choice([1, -1], size=int(alive.sum()), p=[0.8, 0.2])
+    return states
+
+
+def make_sim(size, options, engine="arrays", **parameters):
+    seed_everything(options.seed)
+    return simulate(grid_size=size, grid_height=size,
+                    init_states=random_states(size, options.density, options.seed),
+                    resource_steps_per_time_unit=options.resource_steps, engine=engine,
+                    **{**GRID_PARAMETERS, **parameters})
+
+
+def make_resources(size, options, states, precision="float64"):
+    rm = ResourceManager(size, size, options.resource_steps, GRID_PARAMETERS['dx'],
+                         GRID_PARAMETERS['D_antibiotics'], GRID_PARAMETERS['D_food'],
+                         GRID_PARAMETERS['D_antibiotics_multiplyer'],
+                         GRID_PARAMETERS['D_food_multiplyer'], precision=precision)
+    rng = np.random.default_rng(options.seed)
+    rm.food[:] = rng.random(rm.num_cells) * GRID_PARAMETERS['amount']
+    rm.antibiotics[:] = rng.random(rm.num_cells)
+    rm.update_D(states)
+    return rm
+
+
+def snapshot(*objects):
+    """
+    Copy the numpy arrays and numbers held by the objects; the returned function
+    puts them back, so a benchmark that changes them can run again on the same state.
+    """
+    saved = []
+    for obj in objects:
+        for name, value in vars(obj).items():
+            if isinstance(value, np.ndarray):
+                if not value.flags.writeable:
+                    continue  # shared read-only tables, e.g. the neighbor table
+                saved.append((obj, name, value.copy()))
+            elif isinstance(value, (int, float, dict)) and not isinstance(value, bool):
+                saved.append((obj, name, value.copy() if isinstance(value, dict) else value))
+
+    def restore():
+        for obj, name, value in saved:
+            current = getattr(obj, name)
+            if isinstance(value, np.ndarray) and current.shape == value.shape:
+                current[:] = value  # in place, the kernels may hold views of it
+            else:
+                setattr(obj, name, value.copy() if isinstance(value, dict) else value)
+    return restore
+
+
+# --- Benchmarks: setup(size, options) returns (run, restore or None) --- #
+def bench_cell_step_cells(size, options):
+    # One sub-step of the Cell objects, visited in shuffled order as in simulate.step
+    sim = make_sim(size, options, engine="cells")
+    dt = 1 / sim.steps_per_time_unit
+
+    def run():
+        random.shuffle(sim.indices)
+        for index in sim.indices:
+            sim.grid[index].step(sim.grid, sim.resources, dt)
+    # The Cell objects are not restored; one sub-step changes few of them.
+    return run, None
+
+
+def cell_step_benchmark(engine, precision="float64"):
+    # One sub-step of an engine with compiled sweeps ("arrays" or "parallel")
+    def setup(size, options):
+        sim = make_sim(size, options, engine=engine, precision=precision)
+        dt = 1 / sim.steps_per_time_unit
+
+        def run():
+            sim.grid.step(sim.resources, sim.bookkeeper, dt)
+        return run, snapshot(sim.grid, sim.resources)
+    return setup
+
+
+def bench_cell_events_time_unit(size, options):
+    sim = make_sim(size, options, engine="events")
+
+    def run():
+        sim.grid.step_time_unit(sim.resources, sim.bookkeeper, 0, sim.steps_per_time_unit)
+    return run, snapshot(sim.grid, sim.resources)
+
+
+def diffusion_benchmark(kernel, precision="float64"):
+    # One time unit (resource_steps steps) of one of the diffusion kernels
+    def setup(size, options):
+        rm = make_resources(size, options, random_states(size, options.density, options.seed),
+                            precision)
+        steps = rm.resource_steps_per_time_unit
+
+        if kernel == "food_numba":
+            def run():
+                for _ in range(steps):
+                    rm.food = diffusion_step_food_numba(rm.food, rm.neighbor_offsets,
+                                                        rm.neighbor_indices, rm.D_food_arr,
+                                                        rm.dt, rm.dx)
+        elif kernel == "antibiotics_numba":
+            def run():
+                for _ in range(steps):
+                    rm.antibiotics = diffusion_step_antibiotics_numba(
+                        rm.antibiotics, rm.neighbor_offsets, rm.neighbor_indices,
+                        rm.D_antibiotics_arr, rm.dt, rm.dx)
+        elif kernel == "antibiotics_FAST":
+            def run():
+                rm.antibiotics = diffusion_steps_antibiotics_FAST(
+                    rm.antibiotics, rm.neighbor_offsets, rm.neighbor_indices,
+                    rm.D_antibiotics_arr, rm.dt, rm.dx, steps)
+        elif kernel == "antibiotics_FAST_optimized":
+            def run():
+                rm.antibiotics = diffusion_steps_antibiotics_FAST_optimized(
+                    rm.antibiotics, rm.antibiotics_buffer, rm.neighbor_offsets, rm.neighbor_indices,
+                    rm.D_antibiotics_arr, rm.dt, rm.dx, steps)
+        elif kernel == "stencil":
+            run = rm.diffusion_step_stencil
+        else:
+            # The adaptive implicit solver, both fields. The "cfl" solver is left out:
+            # with the dx and D of the notebook it would need ~10^12 steps.
+            rm.solver = kernel
+            run = rm.diffusion_step
+        return run, snapshot(rm)
+    return setup
+
+
+def bench_update_D(size, options):
+    states = random_states(size, options.density, options.seed)
+    rm = make_resources(size, options, states)
+    return lambda: rm.update_D(states), None
+
+
+def bench_update_D_changed(size, options):
+    # The births of a time unit: 1% of the grid
+    states = random_states(size, options.density, options.seed)
+    rm = make_resources(size, options, states)
+    rng = np.random.default_rng(options.seed)
+    indices = rng.choice(len(states), size=max(1, len(states) // 100), replace=False)
+    return lambda: rm.update_D_changed(indices, states[indices]), None
+
+
+def bench_record_step_summary(size, options):
+    rm = make_resources(size, options, random_states(size, options.density, options.seed))
+    bookkeeper = Bookkeeper()
+    return lambda: bookkeeper.record_step_summary(step=1, resource_manager=rm), None
+
+
+def dosing_benchmark(method, strategy):
+    def setup(size, options):
+        sim = make_sim(size, options, engine="arrays")
+        dump_size = max(1, size // 5)
+        if method == "food":
+            run = lambda: sim.add_food(GRID_PARAMETERS['amount'], dump_size, strategy)
+        else:
+            run = lambda: sim.add_antibiotics(GRID_PARAMETERS['concentration'], dump_size,
+                                              strategy)
+        return run, None
+    return setup
+
+
+def bench_resource_manager(size, options):
+    return lambda: make_resources(size, options, np.zeros(size**3, dtype=int)), None
+
+
+def time_unit_benchmark(engine, diffusion_backend="neighbors", precision="float64"):
+    # simulate.advance: the cell sub-steps, dosing, update of D, diffusion and summary
+    def setup(size, options):
+        sim = make_sim(size, options, engine=engine, diffusion_backend=diffusion_backend,
+                       precision=precision)
+        # The run continues from repeat to repeat; restoring it would cost more
+        # than a time unit.
+        return sim.advance, None
+    return setup
+
+
+BENCHMARKS = {
+    'cell_step_cells': bench_cell_step_cells,
+    'cell_step_arrays': cell_step_benchmark("arrays"),
+    'cell_step_arrays_float32': cell_step_benchmark("arrays", "float32"),
+    'cell_step_parallel': cell_step_benchmark("parallel"),
+    'cell_events_time_unit': bench_cell_events_time_unit,
+    'diffusion_food_numba': diffusion_benchmark("food_numba"),
+    'diffusion_antibiotics_numba': diffusion_benchmark("antibiotics_numba"),
+    'diffusion_antibiotics_FAST': diffusion_benchmark("antibiotics_FAST"),
+    'diffusion_antibiotics_FAST_optimized': diffusion_benchmark("antibiotics_FAST_optimized"),
+    'diffusion_stencil': diffusion_benchmark("stencil"),
+    'diffusion_stencil_float32': diffusion_benchmark("stencil", "float32"),
+    'diffusion_implicit': diffusion_benchmark("implicit"),
+    'update_D': bench_update_D,
+    'update_D_changed': bench_update_D_changed,
+    'record_step_summary': bench_record_step_summary,
+    'add_food_uniform': dosing_benchmark("food", ""),
+    'add_food_quarters': dosing_benchmark("food", "quarters"),
+    'add_antibiotics_middle': dosing_benchmark("antibiotics", "middle"),
+    'add_antibiotics_corner': dosing_benchmark("antibiotics", "corner"),
+    'resource_manager_init': bench_resource_manager,
+    'time_unit_cells': time_unit_benchmark("cells"),
+    'time_unit_arrays': time_unit_benchmark("arrays"),
+    'time_unit_arrays_stencil': time_unit_benchmark("arrays", "stencil"),
+    'time_unit_arrays_stencil_float32': time_unit_benchmark("arrays", "stencil", "float32"),
+    'time_unit_events_stencil': time_unit_benchmark("events", "stencil"),
+    'time_unit_parallel_stencil': time_unit_benchmark("parallel", "stencil"),
+}
+
+
+def measure(name, setup, size, options):
+    """
+    Time one benchmark at one grid size. Returns its result record.
+    """
+    start = time.perf_counter()
+    run, restore = setup(size, options)
+    setup_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    run()  # compiles the numba kernels
+    first_call = time.perf_counter() - start
+
+    times = []
+    for _ in range(options.repeat):
+        if restore is not None:
+            restore()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    if restore is not None:
+        restore()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'name': name, 'size': size, 'grid_cells': size**3, 'repeat': options.repeat,
+            'setup_s': setup_time, 'first_call_s': first_call, 'min_s': min(times),
+            'median_s': statistics.median(times), 'mean_s': statistics.fmean(times),
+            'stdev_s': statistics.stdev(times) if len(times) > 1 else 0.0,
+            'peak_alloc_bytes': peak}
+
+
+def environment():
+    from Parameter_Sweep_3d import code_version
+    return {'benchmark_version': BENCHMARK_VERSION, 'code_version': code_version(),
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S"), 'python': platform.python_version(),
+            'numpy': np.__version__, 'numba': numba.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'numba_threads': numba.get_num_threads()}
+
+
+def run_benchmarks(options):
+    """
+    Run the selected benchmarks at every size and return the results document.
+    """
+    names = [name for name in BENCHMARKS
+             if not options.only or any(part in name for part in options.only)]
+    if not names:
+        raise ValueError(f"No benchmark matches {options.only}")
+    results = []
+    for size in options.sizes:
+        for name in names:
+            if name in ('cell_step_cells', 'time_unit_cells') and size > options.max_cells_size:
+                continue
+            result = measure(name, BENCHMARKS[name], size, options)
+            print(f"{name:<38} {size:>4}^3  median {result['median_s'] * 1e3:10.3f} ms  "
+                  f"first {result['first_call_s'] * 1e3:10.3f} ms  "
+                  f"peak {result['peak_alloc_bytes'] / 2**20:8.2f} MiB")
+            results.append(result)
+    return {'environment': environment(),
+            'options': {key: value for key, value in vars(options).items()
+                        if key not in ('output', 'baseline')},
+            'results': results}
+
+
+def compare(results, baseline, tolerance=0.25, noise=1e-4):
+    """
+    Compare the medians with those of a baseline results document. A benchmark
+    regressed when it is more than `tolerance` (relative) and `noise` seconds
+    slower. Returns one row per benchmark found in both.
+    """
+    previous = {(r['name'], r['size']): r for r in baseline['results']}
+    rows = []
+    for result in results['results']:
+        old = previous.get((result['name'], result['size']))
+        if old is None:
+            continue
+        ratio = result['median_s'] / old['median_s'] if old['median_s'] > 0 else np.inf
+        slower = result['median_s'] - old['median_s']
+        if ratio > 1 + tolerance and slower > noise:
+            status = "REGRESSION"
+        elif ratio < 1 / (1 + tolerance) and -slower > noise:
+            status = "faster"
+        else:
+            status = "ok"
+        rows.append({'name': result['name'], 'size': result['size'],
+                     'median_s': result['median_s'], 'baseline_median_s': old['median_s'],
+                     'ratio': ratio, 'status': status})
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of the 3D "
+                                                 "bacterial growth simulation.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 40, 60, 80, 100],
+                        help="grid sizes, the grids have size^3 positions")
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls per benchmark")
+    parser.add_argument("--only", nargs="+", default=None,
+                        help="run the benchmarks whose name contains one of these")
+    parser.add_argument("--density", type=float, default=0.05,
+                        help="fraction of the grid holding alive cells")
+    parser.add_argument("--resource-steps", type=int, default=4,
+                        help="diffusion steps per time unit (resource_steps_per_time_unit)")
+    parser.add_argument("--max-cells-size", type=int, default=100,
+                        help="largest grid size for the benchmarks of the Cell objects")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=None, help="numba threads")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="JSON file of the results")
+    parser.add_argument("--baseline", default=None,
+                        help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="relative slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        numba.set_num_threads(args.threads)
+    results = run_benchmarks(args)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=1)
+    print(f"{len(results['results'])} results saved to {args.output}")
+
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows = compare(results, baseline, args.tolerance)
+    for row in rows:
+        print(f"{row['name']:<38} {row['size']:>4}^3  {row['baseline_median_s'] * 1e3:10.3f} -> "
+              f"{row['median_s'] * 1e3:10.3f} ms  x{row['ratio']:.2f}  {row['status']}")
+    regressions = [row for row in rows if row['status'] == "REGRESSION"]
+    print(f"{len(rows)} benchmarks compared with {args.baseline}, "
+          f"{len(regressions)} regressions.")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
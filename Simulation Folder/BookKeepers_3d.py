@@ -1,69 +1,262 @@
+import numpy as np
+
+
+class EventTable:
+    """
+    Columns of numpy arrays that grow by doubling as rows are appended.
+    Reading a column with table['name'] returns a view of the filled part.
+    """
+
+    def __init__(self, dtypes, capacity=1024):
+        self.dtypes = dtypes
+        self.size = 0
+        self.data = {name: np.zeros(capacity, dtype=dtype) for name, dtype in dtypes.items()}
+
+    def reserve(self, n):
+        capacity = len(next(iter(self.data.values())))
+        if self.size + n <= capacity:
+            return
+        capacity = max(2 * capacity, self.size + n)
+        for name, column in self.data.items():
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.data[name] = grown
+
+    def append(self, **row):
+        self.reserve(1)
+        for name, value in row.items():
+            self.data[name][self.size] = value
+        self.size += 1
+
+    def extend(self, **columns):
+        n = len(next(iter(columns.values())))
+        self.reserve(n)
+        for name, values in columns.items():
+            self.data[name][self.size:self.size + n] = values
+        self.size += n
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        # Allocated bytes, including the unused capacity
+        return sum(column.nbytes for column in self.data.values())
+
+    def __getitem__(self, name):
+        return self.data[name][:self.size]
+
+
 class Bookkeeper:
+    cell_types = {'good': 1, 'bad': -1}
+    causes = ('age', 'antibiotics', 'food')
+    summary_keys = ('step', 'alive_good', 'alive_bad', 'dead_good', 'dead_bad',
+                    'good_dead_due_to_antibiotics', 'bad_dead_due_to_antibiotics',
+                    'antibiotics_concentration')
+    timeframe_metric_keys = (
+        "mean_reproduction",
+        "mean_alive_time_good",
+        "mean_alive_time_bad",
+        "total_alive_time_good",
+        "total_alive_time_bad",
+        "total_death_counts_good_age",
+        "total_death_counts_good_antibiotics",
+        "total_death_counts_good_food",
+        "total_death_counts_bad_age",
+        "total_death_counts_bad_antibiotics",
+        "total_death_counts_bad_food",
+        "total_death_counts_good",
+        "total_death_counts_bad",
+        "alive_good_at_timeframe_end",
+        "alive_bad_at_timeframe_end",
+    )
+
     def __init__(self):
-        # List of dictionaries: one per simulation step.
-        self.step_summaries = []
+        # Simulation time of the sub-step being processed, used to tag the events.
+        self.current_step = 0
+        # Running counts of the cells per state, updated on every state change.
+        self.counts = {key: 0 for key in self.summary_keys[1:-1]}
         # Counters for deaths per cell type and per cause.
         self.death_counts = {
             'good': {'age': 0, 'antibiotics': 0, 'food': 0},
             'bad': {'age': 0, 'antibiotics': 0, 'food': 0}
         }
-        # Dictionary mapping cell index to the number of reproductions performed before dying.
-        self.reproduction_records = {}
-        self.alive_times = {'good': [], 'bad': []}
+        # One row per death / birth / simulation step, in the order they happened.
+        self.deaths = EventTable({'step': np.float64, 'cell_index': np.int64,
+                                  'cell_type': np.int8, 'cause': np.int8,
+                                  'reproduction_count': np.int64, 'alive_time': np.float64})
+        self.births = EventTable({'step': np.float64, 'cell_index': np.int64,
+                                  'cell_type': np.int8})
+        self.summaries = EventTable({key: np.int64 for key in self.summary_keys[:-1]} |
+                                    {'antibiotics_concentration': np.float64})
+
+    @property
+    def nbytes(self):
+        # Memory held by the death, birth and step summary records
+        return self.deaths.nbytes + self.births.nbytes + self.summaries.nbytes
+
+    def initialize_counts(self, states):
+        """
+        Set the running counts from the initial grid states.
+        """
+        states = np.asarray(states)
+        self.counts['alive_good'] = int(np.count_nonzero(states == 1))
+        self.counts['alive_bad'] = int(np.count_nonzero(states == -1))
+        self.counts['dead_good'] = int(np.count_nonzero(states == 2))
+        self.counts['dead_bad'] = int(np.count_nonzero(states == -2))
+
+    def record_birth(self, cell_index, cell_type):
+        """
+        Record that an empty cell became a 'good' or 'bad' cell.
+        """
+        self.counts[f'alive_{cell_type}'] += 1
+        self.births.append(step=self.current_step, cell_index=cell_index,
+                           cell_type=self.cell_types[cell_type])
+
+    def record_births(self, cell_index, cell_type, step=None):
+        """
+        Batch version of record_birth; cell_type holds 1 (good) or -1 (bad) per birth.
+        step: time of every birth, by default the current step.
+        """
+        cell_type = np.asarray(cell_type)
+        self.counts['alive_good'] += int(np.count_nonzero(cell_type == 1))
+        self.counts['alive_bad'] += int(np.count_nonzero(cell_type == -1))
+        if step is None:
+            step = np.full(len(cell_type), self.current_step)
+        self.births.extend(step=step,
+                           cell_index=cell_index, cell_type=cell_type)
 
-    def record_death(self, cell_index, cell_type, cause, reproduction_count, time):
+    def record_death(self, cell_index, cell_type, cause, reproduction_count, time,
+                     state_change=True):
         """
         Record a death event.
-        
+
         cell_index: unique id or index of the cell.
         cell_type: either 'good' or 'bad'
         cause: one of 'age', 'antibiotics', or 'food'
         reproduction_count: number of reproductions performed before death.
+        state_change: False when the cell was already dead (Cell.step can record an
+                      age death twice); the death is counted but the states are not.
         """
-        if cell_type in self.death_counts:
-            if cause in self.death_counts[cell_type]:
-                self.death_counts[cell_type][cause] += 1
-            else:
-                self.death_counts[cell_type][cause] = 1
-        else:
-            self.death_counts[cell_type] = {cause: 1}
-        # Record the cell's reproduction count at death.
-        self.reproduction_records[cell_index] = reproduction_count
-        self.alive_times[cell_type].append(time)
+        self.death_counts[cell_type][cause] += 1
+        if state_change:
+            self.counts[f'alive_{cell_type}'] -= 1
+            self.counts[f'dead_{cell_type}'] += 1
+            if cause == 'antibiotics':
+                self.counts[f'{cell_type}_dead_due_to_antibiotics'] += 1
+        self.deaths.append(step=self.current_step, cell_index=cell_index,
+                           cell_type=self.cell_types[cell_type],
+                           cause=self.causes.index(cause),
+                           reproduction_count=reproduction_count, alive_time=time)
+
+    def record_deaths(self, cell_index, cell_type, cause, reproduction_count, time,
+                      state_change, step=None):
+        """
+        Batch version of record_death; cell_type holds 1 (good) or -1 (bad) and cause
+        holds the index into Bookkeeper.causes per death.
+        step: time of every death, in increasing order; by default the current step.
+        """
+        cell_type = np.asarray(cell_type)
+        cause = np.asarray(cause)
+        state_change = np.asarray(state_change, dtype=bool)
+        for name, value in self.cell_types.items():
+            of_type = cell_type == value
+            for c, cause_name in enumerate(self.causes):
+                self.death_counts[name][cause_name] += int(np.count_nonzero(of_type & (cause == c)))
+            changed = of_type & state_change
+            n_changed = int(np.count_nonzero(changed))
+            self.counts[f'alive_{name}'] -= n_changed
+            self.counts[f'dead_{name}'] += n_changed
+            self.counts[f'{name}_dead_due_to_antibiotics'] += int(
+                np.count_nonzero(changed & (cause == self.causes.index('antibiotics'))))
+        if step is None:
+            step = np.full(len(cell_type), self.current_step)
+        self.deaths.extend(step=step,
+                           cell_index=cell_index, cell_type=cell_type, cause=cause,
+                           reproduction_count=reproduction_count, alive_time=time)
 
-    def record_step_summary(self, step, grid, resource_manager):
+    def record_step_summary(self, step, grid=None, resource_manager=None):
         """
         Record counts for the current simulation step.
+        The counts are kept up to date on every birth and death, so the grid is
+        no longer walked; it is only accepted for backwards compatibility.
         """
-        from Cell_3d import Cell
-        from Resource_Manager_3d import ResourceManager
-        summary = {
-            'step': step,
-            'alive_good': 0,
-            'alive_bad': 0,
-            'dead_good': 0,
-            'dead_bad': 0,
-            'good_dead_due_to_antibiotics': 0,
-            'bad_dead_due_to_antibiotics': 0,
-            'antibiotics_concentration': 0
-        }
-        for cell in grid:
-            if cell.state == Cell.good:
-                summary['alive_good'] += 1
-            elif cell.state == Cell.bad:
-                summary['alive_bad'] += 1
-            elif cell.state == Cell.dead_good:
-                summary['dead_good'] += 1
-            elif cell.state == Cell.dead_bad:
-                summary['dead_bad'] += 1
-            if cell.good_dead_due_to_antibiotics:
-                summary['good_dead_due_to_antibiotics'] += 1
-            elif cell.bad_dead_due_to_antibiotics:
-                summary['bad_dead_due_to_antibiotics'] += 1
-
-        summary['antibiotics_concentration'] += sum(
-            resource_manager.antibiotics[k] for k in range(len(grid))
-        ) # Sum the antibiotics concentration across all cells in the grid.
-        self.step_summaries.append(summary)
-
-        
\ No newline at end of file
+        antibiotics = 0.0
+        if resource_manager is not None:
+            # Sum the antibiotics concentration across all cells in the grid.
+            antibiotics = float(resource_manager.antibiotics.sum(dtype=np.float64))
+        self.summaries.append(step=step, antibiotics_concentration=antibiotics,
+                              **self.counts)
+
+    # --- Views in the format of the original dictionaries and lists --- #
+    @property
+    def step_summaries(self):
+        columns = {key: self.summaries[key].tolist() for key in self.summary_keys}
+        return [dict(zip(self.summary_keys, row)) for row in zip(*columns.values())]
+
+    @property
+    def reproduction_records(self):
+        # Dictionary mapping cell index to the number of reproductions performed before dying.
+        return dict(zip(self.deaths['cell_index'].tolist(),
+                        self.deaths['reproduction_count'].tolist()))
+
+    @property
+    def alive_times(self):
+        return {name: self.deaths['alive_time'][self.deaths['cell_type'] == value].tolist()
+                for name, value in self.cell_types.items()}
+
+    # --- Queries --- #
+    def deaths_between(self, start, end=None):
+        """
+        Slice of the death events that happened while stepping from time start to
+        time end (start <= step < end). Returns a dict of column views.
+        """
+        steps = self.deaths['step']
+        first = np.searchsorted(steps, start, side='left')
+        last = len(steps) if end is None else np.searchsorted(steps, end, side='left')
+        return {name: self.deaths[name][first:last] for name in self.deaths.dtypes}
+
+    def timeframe_metrics(self, start, end):
+        """
+        Metrics for the deaths that happened between the start of step `start` and the
+        end of step `end`, plus the alive counts at the end of step `end` (or at the
+        last recorded step if the simulation stopped earlier).
+        """
+        metrics = {}
+        summary_steps = self.summaries['step']
+        if len(summary_steps) == 0 or (start > 0 and summary_steps[-1] <= start):
+            # The simulation never got to the start of the timeframe.
+            print(f"Warning: The simulation did not reach step {start}. Metrics will be NaN.")
+            return {key: np.nan for key in self.timeframe_metric_keys}
+
+        deaths = self.deaths_between(start, end)
+        # --- Death Counts ---
+        for name, value in self.cell_types.items():
+            of_type = deaths['cell_type'] == value
+            for c, cause in enumerate(self.causes):
+                metrics[f"total_death_counts_{name}_{cause}"] = int(
+                    np.count_nonzero(of_type & (deaths['cause'] == c)))
+            metrics[f"total_death_counts_{name}"] = int(np.count_nonzero(of_type))
+
+        # --- Alive Times (Lifespans of cells that died within the timeframe) ---
+        for name, value in self.cell_types.items():
+            lifespans = deaths['alive_time'][deaths['cell_type'] == value]
+            metrics[f"mean_alive_time_{name}"] = lifespans.mean() if len(lifespans) else np.nan
+            metrics[f"total_alive_time_{name}"] = lifespans.sum()
+
+        # --- Mean Reproduction (children of the cells that died within the timeframe) ---
+        records = dict(zip(deaths['cell_index'].tolist(),
+                           deaths['reproduction_count'].tolist()))
+        children = [count for count in records.values() if count > 0]
+        metrics["mean_reproduction"] = np.mean(children) if children else np.nan
+
+        # --- Alive counts at timeframe end ---
+        if end is None:
+            last = len(summary_steps) - 1
+        else:
+            last = np.searchsorted(summary_steps, end, side='right') - 1
+        metrics["alive_good_at_timeframe_end"] = (
+            self.summaries['alive_good'][last] if last >= 0 else np.nan)
+        metrics["alive_bad_at_timeframe_end"] = (
+            self.summaries['alive_bad'][last] if last >= 0 else np.nan)
+        return {key: metrics[key] for key in self.timeframe_metric_keys}
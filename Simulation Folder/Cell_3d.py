@@ -76,26 +76,29 @@ class Cell():
     lambd_map = {1: 0.64,
                 -1: 0.87}
     p_mutation = 0.01
+
+    antibiotics_decay = 0.005
+    antibiotics_resistance = 0.05  # Resistance to antibiotics for good bacteria
+    antibiotics_consumption = 0.05  # Antibiotics used up by a cell killed by them
+    eat_amount = 0.1
     
-    def __init__(self, index, init_state, grid_size, grid_height, bookkeeper):
+    def __init__(self, index, init_state, grid_size, grid_height, bookkeeper, neighbors=None):
         self.bookkeeper = bookkeeper
 
         self.index = index
         self.state = init_state
-        self.neighbors = get_close_neighbors_3d(index, grid_size, grid_height)
+        if neighbors is None:
+            neighbors = get_close_neighbors_3d(index, grid_size, grid_height)
+        self.neighbors = neighbors
         self.lambd = None
         self.death_date = None
         self.alive_time = None
         self.reproduction_timer = None
         self.reproduction_count = 0  # Number of reproductions performed before death
 
-        self.antibiotics_decay = 0.005
-        self.antibiotics_resistance = 0.05  # Resistance to antibiotics for good bacteria
         self.good_dead_due_to_antibiotics = False  # indicate if cell died due to antibiotics
         self.bad_dead_due_to_antibiotics = False  # indicate if cell died due to antibiotics
 
-        self.eat_amount = 0.1
-
         if init_state == self.good or init_state == self.bad:
             self.lambd = self.lambd_map[init_state]
             # Death timer in simulation steps.
@@ -107,42 +110,48 @@ class Cell():
 
     def death_of_good(self):
         # A good cell "dies".
+        state_change = self.state != self.dead_good  # False if it already died this step
         self.state = self.dead_good
         self.bookkeeper.record_death(self.index, 'good', 'age', self.reproduction_count, 
-                                     self.alive_time)  # Record the death event
+                                     self.alive_time, state_change)  # Record the death event
 
     def death_of_bad(self):
         # A bad cell "dies".
+        state_change = self.state != self.dead_bad  # False if it already died this step
         self.state = self.dead_bad
         self.bookkeeper.record_death(self.index, 'bad', 'age', self.reproduction_count, 
-                                     self.alive_time)  # Record the death event
+                                     self.alive_time, state_change)  # Record the death event
 
     def death_of_good_due_to_antibiotics(self):
         # A good cell "dies" due to antibiotics.
+        state_change = self.state != self.dead_good  # False if it already died this step
         self.state = self.dead_good
         self.bookkeeper.record_death(self.index, 'good', 'antibiotics', self.reproduction_count, 
-                                     self.alive_time)  # Record the death event
+                                     self.alive_time, state_change)  # Record the death event
         self.good_dead_due_to_antibiotics = True  # flag to indicate death due to antibiotics
 
     def death_of_bad_due_to_antibiotics(self):
         # A bad cell "dies" due to antibiotics.
+        state_change = self.state != self.dead_bad  # False if it already died this step
         self.state = self.dead_bad
         self.bookkeeper.record_death(self.index, 'bad', 'antibiotics', self.reproduction_count, 
-                                     self.alive_time)  # Record the death event
+                                     self.alive_time, state_change)  # Record the death event
         self.bad_dead_due_to_antibiotics = True  # flag to indicate death due to antibiotics
 
 
     def death_of_good_due_to_food(self):
         # A good cell "dies" due to food depletion.
+        state_change = self.state != self.dead_good  # False if it already died this step
         self.state = self.dead_good
         self.bookkeeper.record_death(self.index, 'good', 'food', self.reproduction_count, 
-                                     self.alive_time)  # Record the death event
+                                     self.alive_time, state_change)  # Record the death event
 
     def death_of_bad_due_to_food(self):
         # A bad cell "dies" due to food depletion.
+        state_change = self.state != self.dead_bad  # False if it already died this step
         self.state = self.dead_bad
         self.bookkeeper.record_death(self.index, 'bad', 'food', self.reproduction_count, 
-                                     self.alive_time)  # Record the death event
+                                     self.alive_time, state_change)  # Record the death event
 
 
 
@@ -157,6 +166,7 @@ class Cell():
                     # For example, a mutation flips the state.
                     new_state *= -1
                 child.state = new_state
+                self.bookkeeper.record_birth(child.index, 'good' if new_state == self.good else 'bad')
                 child.lambd = self.lambd_map[new_state]
                 # Initialize child's timers.
                 child.death_date = self.reproduction_timer + \
@@ -243,7 +253,7 @@ class Cell():
                 # Bad bacteria die due to antibiotics.
                 self.alive_time -= self.death_date  # adjust the alive time of the cell
                 self.death_of_bad_due_to_antibiotics()
-                antibiotics_dict[self.index] -= 0.05
+                antibiotics_dict[self.index] -= self.antibiotics_consumption
                 if antibiotics_dict[self.index] < 0:
                     antibiotics_dict[self.index] = 0
         elif self.state == self.good:  # Effect on good bacteria
@@ -251,7 +261,7 @@ class Cell():
                 # Good bacteria die due to antibiotics.
                 self.alive_time -= self.death_date  # adjust the alive time of the cell
                 self.death_of_good_due_to_antibiotics()
-                antibiotics_dict[self.index] -= 0.05
+                antibiotics_dict[self.index] -= self.antibiotics_consumption
                 if antibiotics_dict[self.index] < 0:
                     antibiotics_dict[self.index] = 0
 
@@ -0,0 +1,451 @@
+import numpy as np
+from numba import njit, prange
+from Cell_3d import Cell
+from Precision_3d import precision_dtypes
+
+# Death causes as stored in the event buffers (indices into Bookkeeper.causes).
+CAUSE_AGE = 0
+CAUSE_ANTIBIOTICS = 1
+CAUSE_FOOD = 2
+
+
+@njit(cache=True)
+def seed_numba_rng(seed):
+    # Numba keeps its own random state, separate from numpy's and python's.
+    np.random.seed(seed)
+
+
+# --- Random streams --- #
+# The kernels draw from numba's global generator, or, given rng (two uint64 words),
+# from their own xoroshiro128+ stream, e.g. one per replica of an ensemble.
+@njit(cache=True)
+def rotl_numba(x, k):
+    return (x << np.uint64(k)) | (x >> np.uint64(64 - k))
+
+
+@njit(cache=True)
+def xoroshiro_next_numba(rng):
+    s0 = rng[0]
+    s1 = rng[1]
+    result = s0 + s1
+    s1 ^= s0
+    rng[0] = rotl_numba(s0, 24) ^ s1 ^ (s1 << np.uint64(16))
+    rng[1] = rotl_numba(s1, 37)
+    return result
+
+
+@njit(cache=True)
+def splitmix64_numba(seeds, streams):
+    # Expand every seed into the two words of a stream with splitmix64.
+    for i in range(seeds.shape[0]):
+        x = seeds[i]
+        for w in range(2):
+            x += np.uint64(0x9E3779B97F4A7C15)
+            z = x
+            z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+            streams[i, w] = z ^ (z >> np.uint64(31))
+
+
+@njit(cache=True)
+def random_numba(rng):
+    # Uniform in [0, 1)
+    if rng is None:
+        return np.random.random()
+    return (xoroshiro_next_numba(rng) >> np.uint64(11)) * (1.0 / 9007199254740992.0)
+
+
+@njit(cache=True)
+def randint_numba(rng, n):
+    # Uniform in 0..n-1
+    if rng is None:
+        return np.random.randint(n)
+    return int(random_numba(rng) * n)
+
+
+@njit(cache=True)
+def exponential_numba(rng, scale):
+    if rng is None:
+        return np.random.exponential(scale)
+    return -scale * np.log(1.0 - random_numba(rng))
+
+
+def rng_streams(seed, n):
+    """
+    n independent xoroshiro128+ states, shape (n, 2), derived from one seed: every
+    stream gets a 64 bit seed from np.random.SeedSequence, expanded by splitmix64.
+    """
+    seeds = np.random.SeedSequence(seed).generate_state(n, dtype=np.uint64)
+    streams = np.empty((n, 2), dtype=np.uint64)
+    splitmix64_numba(seeds, streams)
+    return streams
+
+
+@njit(cache=True)
+def record_event(j, state_j, cause, reproduction_count, alive_time, state_change,
+                 ev_index, ev_type, ev_cause, ev_reproduction, ev_alive, ev_changed,
+                 n_events):
+    ev_index[n_events] = j
+    ev_type[n_events] = state_j
+    ev_cause[n_events] = cause
+    ev_reproduction[n_events] = reproduction_count
+    ev_alive[n_events] = alive_time
+    ev_changed[n_events] = state_change
+    return n_events + 1
+
+
+@njit(cache=True)
+def reproduction_of_any_numba(j, state, death_date, reproduction_timer, lambd, alive_time,
+                              reproduction_count, neighbor_offsets, neighbor_indices,
+                              lambd_good, lambd_bad, p_mutation, birth_index, birth_type,
+                              n_births, rng=None):
+    # Same as Cell.reproduction_of_any, on the arrays. Returns the new number of births.
+    candidates = np.empty(6, dtype=np.int64)
+    while reproduction_timer[j] <= 0:
+        n_empty = 0
+        for k in neighbor_indices[neighbor_offsets[j]:neighbor_offsets[j + 1]]:
+            if state[k] == 0:
+                candidates[n_empty] = k
+                n_empty += 1
+        if n_empty == 0:
+            break  # No empty neighbors available for reproduction, exit the loop
+        child = candidates[randint_numba(rng, n_empty)]
+        # Inherit parent's state; with a small chance of mutation.
+        new_state = state[j]
+        if new_state == 1 and random_numba(rng) < p_mutation:
+            new_state = -new_state
+        state[child] = new_state
+        birth_index[n_births] = child
+        birth_type[n_births] = new_state
+        n_births += 1
+        lambd[child] = lambd_good if new_state == 1 else lambd_bad
+        # Initialize child's timers.
+        death_date[child] = reproduction_timer[j] + exponential_numba(rng, 3 / lambd[child])
+        reproduction_timer[child] = reproduction_timer[j] + \
+            exponential_numba(rng, 1 / lambd[child])
+        alive_time[child] = death_date[j]
+
+        reproduction_count[j] += 1
+        # Reset the parent's reproduction timer.
+        reproduction_timer[j] += exponential_numba(rng, 1 / lambd[j])
+    return n_births
+
+
+@njit(parallel=True, cache=True)
+def decay_antibiotics_numba(antibiotics, amount):
+    # The antibiotics decay of Cell.step for every voxel, empty or not.
+    for j in prange(antibiotics.shape[0]):
+        antibiotics[j] -= amount
+        if antibiotics[j] < 0:
+            antibiotics[j] = 0.0
+
+
+@njit(cache=True)
+def cell_update_numba(j, state, death_date, reproduction_timer, lambd, alive_time,
+                      reproduction_count, good_dead_due_to_antibiotics,
+                      bad_dead_due_to_antibiotics, neighbor_offsets, neighbor_indices, food,
+                      antibiotics, dt, lambd_good, lambd_bad, p_mutation, antibiotics_resistance,
+                      antibiotics_consumption, eat_amount, ev_index, ev_type, ev_cause,
+                      ev_reproduction, ev_alive, ev_changed, n_events, birth_index,
+                      birth_type, n_births, rng=None):
+    """
+    Cell.step for cell j, without the antibiotics decay (see decay_antibiotics_numba).
+    Returns the new numbers of deaths and births.
+    """
+    # --- Reproduction and Death Mechanism --- #
+    if state[j] == 1 or state[j] == -1:
+        s = state[j]
+        death_date[j] -= dt
+        if reproduction_timer[j] >= 0:
+            reproduction_timer[j] -= dt
+
+        if reproduction_timer[j] <= 0:
+            if death_date[j] <= 0:
+                if death_date[j] < reproduction_timer[j]:
+                    # Cell dies first.
+                    state[j] = 2 * s
+                    n_events = record_event(j, s, CAUSE_AGE, reproduction_count[j],
+                                            alive_time[j], True, ev_index, ev_type,
+                                            ev_cause, ev_reproduction, ev_alive,
+                                            ev_changed, n_events)
+                else:
+                    # Cell reproduces first, then dies.
+                    n_births = reproduction_of_any_numba(
+                        j, state, death_date, reproduction_timer, lambd, alive_time,
+                        reproduction_count, neighbor_offsets, neighbor_indices, lambd_good,
+                        lambd_bad, p_mutation, birth_index, birth_type, n_births, rng)
+                    state[j] = 2 * s
+                    n_events = record_event(j, s, CAUSE_AGE, reproduction_count[j],
+                                            alive_time[j], True, ev_index, ev_type,
+                                            ev_cause, ev_reproduction, ev_alive,
+                                            ev_changed, n_events)
+            else:  # Cell reproduces only.
+                n_births = reproduction_of_any_numba(
+                    j, state, death_date, reproduction_timer, lambd, alive_time,
+                    reproduction_count, neighbor_offsets, neighbor_indices, lambd_good,
+                    lambd_bad, p_mutation, birth_index, birth_type, n_births, rng)
+
+        if death_date[j] <= 0:
+            # Like Cell.step, this records the age death again if it already happened above.
+            state_change = state[j] == s
+            state[j] = 2 * s
+            n_events = record_event(j, s, CAUSE_AGE, reproduction_count[j], alive_time[j],
+                                    state_change, ev_index, ev_type, ev_cause,
+                                    ev_reproduction, ev_alive, ev_changed, n_events)
+
+    # --- Antibiotics Effect on Cells -- #
+    if state[j] == -1:
+        if random_numba(rng) < antibiotics[j]:
+            alive_time[j] -= death_date[j]
+            state[j] = -2
+            bad_dead_due_to_antibiotics[j] = True
+            n_events = record_event(j, -1, CAUSE_ANTIBIOTICS, reproduction_count[j],
+                                    alive_time[j], True, ev_index, ev_type, ev_cause,
+                                    ev_reproduction, ev_alive, ev_changed, n_events)
+            antibiotics[j] -= antibiotics_consumption
+            if antibiotics[j] < 0:
+                antibiotics[j] = 0.0
+    elif state[j] == 1:
+        if random_numba(rng) < antibiotics[j] * antibiotics_resistance:
+            alive_time[j] -= death_date[j]
+            state[j] = 2
+            good_dead_due_to_antibiotics[j] = True
+            n_events = record_event(j, 1, CAUSE_ANTIBIOTICS, reproduction_count[j],
+                                    alive_time[j], True, ev_index, ev_type, ev_cause,
+                                    ev_reproduction, ev_alive, ev_changed, n_events)
+            antibiotics[j] -= antibiotics_consumption
+            if antibiotics[j] < 0:
+                antibiotics[j] = 0.0
+
+    # --- Food Consumption Mechanism --- #
+    if state[j] == 1 or state[j] == -1:
+        food[j] -= eat_amount * dt
+        if food[j] < 0:
+            food[j] = 0.0
+            alive_time[j] -= death_date[j]
+            s = state[j]
+            state[j] = 2 * s
+            n_events = record_event(j, s, CAUSE_FOOD, reproduction_count[j],
+                                    alive_time[j], True, ev_index, ev_type, ev_cause,
+                                    ev_reproduction, ev_alive, ev_changed, n_events)
+    return n_events, n_births
+
+
+# --- Min-heap of the cells born during a sweep, by visiting key --- #
+@njit(cache=True)
+def heap_push(heap_key, heap_index, n_heap, key, index):
+    i = n_heap
+    while i > 0:
+        parent = (i - 1) // 2
+        if heap_key[parent] <= key:
+            break
+        heap_key[i] = heap_key[parent]
+        heap_index[i] = heap_index[parent]
+        i = parent
+    heap_key[i] = key
+    heap_index[i] = index
+    return n_heap + 1
+
+
+@njit(cache=True)
+def heap_pop(heap_key, heap_index, n_heap):
+    # Remove the smallest key; returns (key, index, new size).
+    key = heap_key[0]
+    index = heap_index[0]
+    n_heap -= 1
+    last_key = heap_key[n_heap]
+    last_index = heap_index[n_heap]
+    i = 0
+    while True:
+        child = 2 * i + 1
+        if child >= n_heap:
+            break
+        if child + 1 < n_heap and heap_key[child + 1] < heap_key[child]:
+            child += 1
+        if heap_key[child] >= last_key:
+            break
+        heap_key[i] = heap_key[child]
+        heap_index[i] = heap_index[child]
+        i = child
+    heap_key[i] = last_key
+    heap_index[i] = last_index
+    return key, index, n_heap
+
+
+@njit(cache=True)
+def schedule_births(birth_index, first, n_births, current_key, n_slots, heap_key,
+                    heap_index, n_heap, own_start, own_end, rng=None):
+    # Give every new child a uniformly random place in the visiting order. Children
+    # that land before the cell being visited have missed their turn in this sweep,
+    # just like an empty position visited before the birth in the full sweep.
+    # Children outside [own_start, own_end) belong to another sweep and are skipped.
+    for b in range(first, n_births):
+        if birth_index[b] < own_start or birth_index[b] >= own_end:
+            continue
+        key = n_slots * random_numba(rng)
+        if key > current_key:
+            n_heap = heap_push(heap_key, heap_index, n_heap, key, birth_index[b])
+    return n_heap
+
+
+@njit(cache=True)
+def cell_sweep_numba(live, n_live, state, death_date, reproduction_timer, lambd, alive_time,
+                     reproduction_count, good_dead_due_to_antibiotics,
+                     bad_dead_due_to_antibiotics, neighbor_offsets, neighbor_indices, food,
+                     antibiotics, dt, lambd_good, lambd_bad, p_mutation, antibiotics_resistance,
+                     antibiotics_consumption, eat_amount, ev_index, ev_type, ev_cause,
+                     ev_reproduction, ev_alive, ev_changed, birth_index, birth_type,
+                     heap_key, heap_index, own_start=0, own_end=-1, rng=None):
+    """
+    One sub-step of Cell.step for the alive cells live[:n_live], visited in a freshly
+    shuffled order. Empty and dead positions do nothing in Cell.step apart from the
+    antibiotics decay, so they are not visited.
+
+    The alive cells get the visiting keys 1..n_live. A cell born during the sweep gets
+    a uniform key in (0, n_live + 1) and is visited at that key if it is still ahead,
+    so every cell has a uniformly random place in the order as in the full sweep.
+    Death events are written to the ev_* buffers and births to the birth_* buffers.
+    Afterwards live holds the cells that are still alive.
+    Only the positions in [own_start, own_end) (default: all) belong to this sweep:
+    children born outside it are recorded as births but neither visited nor kept
+    in live (see Distributed_3d.py). With rng the random numbers come from that
+    stream instead of numba's global generator.
+    Returns the numbers of deaths and births and the new number of alive cells.
+    """
+    if own_end < 0:
+        own_end = state.shape[0]
+    m = n_live
+    # Fisher-Yates shuffle of the visiting order.
+    for i in range(m - 1, 0, -1):
+        k = randint_numba(rng, i + 1)
+        live[i], live[k] = live[k], live[i]
+
+    n_events = 0
+    n_births = 0
+    n_heap = 0
+    for i in range(m + 1):
+        key = i + 1.0 if i < m else np.inf
+        # Children whose turn comes before the next alive cell.
+        while n_heap > 0 and heap_key[0] < key:
+            child_key, j, n_heap = heap_pop(heap_key, heap_index, n_heap)
+            first = n_births
+            n_events, n_births = cell_update_numba(
+                j, state, death_date, reproduction_timer, lambd, alive_time,
+                reproduction_count, good_dead_due_to_antibiotics, bad_dead_due_to_antibiotics,
+                neighbor_offsets, neighbor_indices, food, antibiotics, dt, lambd_good,
+                lambd_bad, p_mutation, antibiotics_resistance, antibiotics_consumption,
+                eat_amount, ev_index, ev_type, ev_cause, ev_reproduction, ev_alive, ev_changed,
+                n_events, birth_index, birth_type, n_births, rng)
+            n_heap = schedule_births(birth_index, first, n_births, child_key, m + 1,
+                                     heap_key, heap_index, n_heap, own_start, own_end, rng)
+        if i == m:
+            break
+        j = live[i]
+        first = n_births
+        n_events, n_births = cell_update_numba(
+            j, state, death_date, reproduction_timer, lambd, alive_time,
+            reproduction_count, good_dead_due_to_antibiotics, bad_dead_due_to_antibiotics,
+            neighbor_offsets, neighbor_indices, food, antibiotics, dt, lambd_good,
+            lambd_bad, p_mutation, antibiotics_resistance, antibiotics_consumption,
+            eat_amount, ev_index, ev_type, ev_cause, ev_reproduction, ev_alive, ev_changed,
+            n_events, birth_index, birth_type, n_births, rng)
+        n_heap = schedule_births(birth_index, first, n_births, key, m + 1,
+                                 heap_key, heap_index, n_heap, own_start, own_end, rng)
+
+    # Keep the cells that are still alive, then the surviving children.
+    n_live = 0
+    for i in range(m):
+        j = live[i]
+        if state[j] == 1 or state[j] == -1:
+            live[n_live] = j
+            n_live += 1
+    for b in range(n_births):
+        j = birth_index[b]
+        if (state[j] == 1 or state[j] == -1) and own_start <= j < own_end:
+            live[n_live] = j
+            n_live += 1
+    return n_events, n_births, n_live
+
+
+class CellArrays:
+    """
+    Structure-of-arrays version of the grid of Cell objects.
+    Every per-cell attribute of Cell is stored as one contiguous numpy array, and a
+    whole sub-step is done by cell_sweep_numba with the same rules as Cell.step.
+    The indices of the alive cells are kept in live[:n_live], so a sub-step costs time
+    in proportion to the alive cells instead of the grid volume.
+    With precision="float32" the states are int8, the reproduction counters uint16
+    and the timers float32.
+    """
+
+    def __init__(self, init_states, neighbor_offsets, neighbor_indices, precision="float64"):
+        self.num_cells = len(init_states)
+        # CSR neighbor table, shared with the ResourceManager (see neighbor_table)
+        self.neighbor_offsets = neighbor_offsets
+        self.neighbor_indices = neighbor_indices
+        # Storage types of the states, counters and timers (see Precision_3d.py)
+        dtypes = precision_dtypes(precision)
+        self.timer_dtype = dtypes['timer']
+
+        self.state = np.asarray(init_states, dtype=dtypes['state']).copy()
+        self.lambd = np.zeros(self.num_cells, dtype=self.timer_dtype)
+        self.death_date = np.full(self.num_cells, np.nan, dtype=self.timer_dtype)
+        self.alive_time = np.full(self.num_cells, np.nan, dtype=self.timer_dtype)
+        self.reproduction_timer = np.full(self.num_cells, np.nan, dtype=self.timer_dtype)
+        self.reproduction_count = np.zeros(self.num_cells, dtype=dtypes['count'])
+        self.good_dead_due_to_antibiotics = np.zeros(self.num_cells, dtype=np.bool_)
+        self.bad_dead_due_to_antibiotics = np.zeros(self.num_cells, dtype=np.bool_)
+
+        alive = np.flatnonzero((self.state == Cell.good) | (self.state == Cell.bad))
+        self.lambd[alive] = np.where(self.state[alive] == Cell.good,
+                                     Cell.lambd_map[Cell.good], Cell.lambd_map[Cell.bad])
+        self.draw_initial_timers(alive)
+
+        # Alive cells, in the visiting order of the last sweep
+        self.live = np.zeros(self.num_cells, dtype=np.int64)
+        self.n_live = len(alive)
+        self.live[:self.n_live] = alive
+        # Heap of the children waiting for their turn within a sweep
+        self.heap_key = np.zeros(self.num_cells, dtype=np.float64)
+        self.heap_index = np.zeros(self.num_cells, dtype=np.int64)
+
+        # Event buffers: a cell can die at most twice per sweep (see cell_sweep_numba).
+        self.ev_index = np.zeros(2 * self.num_cells, dtype=np.int64)
+        self.ev_type = np.zeros(2 * self.num_cells, dtype=np.int64)
+        self.ev_cause = np.zeros(2 * self.num_cells, dtype=np.int64)
+        self.ev_reproduction = np.zeros(2 * self.num_cells, dtype=np.int64)
+        self.ev_alive = np.zeros(2 * self.num_cells, dtype=np.float64)
+        self.ev_changed = np.zeros(2 * self.num_cells, dtype=np.bool_)
+        self.birth_index = np.zeros(self.num_cells, dtype=np.int64)
+        self.birth_type = np.zeros(self.num_cells, dtype=np.int64)
+
+    def draw_initial_timers(self, alive):
+        # Death timer in simulation steps.
+        self.death_date[alive] = np.random.exponential(3 / self.lambd[alive])
+        self.alive_time[alive] = self.death_date[alive]
+        # Reproduction timer.
+        self.reproduction_timer[alive] = np.random.exponential(1 / self.lambd[alive])
+
+    def __len__(self):
+        return self.num_cells
+
+    def step(self, ResourceManager, bookkeeper, dt=1):
+        # Every voxel decays on its own, so the decay is done for the whole grid at
+        # once; it only has to happen before the cell on the voxel is visited.
+        decay_antibiotics_numba(ResourceManager.antibiotics, Cell.antibiotics_decay * dt)
+        n_events, n_births, self.n_live = cell_sweep_numba(
+            self.live, self.n_live, self.state, self.death_date, self.reproduction_timer,
+            self.lambd, self.alive_time, self.reproduction_count,
+            self.good_dead_due_to_antibiotics, self.bad_dead_due_to_antibiotics,
+            self.neighbor_offsets, self.neighbor_indices, ResourceManager.food,
+            ResourceManager.antibiotics, self.timer_dtype(dt),
+            Cell.lambd_map[Cell.good], Cell.lambd_map[Cell.bad], Cell.p_mutation,
+            Cell.antibiotics_resistance, Cell.antibiotics_consumption, Cell.eat_amount,
+            self.ev_index, self.ev_type, self.ev_cause, self.ev_reproduction, self.ev_alive,
+            self.ev_changed, self.birth_index, self.birth_type, self.heap_key,
+            self.heap_index)
+        # Hand the births and deaths to the bookkeeper in one batch each.
+        bookkeeper.record_births(self.birth_index[:n_births], self.birth_type[:n_births])
+        bookkeeper.record_deaths(self.ev_index[:n_events], self.ev_type[:n_events],
+                                 self.ev_cause[:n_events], self.ev_reproduction[:n_events],
+                                 self.ev_alive[:n_events], self.ev_changed[:n_events])
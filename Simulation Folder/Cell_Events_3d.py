@@ -0,0 +1,279 @@
+import numpy as np
+from numba import njit
+from Cell_3d import Cell
+from Cell_Arrays_3d import (CellArrays, CAUSE_AGE, CAUSE_ANTIBIOTICS, CAUSE_FOOD,
+                            decay_antibiotics_numba)
+
+
+# --- Indexed min-heap: heap_index[pos] is a cell, heap_pos[cell] its position --- #
+@njit(cache=True)
+def heap_swap(heap_key, heap_index, heap_pos, a, b):
+    heap_key[a], heap_key[b] = heap_key[b], heap_key[a]
+    heap_index[a], heap_index[b] = heap_index[b], heap_index[a]
+    heap_pos[heap_index[a]] = a
+    heap_pos[heap_index[b]] = b
+
+
+@njit(cache=True)
+def heap_sift_up(heap_key, heap_index, heap_pos, pos):
+    while pos > 0:
+        parent = (pos - 1) // 2
+        if heap_key[parent] <= heap_key[pos]:
+            break
+        heap_swap(heap_key, heap_index, heap_pos, pos, parent)
+        pos = parent
+
+
+@njit(cache=True)
+def heap_sift_down(heap_key, heap_index, heap_pos, pos, n_heap):
+    while True:
+        child = 2 * pos + 1
+        if child >= n_heap:
+            break
+        if child + 1 < n_heap and heap_key[child + 1] < heap_key[child]:
+            child += 1
+        if heap_key[pos] <= heap_key[child]:
+            break
+        heap_swap(heap_key, heap_index, heap_pos, pos, child)
+        pos = child
+
+
+@njit(cache=True)
+def heap_push(heap_key, heap_index, heap_pos, n_heap, key, cell):
+    heap_key[n_heap] = key
+    heap_index[n_heap] = cell
+    heap_pos[cell] = n_heap
+    heap_sift_up(heap_key, heap_index, heap_pos, n_heap)
+    return n_heap + 1
+
+
+@njit(cache=True)
+def heap_remove_top(heap_key, heap_index, heap_pos, n_heap):
+    heap_pos[heap_index[0]] = -1
+    n_heap -= 1
+    if n_heap > 0:
+        heap_key[0] = heap_key[n_heap]
+        heap_index[0] = heap_index[n_heap]
+        heap_pos[heap_index[0]] = 0
+        heap_sift_down(heap_key, heap_index, heap_pos, 0, n_heap)
+    return n_heap
+
+
+@njit(cache=True)
+def heap_update(heap_key, heap_index, heap_pos, n_heap, cell, key):
+    # Change the key of a cell that is in the heap.
+    pos = heap_pos[cell]
+    old_key = heap_key[pos]
+    heap_key[pos] = key
+    if key < old_key:
+        heap_sift_up(heap_key, heap_index, heap_pos, pos)
+    else:
+        heap_sift_down(heap_key, heap_index, heap_pos, pos, n_heap)
+
+
+@njit(cache=True)
+def kill_rate(state_j, antibiotics_j, antibiotics_resistance, substeps):
+    """
+    Rate of antibiotics deaths per time unit. In Cell.step a cell is killed with
+    probability p per sub-step, so it survives a time unit with (1 - p)^substeps.
+    """
+    p = antibiotics_j if state_j == -1 else antibiotics_j * antibiotics_resistance
+    if p <= 0:
+        return 0.0
+    if p >= 1:
+        return np.inf
+    return -substeps * np.log1p(-p)
+
+
+@njit(cache=True)
+def schedule_resources(j, t, state, food, antibiotics, eat_from, food_time, kill_time,
+                       antibiotics_resistance, eat_amount, substeps):
+    # Times at which cell j, eating from time t on, runs out of food and is killed.
+    eat_from[j] = t
+    food_time[j] = t + food[j] / eat_amount if eat_amount > 0 else np.inf
+    rate = kill_rate(state[j], antibiotics[j], antibiotics_resistance, substeps)
+    if rate == 0:
+        kill_time[j] = np.inf
+    elif rate == np.inf:
+        kill_time[j] = t
+    else:
+        kill_time[j] = t + np.random.exponential(1 / rate)
+
+
+@njit(cache=True)
+def next_event_time(j, death_date, reproduction_timer, food_time, kill_time):
+    return min(min(reproduction_timer[j], death_date[j]), min(food_time[j], kill_time[j]))
+
+
+@njit(cache=True)
+def time_unit_events_numba(live, n_live, state, death_date, reproduction_timer, lambd,
+                           alive_time, reproduction_count, good_dead_due_to_antibiotics,
+                           bad_dead_due_to_antibiotics, neighbor_offsets, neighbor_indices,
+                           food, antibiotics, t0, substeps, lambd_good, lambd_bad, p_mutation,
+                           antibiotics_resistance, antibiotics_consumption, eat_amount,
+                           ev_index, ev_type, ev_cause, ev_reproduction, ev_alive, ev_step,
+                           birth_index, birth_type, birth_step, heap_key, heap_index, heap_pos,
+                           eat_from, food_time, kill_time):
+    """
+    Run the time unit [t0, t0 + 1) event by event. death_date and reproduction_timer
+    hold absolute times here. At the start (the synchronization point after the
+    diffusion) every alive cell gets the time it runs out of food and a time it is
+    killed by the antibiotics; then the earliest event of any cell is taken from the
+    heap until the end of the time unit. Deaths and births are written to the buffers
+    with their times; returns their numbers and the new number of alive cells.
+    """
+    t1 = t0 + 1.0
+    n_heap = 0
+    for i in range(n_live):
+        j = live[i]
+        schedule_resources(j, t0, state, food, antibiotics, eat_from, food_time, kill_time,
+                           antibiotics_resistance, eat_amount, substeps)
+        n_heap = heap_push(heap_key, heap_index, heap_pos, n_heap,
+                           next_event_time(j, death_date, reproduction_timer, food_time,
+                                           kill_time), j)
+
+    candidates = np.empty(6, dtype=np.int64)
+    n_events = 0
+    n_births = 0
+    while n_heap > 0 and heap_key[0] < t1:
+        t = heap_key[0]
+        j = heap_index[0]
+        s = state[j]
+
+        if reproduction_timer[j] <= min(death_date[j], min(food_time[j], kill_time[j])):
+            # --- Reproduction (before a death at the same time, as in Cell.step) --- #
+            n_empty = 0
+            for k in neighbor_indices[neighbor_offsets[j]:neighbor_offsets[j + 1]]:
+                if state[k] == 0:
+                    candidates[n_empty] = k
+                    n_empty += 1
+            if n_empty == 0:
+                # Empty positions never come back, so the cell cannot reproduce again.
+                reproduction_timer[j] = np.inf
+            else:
+                child = candidates[np.random.randint(n_empty)]
+                new_state = s
+                if new_state == 1 and np.random.random() < p_mutation:
+                    new_state = -new_state
+                state[child] = new_state
+                birth_index[n_births] = child
+                birth_type[n_births] = new_state
+                birth_step[n_births] = t
+                n_births += 1
+                lambd[child] = lambd_good if new_state == 1 else lambd_bad
+                death_date[child] = t + np.random.exponential(3 / lambd[child])
+                reproduction_timer[child] = t + np.random.exponential(1 / lambd[child])
+                alive_time[child] = death_date[j] - t  # the remaining time of the parent
+                schedule_resources(child, t, state, food, antibiotics, eat_from, food_time,
+                                   kill_time, antibiotics_resistance, eat_amount, substeps)
+                n_heap = heap_push(heap_key, heap_index, heap_pos, n_heap,
+                                   next_event_time(child, death_date, reproduction_timer,
+                                                   food_time, kill_time), child)
+                reproduction_count[j] += 1
+                reproduction_timer[j] = t + np.random.exponential(1 / lambd[j])
+            heap_update(heap_key, heap_index, heap_pos, n_heap, j,
+                        next_event_time(j, death_date, reproduction_timer, food_time,
+                                        kill_time))
+            continue
+
+        # --- Death --- #
+        n_heap = heap_remove_top(heap_key, heap_index, heap_pos, n_heap)
+        food[j] -= eat_amount * (t - eat_from[j])
+        if food[j] < 0:
+            food[j] = 0.0
+        if death_date[j] <= min(food_time[j], kill_time[j]):
+            cause = CAUSE_AGE
+        elif kill_time[j] <= food_time[j]:
+            cause = CAUSE_ANTIBIOTICS
+            alive_time[j] -= death_date[j] - t
+            if s == 1:
+                good_dead_due_to_antibiotics[j] = True
+            else:
+                bad_dead_due_to_antibiotics[j] = True
+            antibiotics[j] -= antibiotics_consumption
+            if antibiotics[j] < 0:
+                antibiotics[j] = 0.0
+        else:
+            cause = CAUSE_FOOD
+            alive_time[j] -= death_date[j] - t
+            food[j] = 0.0
+        state[j] = 2 * s
+        ev_index[n_events] = j
+        ev_type[n_events] = s
+        ev_cause[n_events] = cause
+        ev_reproduction[n_events] = reproduction_count[j]
+        ev_alive[n_events] = alive_time[j]
+        ev_step[n_events] = t
+        n_events += 1
+
+    # The cells that are left have eaten until the end of the time unit.
+    for pos in range(n_heap):
+        j = heap_index[pos]
+        heap_pos[j] = -1
+        food[j] -= eat_amount * (t1 - eat_from[j])
+        if food[j] < 0:
+            food[j] = 0.0
+
+    # Keep the cells that are still alive, then the surviving children.
+    m = n_live
+    n_live = 0
+    for i in range(m):
+        j = live[i]
+        if state[j] == 1 or state[j] == -1:
+            live[n_live] = j
+            n_live += 1
+    for b in range(n_births):
+        j = birth_index[b]
+        if state[j] == 1 or state[j] == -1:
+            live[n_live] = j
+            n_live += 1
+    return n_events, n_births, n_live
+
+
+class CellEvents(CellArrays):
+    """
+    Event driven version of CellArrays. Instead of decrementing every timer in each
+    sub-step, the reproductions and deaths are processed in time order from an
+    indexed priority queue, so the work grows with the number of events.
+
+    death_date and reproduction_timer hold absolute times. The cells see the
+    resources at synchronization points, once per time unit after the diffusion:
+    the food of a cell runs out at a fixed time while it eats eat_amount per time
+    unit, and the antibiotics kill a cell at a random time with the rate that gives
+    the same survival over a time unit as steps_per_time_unit sub-steps of Cell.step.
+    """
+
+    def __init__(self, init_states, neighbor_offsets, neighbor_indices):
+        # The timers drawn at time 0 are also the absolute times of the events.
+        super().__init__(init_states, neighbor_offsets, neighbor_indices)
+        self.heap_pos = np.full(self.num_cells, -1, dtype=np.int64)
+        self.eat_from = np.zeros(self.num_cells, dtype=np.float64)
+        self.food_time = np.full(self.num_cells, np.inf, dtype=np.float64)
+        self.kill_time = np.full(self.num_cells, np.inf, dtype=np.float64)
+        self.ev_step = np.zeros(2 * self.num_cells, dtype=np.float64)
+        self.birth_step = np.zeros(self.num_cells, dtype=np.float64)
+
+    def step_time_unit(self, ResourceManager, bookkeeper, t0, steps_per_time_unit):
+        """
+        Run the time unit that starts at t0 and record its births and deaths.
+        """
+        decay_antibiotics_numba(ResourceManager.antibiotics, Cell.antibiotics_decay)
+        n_events, n_births, self.n_live = time_unit_events_numba(
+            self.live, self.n_live, self.state, self.death_date, self.reproduction_timer,
+            self.lambd, self.alive_time, self.reproduction_count,
+            self.good_dead_due_to_antibiotics, self.bad_dead_due_to_antibiotics,
+            self.neighbor_offsets, self.neighbor_indices, ResourceManager.food,
+            ResourceManager.antibiotics, float(t0),
+            steps_per_time_unit, Cell.lambd_map[Cell.good], Cell.lambd_map[Cell.bad],
+            Cell.p_mutation, Cell.antibiotics_resistance, Cell.antibiotics_consumption,
+            Cell.eat_amount, self.ev_index, self.ev_type, self.ev_cause,
+            self.ev_reproduction, self.ev_alive, self.ev_step, self.birth_index,
+            self.birth_type, self.birth_step, self.heap_key, self.heap_index, self.heap_pos,
+            self.eat_from, self.food_time, self.kill_time)
+        bookkeeper.record_births(self.birth_index[:n_births], self.birth_type[:n_births],
+                                 step=self.birth_step[:n_births])
+        bookkeeper.record_deaths(self.ev_index[:n_events], self.ev_type[:n_events],
+                                 self.ev_cause[:n_events], self.ev_reproduction[:n_events],
+                                 self.ev_alive[:n_events],
+                                 np.ones(n_events, dtype=np.bool_),
+                                 step=self.ev_step[:n_events])
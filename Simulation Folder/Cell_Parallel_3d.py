@@ -0,0 +1,334 @@
+import numpy as np
+from numba import njit, prange
+from Cell_3d import Cell
+from Cell_Arrays_3d import (CellArrays, CAUSE_AGE, CAUSE_ANTIBIOTICS, CAUSE_FOOD,
+                            decay_antibiotics_numba)
+from Counter_RNG_3d import (philox_key, keyed_random_numba, keyed_randint_numba,
+                            keyed_exponential_numba, keyed_exponentials, PURPOSE_INIT_DEATH,
+                            PURPOSE_INIT_REPRODUCTION, PURPOSE_CLAIM, PURPOSE_PRIORITY,
+                            PURPOSE_MUTATION, PURPOSE_CHILD_DEATH, PURPOSE_CHILD_REPRODUCTION,
+                            PURPOSE_PARENT_REPRODUCTION, PURPOSE_ANTIBIOTICS)
+
+# A cell claims at most one position per neighbor, and dies at most twice per sub-step
+MAX_CLAIMS = 6
+MAX_CELL_EVENTS = 2
+
+
+# --- Phase 1: every alive cell on its own position --- #
+@njit(parallel=True, cache=True)
+def decide_numba(live, n_live, state, death_date, reproduction_timer, lambd, alive_time,
+                 good_dead_due_to_antibiotics, bad_dead_due_to_antibiotics, neighbor_offsets,
+                 neighbor_indices, food, antibiotics, dt, antibiotics_resistance,
+                 antibiotics_consumption, eat_amount, key, step, pos, fate, n_claims,
+                 claim_target, claim_priority, n_cell_events, slot_cause, slot_changed,
+                 slot_alive):
+    """
+    The timers, deaths, antibiotics and food of Cell.step for every alive cell, which
+    only touch the position of the cell, and the claims of the reproducing cells on
+    their empty neighbors. The states are not changed yet: the new state of live[i]
+    is kept in fate[i], so every cell sees the states at the start of the sub-step.
+    """
+    for i in prange(n_live):
+        j = live[i]
+        pos[j] = i
+        s = state[j]
+        new_s = s
+        n_ev = 0
+        n_claim = 0
+        e = MAX_CELL_EVENTS * i
+        base = MAX_CLAIMS * i
+
+        death_date[j] -= dt
+        if reproduction_timer[j] >= 0:
+            reproduction_timer[j] -= dt
+        if reproduction_timer[j] <= 0:
+            if not (death_date[j] <= 0 and death_date[j] < reproduction_timer[j]):
+                # Claim the empty neighbors in a random order, as many as the
+                # reproduction timer allows if every claim succeeds
+                n_empty = 0
+                for k in neighbor_indices[neighbor_offsets[j]:neighbor_offsets[j + 1]]:
+                    if state[k] == 0:
+                        claim_target[base + n_empty] = k
+                        n_empty += 1
+                t = reproduction_timer[j]
+                while t <= 0 and n_claim < n_empty:
+                    pick = n_claim + keyed_randint_numba(key, step, j, PURPOSE_CLAIM, n_claim,
+                                                         n_empty - n_claim)
+                    k = claim_target[base + pick]
+                    claim_target[base + pick] = claim_target[base + n_claim]
+                    claim_target[base + n_claim] = k
+                    claim_priority[base + n_claim] = keyed_random_numba(
+                        key, step, j, PURPOSE_PRIORITY, n_claim)
+                    t += keyed_exponential_numba(key, step, j, PURPOSE_PARENT_REPRODUCTION,
+                                                 n_claim, 1 / lambd[j])
+                    n_claim += 1
+            if death_date[j] <= 0:
+                new_s = 2 * s
+                slot_cause[e] = CAUSE_AGE
+                slot_changed[e] = True
+                slot_alive[e] = alive_time[j]
+                n_ev = 1
+        if death_date[j] <= 0:
+            # Like Cell.step, this records the age death again if it already happened above.
+            slot_cause[e + n_ev] = CAUSE_AGE
+            slot_changed[e + n_ev] = new_s == s
+            slot_alive[e + n_ev] = alive_time[j]
+            n_ev += 1
+            new_s = 2 * s
+
+        # --- Antibiotics Effect on Cells -- #
+        if new_s == 1 or new_s == -1:
+            threshold = antibiotics[j] if new_s == -1 else antibiotics[j] * antibiotics_resistance
+            if keyed_random_numba(key, step, j, PURPOSE_ANTIBIOTICS, 0) < threshold:
+                alive_time[j] -= death_date[j]
+                if new_s == -1:
+                    bad_dead_due_to_antibiotics[j] = True
+                else:
+                    good_dead_due_to_antibiotics[j] = True
+                new_s = 2 * new_s
+                slot_cause[e + n_ev] = CAUSE_ANTIBIOTICS
+                slot_changed[e + n_ev] = True
+                slot_alive[e + n_ev] = alive_time[j]
+                n_ev += 1
+                antibiotics[j] -= antibiotics_consumption
+                if antibiotics[j] < 0:
+                    antibiotics[j] = 0.0
+
+        # --- Food Consumption Mechanism --- #
+        if new_s == 1 or new_s == -1:
+            food[j] -= eat_amount * dt
+            if food[j] < 0:
+                food[j] = 0.0
+                alive_time[j] -= death_date[j]
+                new_s = 2 * new_s
+                slot_cause[e + n_ev] = CAUSE_FOOD
+                slot_changed[e + n_ev] = True
+                slot_alive[e + n_ev] = alive_time[j]
+                n_ev += 1
+
+        fate[i] = new_s
+        n_claims[i] = n_claim
+        n_cell_events[i] = n_ev
+
+
+# --- Phase 2: resolve the claims on the same position --- #
+@njit(parallel=True, cache=True)
+def resolve_numba(live, n_live, neighbor_offsets, neighbor_indices, pos, n_claims,
+                  claim_target, claim_priority, claim_won):
+    """
+    A claim wins when no other claim on its position has a lower priority (ties go
+    to the lower cell index). Only neighbors of a position can claim it, so every
+    claim finds its competitors without writing anything shared.
+    """
+    for i in prange(n_live):
+        j = live[i]
+        for c in range(n_claims[i]):
+            target = claim_target[MAX_CLAIMS * i + c]
+            priority = claim_priority[MAX_CLAIMS * i + c]
+            won = True
+            for k in neighbor_indices[neighbor_offsets[target]:neighbor_offsets[target + 1]]:
+                other = pos[k]
+                if k == j or other < 0:
+                    continue
+                for c2 in range(n_claims[other]):
+                    if claim_target[MAX_CLAIMS * other + c2] == target:
+                        rival = claim_priority[MAX_CLAIMS * other + c2]
+                        if rival < priority or (rival == priority and k < j):
+                            won = False
+                        break
+                if not won:
+                    break
+            claim_won[MAX_CLAIMS * i + c] = won
+
+
+# --- Phase 3: the children of the winning claims and the new states --- #
+@njit(parallel=True, cache=True)
+def apply_numba(live, n_live, state, death_date, reproduction_timer, lambd, alive_time,
+                reproduction_count, lambd_good, lambd_bad, p_mutation, key, step, pos, fate,
+                n_claims, claim_target, claim_won, child_state):
+    # Same as reproduction_of_any_numba for the won claims, in the order of the claims.
+    for i in prange(n_live):
+        j = live[i]
+        s = state[j]
+        for c in range(n_claims[i]):
+            if not claim_won[MAX_CLAIMS * i + c]:
+                continue
+            child = claim_target[MAX_CLAIMS * i + c]
+            # Inherit parent's state; with a small chance of mutation.
+            new_state = s
+            if new_state == 1 and keyed_random_numba(key, step, j, PURPOSE_MUTATION,
+                                                     c) < p_mutation:
+                new_state = -new_state
+            state[child] = new_state
+            child_state[MAX_CLAIMS * i + c] = new_state
+            lambd[child] = lambd_good if new_state == 1 else lambd_bad
+            death_date[child] = reproduction_timer[j] + keyed_exponential_numba(
+                key, step, j, PURPOSE_CHILD_DEATH, c, 3 / lambd[child])
+            reproduction_timer[child] = reproduction_timer[j] + keyed_exponential_numba(
+                key, step, j, PURPOSE_CHILD_REPRODUCTION, c, 1 / lambd[child])
+            alive_time[child] = death_date[j]
+            reproduction_count[j] += 1
+            reproduction_timer[j] += keyed_exponential_numba(
+                key, step, j, PURPOSE_PARENT_REPRODUCTION, c, 1 / lambd[j])
+        state[j] = fate[i]
+        pos[j] = -1
+
+
+# --- Phase 4: the events in the order of the cells --- #
+@njit(cache=True)
+def collect_numba(live, n_live, live_out, reproduction_count, fate, n_claims, claim_target,
+                  claim_won, child_state, n_cell_events, slot_cause, slot_changed, slot_alive,
+                  ev_index, ev_type, ev_cause, ev_reproduction, ev_alive, ev_changed,
+                  birth_index, birth_type):
+    # Returns the numbers of deaths and births, and of alive cells in live_out, which
+    # like live is sorted by position.
+    n_events = 0
+    n_births = 0
+    n_alive = 0
+    for i in range(n_live):
+        j = live[i]
+        for c in range(n_claims[i]):
+            if claim_won[MAX_CLAIMS * i + c]:
+                birth_index[n_births] = claim_target[MAX_CLAIMS * i + c]
+                birth_type[n_births] = child_state[MAX_CLAIMS * i + c]
+                n_births += 1
+        for e in range(MAX_CELL_EVENTS * i, MAX_CELL_EVENTS * i + n_cell_events[i]):
+            ev_index[n_events] = j
+            ev_type[n_events] = fate[i] // 2  # every event ends the cell
+            ev_cause[n_events] = slot_cause[e]
+            ev_reproduction[n_events] = reproduction_count[j]
+            ev_alive[n_events] = slot_alive[e]
+            ev_changed[n_events] = slot_changed[e]
+            n_events += 1
+        if fate[i] == 1 or fate[i] == -1:
+            live[n_alive] = j
+            n_alive += 1
+
+    # Merge the surviving cells and the children
+    children = np.sort(birth_index[:n_births])
+    a = 0
+    b = 0
+    n_out = 0
+    while a < n_alive or b < n_births:
+        if b == n_births or (a < n_alive and live[a] < children[b]):
+            live_out[n_out] = live[a]
+            a += 1
+        else:
+            live_out[n_out] = children[b]
+            b += 1
+        n_out += 1
+    return n_events, n_births, n_out
+
+
+@njit(cache=True)
+def cell_sweep_parallel_numba(live, n_live, live_out, state, death_date, reproduction_timer,
+                              lambd, alive_time, reproduction_count,
+                              good_dead_due_to_antibiotics, bad_dead_due_to_antibiotics,
+                              neighbor_offsets, neighbor_indices, food, antibiotics, dt,
+                              lambd_good, lambd_bad, p_mutation, antibiotics_resistance,
+                              antibiotics_consumption, eat_amount, key, step, pos, fate,
+                              n_claims, claim_target, claim_priority, claim_won, child_state,
+                              n_cell_events, slot_cause, slot_changed, slot_alive, ev_index,
+                              ev_type, ev_cause, ev_reproduction, ev_alive, ev_changed,
+                              birth_index, birth_type):
+    """
+    One sub-step of Cell.step for the alive cells live[:n_live] (sorted by position)
+    in three parallel phases: decide_numba, resolve_numba and apply_numba. Every
+    random number is keyed by (step, cell, purpose) and every write of a phase goes
+    to a position or slot of one cell, so the result does not depend on the number
+    of threads. Returns the numbers of deaths and births and of alive cells, which
+    are written to live_out.
+    """
+    decide_numba(live, n_live, state, death_date, reproduction_timer, lambd, alive_time,
+                 good_dead_due_to_antibiotics, bad_dead_due_to_antibiotics, neighbor_offsets,
+                 neighbor_indices, food, antibiotics, dt, antibiotics_resistance,
+                 antibiotics_consumption, eat_amount, key, step, pos, fate, n_claims,
+                 claim_target, claim_priority, n_cell_events, slot_cause, slot_changed,
+                 slot_alive)
+    resolve_numba(live, n_live, neighbor_offsets, neighbor_indices, pos, n_claims,
+                  claim_target, claim_priority, claim_won)
+    apply_numba(live, n_live, state, death_date, reproduction_timer, lambd, alive_time,
+                reproduction_count, lambd_good, lambd_bad, p_mutation, key, step, pos, fate,
+                n_claims, claim_target, claim_won, child_state)
+    return collect_numba(live, n_live, live_out, reproduction_count, fate, n_claims,
+                         claim_target, claim_won, child_state, n_cell_events, slot_cause,
+                         slot_changed, slot_alive, ev_index, ev_type, ev_cause,
+                         ev_reproduction, ev_alive, ev_changed, birth_index, birth_type)
+
+
+class CellParallel(CellArrays):
+    """
+    Version of CellArrays that updates the cells of a sub-step in parallel, with
+    the same answer for a seed whatever the number of threads.
+
+    The random numbers come from Counter_RNG_3d, keyed by the seed, the sub-step,
+    the cell and the purpose of the draw, instead of from a shared stream. A sub-step
+    is done in phases (see cell_sweep_parallel_numba): first every cell updates its
+    own timers, food and antibiotics and claims empty neighbors to reproduce into;
+    then every claim on a position that is claimed more than once is decided by a
+    random priority; then the winners place their children. Differences from the
+    sequential sweep: all cells see the states at the start of the sub-step, a
+    parent that loses a claim tries again in the next sub-step, and children first
+    act in the next sub-step.
+    seed: seed of the draws; by default drawn from numpy's global generator.
+    """
+
+    def __init__(self, init_states, neighbor_offsets, neighbor_indices, precision="float64",
+                 seed=None):
+        if seed is None:
+            seed = int(np.random.randint(0, 2**63 - 1, dtype=np.int64))
+        self.seed = seed
+        self.key = philox_key(seed)
+        self.substep = 0  # counter of the draws; 0 is the initial timers
+        super().__init__(init_states, neighbor_offsets, neighbor_indices, precision)
+        self.pos = np.full(self.num_cells, -1, dtype=np.int64)
+        self.live_out = np.zeros(self.num_cells, dtype=np.int64)
+        self.capacity = -1  # so the slots are allocated even without alive cells
+        self.reserve(self.n_live)
+
+    def draw_initial_timers(self, alive):
+        self.death_date[alive] = keyed_exponentials(self.key, 0, alive, PURPOSE_INIT_DEATH,
+                                                    3 / self.lambd[alive])
+        self.alive_time[alive] = self.death_date[alive]
+        self.reproduction_timer[alive] = keyed_exponentials(
+            self.key, 0, alive, PURPOSE_INIT_REPRODUCTION, 1 / self.lambd[alive])
+
+    def reserve(self, n_live):
+        # The per-cell slots of the phases, grown to twice the size when too small
+        if n_live <= self.capacity:
+            return
+        self.capacity = max(n_live, 2 * self.capacity, 1)
+        n = self.capacity
+        self.fate = np.zeros(n, dtype=self.state.dtype)
+        self.n_claims = np.zeros(n, dtype=np.int64)
+        self.claim_target = np.zeros(MAX_CLAIMS * n, dtype=np.int64)
+        self.claim_priority = np.zeros(MAX_CLAIMS * n, dtype=np.float64)
+        self.claim_won = np.zeros(MAX_CLAIMS * n, dtype=np.bool_)
+        self.child_state = np.zeros(MAX_CLAIMS * n, dtype=self.state.dtype)
+        self.n_cell_events = np.zeros(n, dtype=np.int64)
+        self.slot_cause = np.zeros(MAX_CELL_EVENTS * n, dtype=np.int64)
+        self.slot_changed = np.zeros(MAX_CELL_EVENTS * n, dtype=np.bool_)
+        self.slot_alive = np.zeros(MAX_CELL_EVENTS * n, dtype=np.float64)
+
+    def step(self, ResourceManager, bookkeeper, dt=1):
+        decay_antibiotics_numba(ResourceManager.antibiotics, Cell.antibiotics_decay * dt)
+        self.substep += 1
+        self.reserve(self.n_live)
+        n_events, n_births, self.n_live = cell_sweep_parallel_numba(
+            self.live, self.n_live, self.live_out, self.state, self.death_date,
+            self.reproduction_timer, self.lambd, self.alive_time, self.reproduction_count,
+            self.good_dead_due_to_antibiotics, self.bad_dead_due_to_antibiotics,
+            self.neighbor_offsets, self.neighbor_indices, ResourceManager.food,
+            ResourceManager.antibiotics, self.timer_dtype(dt),
+            Cell.lambd_map[Cell.good], Cell.lambd_map[Cell.bad], Cell.p_mutation,
+            Cell.antibiotics_resistance, Cell.antibiotics_consumption, Cell.eat_amount,
+            self.key, self.substep, self.pos, self.fate, self.n_claims, self.claim_target,
+            self.claim_priority, self.claim_won, self.child_state, self.n_cell_events,
+            self.slot_cause, self.slot_changed, self.slot_alive, self.ev_index, self.ev_type,
+            self.ev_cause, self.ev_reproduction, self.ev_alive, self.ev_changed,
+            self.birth_index, self.birth_type)
+        self.live, self.live_out = self.live_out, self.live
+        bookkeeper.record_births(self.birth_index[:n_births], self.birth_type[:n_births])
+        bookkeeper.record_deaths(self.ev_index[:n_events], self.ev_type[:n_events],
+                                 self.ev_cause[:n_events], self.ev_reproduction[:n_events],
+                                 self.ev_alive[:n_events], self.ev_changed[:n_events])
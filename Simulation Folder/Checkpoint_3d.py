@@ -0,0 +1,269 @@
+"""
+Checkpoints of a running simulation.
+
+save_checkpoint writes everything a simulate instance needs to continue into one
+uncompressed .npz file: the cells and their timers, the food and antibiotics fields,
+the diffusion coefficient arrays, the Bookkeeper records and counters, the dosing
+schedule and the states of the python, numpy and numba random generators (and the
+seed and sub-step counter of the parallel engine).
+A history kept in memory is written to side files next to the checkpoint,
+"<path>.history<k>.npz", each holding the snapshots added since the checkpoint
+before it, so a checkpoint does not copy the whole history again.
+load_checkpoint rebuilds the simulation from it, and the restored run continues
+exactly as the original run would have.
+
+    sim = simulate(..., checkpoint_path="run.ckpt.npz", checkpoint_interval=5)
+    ...  # the run is killed
+    sim = load_checkpoint("run.ckpt.npz")
+    while sim.advance():
+        pass
+"""
+import json
+import os
+import random
+import numpy as np
+try:
+    # Numba has no public access to the state of its generator.
+    from numba import _helperlib
+except ImportError:
+    _helperlib = None
+from History_Store_3d import HistoryStore
+from Dosing_3d import DosingSchedule
+from Counter_RNG_3d import philox_key
+
+CHECKPOINT_VERSION = 1
+
+# Per-cell attributes saved for both engines.
+CELL_FIELDS = ('state', 'lambd', 'death_date', 'alive_time', 'reproduction_timer',
+               'reproduction_count', 'good_dead_due_to_antibiotics',
+               'bad_dead_due_to_antibiotics')
+
+
+def numba_helperlib():
+    if _helperlib is None or not hasattr(_helperlib, 'rnd_get_np_state_ptr'):
+        raise RuntimeError("This numba version does not expose the state of its random "
+                           "generator (numba._helperlib), so checkpoints cannot be saved "
+                           "or restored. Use a numba version that does.")
+    return _helperlib
+
+
+def get_numba_random_state():
+    # Numba's generator for np.random in compiled functions, separate from numpy's.
+    helperlib = numba_helperlib()
+    return helperlib.rnd_get_state(helperlib.rnd_get_np_state_ptr())
+
+
+def set_numba_random_state(state):
+    helperlib = numba_helperlib()
+    helperlib.rnd_set_state(helperlib.rnd_get_np_state_ptr(), state)
+
+
+def save_history_segment(sim, path):
+    """
+    Write the in-memory snapshots added since the last checkpoint to `path` to a side
+    file and return the names of all side files of `path`.
+    """
+    segments, written = sim.checkpoint_history.get(path, ([], 0))
+    n = len(sim.grid_history)
+    if n > written:
+        name = f"{os.path.basename(path)}.history{len(segments)}.npz"
+        np.savez(os.path.join(os.path.dirname(path), name),
+                 states=np.array(sim.grid_history[written:]),
+                 antibiotics=np.array(sim.antibiotics_history[written:]),
+                 food=np.array(sim.food_history[written:]))
+        segments = segments + [name]
+    sim.checkpoint_history = {path: (segments, n)}
+    return segments
+
+
+def load_history_segments(sim, path, segments):
+    histories = {'states': [], 'antibiotics': [], 'food': []}
+    for name in segments:
+        with np.load(os.path.join(os.path.dirname(path), name)) as data:
+            for key, values in histories.items():
+                values.extend(data[key].tolist())
+    sim.grid_history = histories['states']
+    sim.antibiotics_history = histories['antibiotics']
+    sim.food_history = histories['food']
+    sim.checkpoint_history = {path: (list(segments), len(sim.grid_history))}
+
+
+def cell_arrays(sim):
+    # The per-cell attributes as arrays; None (never alive) is stored as NaN.
+    if sim.engine in ("arrays", "events", "parallel"):
+        return {name: getattr(sim.grid, name) for name in CELL_FIELDS}
+    arrays = {}
+    for name in CELL_FIELDS:
+        values = [getattr(cell, name) for cell in sim.grid]
+        if name in ('lambd', 'death_date', 'alive_time', 'reproduction_timer'):
+            arrays[name] = np.array([np.nan if v is None else v for v in values],
+                                    dtype=np.float64)
+        else:
+            arrays[name] = np.array(values)
+    return arrays
+
+
+def save_checkpoint(sim, path):
+    """
+    Write the full state of `sim` to `path`. The file is written next to `path` and
+    renamed into place, so a crash during the write keeps the previous checkpoint.
+    """
+    path = os.fspath(path)
+    arrays = {}
+    for name, values in cell_arrays(sim).items():
+        arrays[f"cells/{name}"] = values
+    # The visiting order is shuffled in place, so it is part of the state.
+    if sim.engine in ("arrays", "events", "parallel"):
+        arrays["order"] = sim.grid.live[:sim.grid.n_live]
+    else:
+        arrays["order"] = sim.indices
+
+    resources = sim.resources
+    for name in ('food', 'antibiotics', 'D_food_arr', 'D_antibiotics_arr'):
+        arrays[f"resources/{name}"] = getattr(resources, name)
+
+    bookkeeper = sim.bookkeeper
+    tables = {'deaths': bookkeeper.deaths, 'births': bookkeeper.births,
+              'summaries': bookkeeper.summaries}
+    for table_name, table in tables.items():
+        for name in table.dtypes:
+            arrays[f"bookkeeper/{table_name}/{name}"] = table[name]
+
+    python_state = random.getstate()
+    numpy_state = np.random.get_state()
+    numba_state = get_numba_random_state()
+    arrays["random/python"] = np.array(python_state[1], dtype=np.uint32)
+    arrays["random/numpy"] = numpy_state[1]
+    arrays["random/numba"] = np.array(numba_state[1], dtype=np.uint32)
+
+    history = {'snapshots': 0, 'segments': []}
+    if sim.history_store is not None:
+        # Everything up to here must be on disk; later snapshots are dropped on restore.
+        sim.history_store.flush()
+        history['snapshots'] = len(sim.history_store)
+    elif sim.grid_history_interval is not None:
+        history['snapshots'] = len(sim.grid_history)
+        history['segments'] = save_history_segment(sim, path)
+
+    dosing, dosing_arrays = sim.dosing.to_arrays()
+    for name, values in dosing_arrays.items():
+        arrays[f"dosing/{name}"] = values
+
+    meta = {
+        'version': CHECKPOINT_VERSION,
+        'parameters': sim.parameters,
+        'steps': sim.steps,
+        'resources': {'dt': resources.dt, 'substeps': resources.substeps,
+                      'effective_substeps': resources.effective_substeps,
+                      'implicit_h': resources.implicit_h},
+        'bookkeeper': {'current_step': bookkeeper.current_step,
+                       'counts': bookkeeper.counts,
+                       'death_counts': bookkeeper.death_counts},
+        'random': {'python_version': python_state[0], 'python_gauss': python_state[2],
+                   'numpy_pos': numpy_state[2], 'numpy_has_gauss': numpy_state[3],
+                   'numpy_gauss': numpy_state[4], 'numba_index': numba_state[0]},
+        'history': history,
+        'births_applied': sim.births_applied,
+        'dosing': dosing,
+        'dosing_key': sim.dosing_key,
+    }
+    if sim.engine == "parallel":
+        meta['counter_rng'] = {'seed': sim.grid.seed, 'substep': sim.grid.substep}
+    # Counters and step sizes can be numpy scalars
+    arrays["meta"] = np.array(json.dumps(meta, default=lambda value: value.item()))
+
+    tmp_path = f"{path}.tmp.npz"  # np.savez adds .npz to names without it
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    """
+    Rebuild the simulate instance saved in the checkpoint at `path`.
+    A HistoryStore the run was writing to is reopened, and snapshots written after
+    the checkpoint are dropped from it.
+    """
+    from Simulation_3d import simulate
+
+    path = os.fspath(path)
+    with np.load(path) as data:
+        arrays = {name: data[name] for name in data.files}
+    meta = json.loads(str(arrays["meta"]))
+    if meta['version'] != CHECKPOINT_VERSION:
+        raise ValueError(f"Unsupported checkpoint version: {meta['version']}")
+    parameters = meta['parameters']
+
+    # An empty grid adds no cells and draws no random numbers; everything is
+    # overwritten below. The history is attached afterwards.
+    sim = simulate(init_states=np.zeros(arrays["cells/state"].shape[0], dtype=int),
+                   **{**parameters, 'grid_history_interval': None, 'history_path': None,
+                      'history_dtype': np.dtype(parameters['history_dtype'])})
+    sim.steps = meta['steps']
+
+    # --- Cells --- #
+    if sim.engine in ("arrays", "events", "parallel"):
+        for name in CELL_FIELDS:
+            getattr(sim.grid, name)[:] = arrays[f"cells/{name}"]
+        sim.grid.n_live = len(arrays["order"])
+        sim.grid.live[:sim.grid.n_live] = arrays["order"]
+        if sim.engine == "parallel":
+            sim.grid.seed = meta['counter_rng']['seed']
+            sim.grid.key = philox_key(sim.grid.seed)
+            sim.grid.substep = meta['counter_rng']['substep']
+    else:
+        columns = {name: arrays[f"cells/{name}"].tolist() for name in CELL_FIELDS}
+        for name in ('lambd', 'death_date', 'alive_time', 'reproduction_timer'):
+            columns[name] = [None if v != v else v for v in columns[name]]  # NaN -> None
+        for index, cell in enumerate(sim.grid):
+            for name in CELL_FIELDS:
+                setattr(cell, name, columns[name][index])
+        sim.indices[:] = arrays["order"]
+
+    # --- Resources --- #
+    resources = sim.resources
+    for name in ('food', 'antibiotics', 'D_food_arr', 'D_antibiotics_arr'):
+        getattr(resources, name)[:] = arrays[f"resources/{name}"]
+    resources.rebuild_faces()
+    resources.dt = meta['resources']['dt']
+    resources.substeps = meta['resources']['substeps']
+    resources.effective_substeps = meta['resources']['effective_substeps']
+    resources.implicit_h = meta['resources']['implicit_h']
+
+    # --- Dosing schedule --- #
+    sim.dosing = DosingSchedule.from_arrays(
+        meta['dosing'], {name[len("dosing/"):]: values for name, values in arrays.items()
+                         if name.startswith("dosing/")})
+    sim.dosing_key = tuple(meta['dosing_key'])
+
+    # --- Bookkeeper --- #
+    bookkeeper = sim.bookkeeper
+    bookkeeper.current_step = meta['bookkeeper']['current_step']
+    bookkeeper.counts = meta['bookkeeper']['counts']
+    bookkeeper.death_counts = meta['bookkeeper']['death_counts']
+    for table_name in ('deaths', 'births', 'summaries'):
+        table = getattr(bookkeeper, table_name)
+        columns = {name: arrays[f"bookkeeper/{table_name}/{name}"] for name in table.dtypes}
+        if len(next(iter(columns.values()))):
+            table.extend(**columns)
+    sim.births_applied = meta['births_applied']
+
+    # --- History --- #
+    sim.grid_history_interval = parameters['grid_history_interval']
+    n_snapshots = meta['history']['snapshots']
+    if parameters['history_path'] is not None:
+        sim.history_store = HistoryStore(parameters['history_path'], "a")
+        sim.history_store.truncate(n_snapshots)
+        sim.grid_history = sim.history_store.states
+        sim.antibiotics_history = sim.history_store.antibiotics
+        sim.food_history = sim.history_store.food
+    elif n_snapshots:
+        load_history_segments(sim, path, meta['history']['segments'])
+
+    # --- Random generators, last so nothing above draws from them --- #
+    rng = meta['random']
+    random.setstate((rng['python_version'], tuple(arrays["random/python"].tolist()),
+                     rng['python_gauss']))
+    np.random.set_state(('MT19937', arrays["random/numpy"], rng['numpy_pos'],
+                         rng['numpy_has_gauss'], rng['numpy_gauss']))
+    set_numba_random_state((rng['numba_index'], arrays["random/numba"].tolist()))
+    return sim
@@ -0,0 +1,99 @@
+"""
+Counter-based random numbers keyed by (seed, step, cell, purpose, index).
+
+A draw is Philox4x32-10 (Salmon et al., "Parallel random numbers: as easy as
+1, 2, 3", SC 2011) of the counter (step, cell, purpose, index) under a key derived
+from the seed. Nothing is carried from one draw to the next, so a draw does not
+depend on the order in which the cells are updated or on the thread that updates
+them, and any draw of a run can be recomputed on its own:
+
+    key = philox_key(seed)
+    u = keyed_random_numba(key, step, cell, PURPOSE_ANTIBIOTICS, 0)
+
+The purposes keep the draws of one cell in one step apart; index numbers repeated
+draws of the same purpose, e.g. the reproductions of a cell within a step.
+Used by the parallel engine (Cell_Parallel_3d.py).
+"""
+import numpy as np
+from numba import njit, prange
+
+# --- Purposes of the draws --- #
+PURPOSE_INIT_DEATH = 0
+PURPOSE_INIT_REPRODUCTION = 1
+PURPOSE_CLAIM = 2
+PURPOSE_PRIORITY = 3
+PURPOSE_MUTATION = 4
+PURPOSE_CHILD_DEATH = 5
+PURPOSE_CHILD_REPRODUCTION = 6
+PURPOSE_PARENT_REPRODUCTION = 7
+PURPOSE_ANTIBIOTICS = 8
+
+# Philox4x32 multipliers and Weyl constants; 32 bit words are held in uint64
+PHILOX_M0 = np.uint64(0xD2511F53)
+PHILOX_M1 = np.uint64(0xCD9E8D57)
+PHILOX_W0 = np.uint64(0x9E3779B9)
+PHILOX_W1 = np.uint64(0xBB67AE85)
+MASK32 = np.uint64(0xFFFFFFFF)
+SHIFT32 = np.uint64(32)
+
+
+@njit(cache=True)
+def philox4x32_numba(c0, c1, c2, c3, k0, k1):
+    # Ten rounds of Philox4x32 on the counter (c0, c1, c2, c3) with the key (k0, k1)
+    for r in range(10):
+        if r > 0:
+            k0 = (k0 + PHILOX_W0) & MASK32
+            k1 = (k1 + PHILOX_W1) & MASK32
+        p0 = PHILOX_M0 * c0
+        p1 = PHILOX_M1 * c2
+        c0, c1, c2, c3 = ((p1 >> SHIFT32) ^ c1 ^ k0, p1 & MASK32,
+                          (p0 >> SHIFT32) ^ c3 ^ k1, p0 & MASK32)
+    return c0, c1, c2, c3
+
+
+@njit(cache=True)
+def keyed_random_numba(key, step, cell, purpose, index):
+    # Uniform in [0, 1) with 53 random bits, from the first two words of the block
+    w0, w1, _, _ = philox4x32_numba(np.uint64(step) & MASK32, np.uint64(cell) & MASK32,
+                                    np.uint64(purpose) & MASK32, np.uint64(index) & MASK32,
+                                    key[0], key[1])
+    return ((w0 >> np.uint64(5)) * 67108864.0 + (w1 >> np.uint64(6))) * \
+        (1.0 / 9007199254740992.0)
+
+
+@njit(cache=True)
+def keyed_randint_numba(key, step, cell, purpose, index, n):
+    # Uniform in 0..n-1
+    return int(keyed_random_numba(key, step, cell, purpose, index) * n)
+
+
+@njit(cache=True)
+def keyed_exponential_numba(key, step, cell, purpose, index, scale):
+    return -scale * np.log(1.0 - keyed_random_numba(key, step, cell, purpose, index))
+
+
+@njit(parallel=True, cache=True)
+def keyed_exponentials_numba(key, step, cells, purpose, scales, out):
+    for i in prange(cells.shape[0]):
+        out[i] = keyed_exponential_numba(key, step, cells[i], purpose, 0, scales[i])
+
+
+def philox_key(seed):
+    """
+    The Philox key (two 32 bit words, as uint64) of a seed, from np.random.SeedSequence,
+    so nearby seeds give unrelated keys.
+    """
+    return np.random.SeedSequence(seed).generate_state(2, dtype=np.uint32).astype(np.uint64)
+
+
+def keyed_exponentials(key, step, cells, purpose, scales):
+    """
+    One exponential draw with the given scales for every cell, as in
+    keyed_exponential_numba with index 0.
+    """
+    cells = np.asarray(cells, dtype=np.int64)
+    out = np.empty(len(cells), dtype=np.float64)
+    keyed_exponentials_numba(key, step, cells, purpose,
+                             np.broadcast_to(np.asarray(scales, dtype=np.float64),
+                                             cells.shape).copy(), out)
+    return out
@@ -0,0 +1,540 @@
+"""
+Domain decomposition of very large grids over worker processes.
+
+The grid is split along its height into slabs of whole layers, and every slab is
+owned by one worker process. The food and antibiotics fields, their buffers, the
+diffusion coefficients and face sums and the grid states live in
+multiprocessing.shared_memory, so no process holds a private copy of the grid; a
+worker keeps the per-cell arrays (CellArrays) of its own slab plus one halo layer
+on each side.
+
+Every cell sub-step:
+  1. the worker copies the states of its halo layers from the shared states,
+  2. sweeps its own alive cells (cell_sweep_numba restricted to its slab),
+  3. turns the children born in its halo layers into claims,
+  4. after a barrier, the owner of the claimed positions accepts the claims in
+     the order of the rank of the claiming worker, as long as the position is
+     still empty, and publishes its states for the next halo exchange.
+Every diffusion step each worker updates its own layers from the previous step;
+the only values it reads from other slabs are the halo layers, and the workers
+meet at a barrier between steps.
+
+The coordinator (DistributedSimulation) applies the dosing and merges the counts,
+deaths, births and step summaries of the workers into one Bookkeeper, so the
+usual metrics functions work on it.
+
+    with DistributedSimulation(300, 300, init_states, workers=8, seed=1,
+                               steps_per_time_unit=2) as sim:
+        while sim.advance():
+            pass
+        metrics = calculate_metrics_for_sim(sim.bookkeeper)
+
+Differences from simulate(engine="arrays", diffusion_backend="stencil"): a child
+born across a slab boundary starts in the next sub-step, and the explicit stencil
+is the only diffusion solver. A parent whose claim is rejected, because the
+position was filled by its owner or by an earlier claim, has still counted the
+reproduction and restarted its reproduction timer, so it loses that child; in
+simulate it would have seen the position taken and used another empty neighbor,
+if it had one. Every worker draws from its own random generators, seeded from
+np.random.SeedSequence(seed).spawn(workers), so results depend on the seed and the
+number of workers, not on the timing of the processes. A single
+worker is seeded with the seed itself, so with workers=1 a run takes the same
+steps as seed_everything(seed) followed by simulate(engine="arrays",
+diffusion_backend="stencil") with the same parameters.
+"""
+import multiprocessing
+import os
+import traceback
+from multiprocessing import shared_memory
+from types import SimpleNamespace
+import numpy as np
+from numba import njit, prange
+from Cell_3d import Cell
+from Cell_Arrays_3d import CellArrays, cell_sweep_numba, decay_antibiotics_numba, seed_numba_rng
+from BookKeepers_3d import Bookkeeper
+from Dosing_3d import DosingSchedule, strategy_indices, strategy_amount, add_dose
+from Efficient_Resource_Manager_3d import (neighbor_table, face_sums, update_faces_numba,
+                                           stencil_layer_numba)
+
+FIELDS = ('food', 'antibiotics', 'food_buffer', 'antibiotics_buffer', 'D_food',
+          'D_antibiotics')
+CLAIM_FIELDS = ('lambd', 'death_date', 'reproduction_timer', 'alive_time')
+
+
+# --- Shared memory --- #
+def create_shared(blocks, specs, name, shape, dtype):
+    dtype = np.dtype(dtype)
+    size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    block = shared_memory.SharedMemory(create=True, size=size)
+    blocks[name] = block
+    specs[name] = (block.name, tuple(shape), dtype.str)
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    array.fill(0)
+    return array
+
+
+def attach_shared(specs):
+    """
+    Open the shared blocks described by specs. Returns the blocks (keep them
+    referenced while the arrays are used) and the arrays.
+    """
+    blocks = {}
+    arrays = {}
+    for name, (block_name, shape, dtype) in specs.items():
+        blocks[name] = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=blocks[name].buf)
+    return blocks, arrays
+
+
+def slab_bounds(height, workers):
+    # First layer of every slab, and the height; the slabs differ by at most a layer.
+    if not 1 <= workers <= height:
+        raise ValueError(f"workers must be between 1 and grid_height ({height})")
+    return [len(part) for part in np.array_split(np.arange(height), workers)]
+
+
+@njit(parallel=True, cache=True)
+def slab_diffusion_step_numba(src_f, src_a, dst_f, dst_a, food_faces_z, food_faces_r,
+                              food_faces_c, antibiotics_faces_z, antibiotics_faces_r,
+                              antibiotics_faces_c, coeff_prime, z_begin, z_end):
+    """
+    One explicit step of diffusion_steps_stencil_numba for the layers z_begin..z_end-1
+    of the (height, size, size) fields, reading the layers next to them as halo.
+    """
+    for z in prange(z_begin, z_end):
+        stencil_layer_numba(src_f, src_a, dst_f, dst_a, food_faces_z, food_faces_r,
+                            food_faces_c, antibiotics_faces_z, antibiotics_faces_r,
+                            antibiotics_faces_c, coeff_prime, z)
+
+
+# --- Worker process --- #
+class SlabWorker:
+    """
+    The cells of the layers z0..z1-1 and the updates of their part of the fields.
+    Local arrays cover the slab plus a halo layer on each side; local index 0 is
+    global index `base`.
+    """
+
+    def __init__(self, config, barrier):
+        self.rank = config['rank']
+        self.workers = config['workers']
+        self.barrier = barrier
+        self.p = config['parameters']
+        self.blocks, self.arrays = attach_shared(config['specs'])
+        size, height = self.p['grid_size'], self.p['grid_height']
+        self.shape = (height, size, size)
+        layer_size = size * size
+        self.z0, self.z1 = config['z0'], config['z1']
+        lz0, lz1 = max(self.z0 - 1, 0), min(self.z1 + 1, height)
+        self.base = lz0 * layer_size
+        self.num_local = (lz1 - lz0) * layer_size
+        self.own_start = (self.z0 - lz0) * layer_size
+        self.own_end = self.own_start + (self.z1 - self.z0) * layer_size
+        self.global_own = slice(self.base + self.own_start, self.base + self.own_end)
+        self.global_local = slice(self.base, self.base + self.num_local)
+
+        np.random.seed(config['seed'])
+        seed_numba_rng(config['seed'])
+        states = np.zeros(self.num_local, dtype=np.int64)
+        states[self.own_start:self.own_end] = self.arrays['state'][self.global_own]
+        self.cells = CellArrays(states, *neighbor_table(size, lz1 - lz0))
+        self.refresh_halo()
+        self.food = self.arrays['food'][self.global_local]
+        self.antibiotics = self.arrays['antibiotics'][self.global_local]
+
+        self.bookkeeper = Bookkeeper()
+        self.bookkeeper.initialize_counts(states[self.own_start:self.own_end])
+        self.steps = 0
+        self.born = []  # global indices born since the last update of D
+        self.sent = {'deaths': 0, 'births': 0}
+
+    def refresh_halo(self):
+        # Halo exchange of the states: the layers next to the slab, as published
+        # by their owners at the end of the last sub-step.
+        shared = self.arrays['state']
+        state = self.cells.state
+        state[:self.own_start] = shared[self.base:self.base + self.own_start]
+        state[self.own_end:] = shared[self.base + self.own_end:self.base + self.num_local]
+
+    def cell_substep(self, dt):
+        cells = self.cells
+        bookkeeper = self.bookkeeper
+        bookkeeper.current_step = self.steps
+        self.refresh_halo()
+        decay_antibiotics_numba(self.antibiotics[self.own_start:self.own_end],
+                                Cell.antibiotics_decay * dt)
+        n_events, n_births, cells.n_live = cell_sweep_numba(
+            cells.live, cells.n_live, cells.state, cells.death_date,
+            cells.reproduction_timer, cells.lambd, cells.alive_time,
+            cells.reproduction_count, cells.good_dead_due_to_antibiotics,
+            cells.bad_dead_due_to_antibiotics, cells.neighbor_offsets,
+            cells.neighbor_indices, self.food, self.antibiotics, dt,
+            Cell.lambd_map[Cell.good], Cell.lambd_map[Cell.bad], Cell.p_mutation,
+            Cell.antibiotics_resistance, Cell.antibiotics_consumption, Cell.eat_amount,
+            cells.ev_index, cells.ev_type, cells.ev_cause, cells.ev_reproduction,
+            cells.ev_alive, cells.ev_changed, cells.birth_index, cells.birth_type,
+            cells.heap_key, cells.heap_index, self.own_start, self.own_end)
+
+        births = cells.birth_index[:n_births]
+        owned = (births >= self.own_start) & (births < self.own_end)
+        bookkeeper.record_births(births[owned] + self.base, cells.birth_type[:n_births][owned])
+        bookkeeper.record_deaths(cells.ev_index[:n_events] + self.base, cells.ev_type[:n_events],
+                                 cells.ev_cause[:n_events], cells.ev_reproduction[:n_events],
+                                 cells.ev_alive[:n_events], cells.ev_changed[:n_events])
+        self.born.append(births[owned] + self.base)
+
+        # Children in the halo are claims on the positions of the neighbors
+        claimed = births[~owned]
+        n = len(claimed)
+        self.arrays['claim_count'][self.rank] = n
+        self.arrays['claim_index'][self.rank, :n] = claimed + self.base
+        self.arrays['claim_type'][self.rank, :n] = cells.state[claimed]
+        for name in CLAIM_FIELDS:
+            self.arrays[f'claim_{name}'][self.rank, :n] = getattr(cells, name)[claimed]
+        self.barrier.wait()
+
+        self.accept_claims()
+        self.arrays['state'][self.global_own] = cells.state[self.own_start:self.own_end]
+        self.barrier.wait()
+        self.steps += dt
+
+    def accept_claims(self):
+        """
+        Place the children the neighbors claimed in this slab. Claims are taken in
+        rank order, and only on positions that are still empty.
+        """
+        count = self.arrays['claim_count']
+        ranks = [r for r in (self.rank - 1, self.rank + 1)
+                 if 0 <= r < self.workers and count[r] > 0]
+        if not ranks:
+            return
+        claim_ranks = np.concatenate([np.full(count[r], r) for r in ranks])
+        claim_rows = np.concatenate([np.arange(count[r]) for r in ranks])
+        index = self.arrays['claim_index'][claim_ranks, claim_rows]
+        select = (index >= self.global_own.start) & (index < self.global_own.stop)
+        cells = self.cells
+        local = index[select] - self.base
+        claim_ranks, claim_rows = claim_ranks[select], claim_rows[select]
+        # The first claim on a position wins, if the owner did not fill it itself.
+        _, first = np.unique(local, return_index=True)
+        first = np.sort(first)
+        first = first[cells.state[local[first]] == 0]
+        if len(first) == 0:
+            return
+        local, claim_ranks, claim_rows = local[first], claim_ranks[first], claim_rows[first]
+        cells.state[local] = self.arrays['claim_type'][claim_ranks, claim_rows]
+        for name in CLAIM_FIELDS:
+            getattr(cells, name)[local] = self.arrays[f'claim_{name}'][claim_ranks, claim_rows]
+        cells.live[cells.n_live:cells.n_live + len(local)] = local
+        cells.n_live += len(local)
+        self.bookkeeper.record_births(local + self.base, cells.state[local])
+        self.born.append(local + self.base)
+
+    def update_resources(self):
+        """
+        Update D and the face sums at the positions born since the last time unit,
+        then diffuse the own layers for a time unit.
+        """
+        p = self.p
+        arrays = self.arrays
+        born = np.concatenate(self.born) if self.born else np.zeros(0, dtype=np.int64)
+        self.born = []
+        states = self.cells.state[born - self.base]
+        empty = states == 0
+        arrays['D_food'][born] = np.where(empty, p['D_food'], p['D_food'] * p['D_food_multiplyer'])
+        arrays['D_antibiotics'][born] = np.where(
+            empty, p['D_antibiotics'], p['D_antibiotics'] * p['D_antibiotics_multiplyer'])
+        self.barrier.wait()
+        # Faces on the slab boundary are written by both owners, from the same D values.
+        update_faces_numba(arrays['D_food'].reshape(self.shape), arrays['food_faces_z'],
+                           arrays['food_faces_r'], arrays['food_faces_c'], born)
+        update_faces_numba(arrays['D_antibiotics'].reshape(self.shape),
+                           arrays['antibiotics_faces_z'], arrays['antibiotics_faces_r'],
+                           arrays['antibiotics_faces_c'], born)
+        self.barrier.wait()
+
+        steps = p['resource_steps_per_time_unit']
+        coeff_prime = 0.5 * (1 / steps) / (p['dx']**2)
+        fields = [arrays[name].reshape(self.shape) for name in FIELDS[:4]]
+        src_f, src_a, dst_f, dst_a = fields
+        for _ in range(steps):
+            slab_diffusion_step_numba(src_f, src_a, dst_f, dst_a, arrays['food_faces_z'],
+                                      arrays['food_faces_r'], arrays['food_faces_c'],
+                                      arrays['antibiotics_faces_z'],
+                                      arrays['antibiotics_faces_r'],
+                                      arrays['antibiotics_faces_c'], coeff_prime, self.z0,
+                                      self.z1)
+            self.barrier.wait()
+            src_f, dst_f = dst_f, src_f
+            src_a, dst_a = dst_a, src_a
+        if steps % 2 == 1:
+            # The result ended up in the buffers, copy the own part back
+            for name in ('food', 'antibiotics'):
+                arrays[name][self.global_own] = arrays[f'{name}_buffer'][self.global_own]
+
+    def report(self):
+        # Counts and the records added since the last report, for the reduction.
+        bookkeeper = self.bookkeeper
+        records = {}
+        for table_name in ('deaths', 'births'):
+            table = getattr(bookkeeper, table_name)
+            start = self.sent[table_name]
+            records[table_name] = {name: table[name][start:].copy() for name in table.dtypes}
+            self.sent[table_name] = len(table)
+        return {'counts': dict(bookkeeper.counts), 'death_counts': bookkeeper.death_counts,
+                'records': records}
+
+
+def run_worker(config, connection, barrier):
+    """
+    Entry point of a worker process: build the slab and answer the commands of the
+    coordinator until "close".
+    """
+    worker = None
+    try:
+        if config['threads']:
+            import numba
+            numba.set_num_threads(config['threads'])
+        worker = SlabWorker(config, barrier)
+        connection.send(('ok', worker.report()))
+        dt = 1 / config['parameters']['steps_per_time_unit']
+        while True:
+            command = connection.recv()
+            if command == "cells":
+                for _ in range(config['parameters']['steps_per_time_unit']):
+                    worker.cell_substep(dt)
+                connection.send(('ok', None))
+            elif command == "resources":
+                worker.update_resources()
+                connection.send(('ok', worker.report()))
+            elif command == "close":
+                break
+    except Exception:
+        barrier.abort()  # do not leave the other workers waiting
+        connection.send(('error', traceback.format_exc()))
+    finally:
+        if worker is not None:
+            del worker.arrays, worker.food, worker.antibiotics, worker.cells
+            for block in worker.blocks.values():
+                block.close()
+        connection.close()
+
+
+# --- Coordinator --- #
+class DistributedSimulation:
+    """
+    A simulation of the arrays engine with the stencil diffusion, split over
+    `workers` processes by slabs of layers (see the module docstring). Takes the
+    parameters of simulate; the workers use threads_per_worker numba threads each
+    (default: the cores divided by the workers). Call close() when done, or use it
+    in a with statement.
+    """
+
+    def __init__(self, grid_size, grid_height, init_states, workers=2, seed=None,
+                 threads_per_worker=None, steps_per_time_unit=1, antibiotics_interval=100,
+                 antibiotics_steps=[10], dump_strat="quarters", dump_size=10, concentration=1,
+                 antibiotics_concentrations=[1], food_interval=100, food_dump_strat="quarters",
+                 food_dump_size=10, amount=1, resource_steps_per_time_unit=4, dx=0.000002,
+                 D_antibiotics=1, D_food=1, D_antibiotics_multiplyer=2, D_food_multiplyer=2,
+                 dosing_schedule=None):
+        self.grid_size = grid_size
+        self.grid_height = grid_height
+        self.workers = workers
+        self.steps = 0
+        self.steps_per_time_unit = steps_per_time_unit
+        self.parameters = dict(
+            grid_size=grid_size, grid_height=grid_height,
+            steps_per_time_unit=steps_per_time_unit,
+            resource_steps_per_time_unit=resource_steps_per_time_unit, dx=dx,
+            D_antibiotics=D_antibiotics, D_food=D_food,
+            D_antibiotics_multiplyer=D_antibiotics_multiplyer,
+            D_food_multiplyer=D_food_multiplyer)
+        layers = slab_bounds(grid_height, workers)
+        num_cells = grid_size * grid_size * grid_height
+        shape = (grid_height, grid_size, grid_size)
+        self.blocks = {}
+        self.specs = {}
+        self.processes = []
+        self.connections = []
+
+        try:
+            # --- Shared fields and states --- #
+            arrays = {'state': create_shared(self.blocks, self.specs, 'state', (num_cells,),
+                                             np.int8)}
+            for name in FIELDS:
+                arrays[name] = create_shared(self.blocks, self.specs, name, (num_cells,),
+                                             np.float64)
+            for field in ('food', 'antibiotics'):
+                for axis, faces_shape in zip('zrc', (
+                        (grid_height - 1, grid_size, grid_size),
+                        (grid_height, grid_size - 1, grid_size),
+                        (grid_height, grid_size, grid_size - 1))):
+                    name = f'{field}_faces_{axis}'
+                    arrays[name] = create_shared(self.blocks, self.specs, name, faces_shape,
+                                                 np.float64)
+            capacity = 2 * grid_size * grid_size  # at most the two halo layers per sub-step
+            arrays['claim_count'] = create_shared(self.blocks, self.specs, 'claim_count',
+                                                  (workers,), np.int64)
+            for name in ('index', 'type'):
+                arrays[f'claim_{name}'] = create_shared(self.blocks, self.specs,
+                                                        f'claim_{name}', (workers, capacity),
+                                                        np.int64)
+            for name in CLAIM_FIELDS:
+                arrays[f'claim_{name}'] = create_shared(self.blocks, self.specs,
+                                                        f'claim_{name}', (workers, capacity),
+                                                        np.float64)
+            self.arrays = arrays
+
+            states = np.asarray(init_states)
+            arrays['state'][:] = states
+            empty = states == 0
+            arrays['D_food'][:] = np.where(empty, D_food, D_food * D_food_multiplyer)
+            arrays['D_antibiotics'][:] = np.where(empty, D_antibiotics,
+                                                  D_antibiotics * D_antibiotics_multiplyer)
+            for field, D in (('food', arrays['D_food']),
+                             ('antibiotics', arrays['D_antibiotics'])):
+                for axis, faces in zip('zrc', face_sums(D.reshape(shape))):
+                    arrays[f'{field}_faces_{axis}'][:] = faces
+            # The fields as simulate's resources, for the dosing and the summaries
+            self.resources = SimpleNamespace(food=arrays['food'],
+                                             antibiotics=arrays['antibiotics'])
+
+            # --- Dosing, as in simulate --- #
+            indices, unique = strategy_indices(food_dump_strat, grid_size, grid_height,
+                                               food_dump_size)
+            add_dose(arrays['food'], indices,
+                     strategy_amount(food_dump_strat, amount, grid_size, food_dump_size),
+                     unique)
+            self.dosing = dosing_schedule or DosingSchedule.from_parameters(
+                grid_size, grid_height, antibiotics_steps, antibiotics_concentrations,
+                dump_strat, dump_size, concentration, antibiotics_interval, food_interval,
+                food_dump_strat, food_dump_size, amount)
+
+            # --- Workers --- #
+            if workers == 1 and seed is not None:
+                seeds = [seed]  # as seed_everything seeds simulate
+            else:
+                seeds = [int(child.generate_state(1)[0])
+                         for child in np.random.SeedSequence(seed).spawn(workers)]
+            if threads_per_worker is None:
+                threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+            # Numba's thread pool is not fork-safe, so the workers are started fresh.
+            context = multiprocessing.get_context("spawn")
+            barrier = context.Barrier(workers)
+            z0 = 0
+            for rank in range(workers):
+                config = {'rank': rank, 'workers': workers, 'z0': z0, 'z1': z0 + layers[rank],
+                          'seed': seeds[rank], 'threads': threads_per_worker,
+                          'specs': self.specs, 'parameters': self.parameters}
+                z0 += layers[rank]
+                parent, child = context.Pipe()
+                process = context.Process(target=run_worker, args=(config, child, barrier),
+                                          daemon=True)
+                process.start()
+                child.close()
+                self.processes.append(process)
+                self.connections.append(parent)
+
+            self.bookkeeper = Bookkeeper()
+            self.reduce(self.gather())
+        except BaseException:
+            self.close()
+            raise
+
+    def gather(self):
+        replies = []
+        errors = []
+        for rank, connection in enumerate(self.connections):
+            try:
+                status, payload = connection.recv()
+            except EOFError:
+                status, payload = 'error', "the worker process exited"
+            if status == 'error':
+                errors.append((rank, payload))
+            replies.append(payload)
+        if errors:
+            # The first real error, not the broken barriers it caused in the others
+            rank, message = next(((r, m) for r, m in errors if "BrokenBarrierError" not in m),
+                                 errors[0])
+            self.close()
+            raise RuntimeError(f"Worker {rank} failed:\n{message}")
+        return replies
+
+    def command(self, command):
+        for connection in self.connections:
+            connection.send(command)
+        return self.gather()
+
+    def reduce(self, reports):
+        """
+        Merge the counts and new records of the workers into the Bookkeeper. The
+        records of a time unit are ordered by their step, then by worker.
+        """
+        bookkeeper = self.bookkeeper
+        for key in bookkeeper.counts:
+            bookkeeper.counts[key] = sum(report['counts'][key] for report in reports)
+        for cell_type, causes in bookkeeper.death_counts.items():
+            for cause in causes:
+                causes[cause] = sum(report['death_counts'][cell_type][cause]
+                                    for report in reports)
+        for table_name in ('deaths', 'births'):
+            table = getattr(bookkeeper, table_name)
+            columns = {name: np.concatenate([report['records'][table_name][name]
+                                             for report in reports])
+                       for name in table.dtypes}
+            if len(columns['step']):
+                order = np.argsort(columns['step'], kind='stable')
+                table.extend(**{name: values[order] for name, values in columns.items()})
+
+    def advance(self):
+        """
+        Run one time unit like simulate.advance: the cell sub-steps, the dosing, the
+        update of D, the diffusion and the step summary. Returns False once no
+        alive cells are left.
+        """
+        self.command("cells")
+        dt = 1 / self.steps_per_time_unit
+        for _ in range(self.steps_per_time_unit):
+            self.steps += dt
+        self.bookkeeper.current_step = self.steps
+        self.dosing.apply(int(self.steps), self.resources)
+        self.reduce(self.command("resources"))
+        self.bookkeeper.record_step_summary(step=int(self.steps), resource_manager=self.resources)
+        return self.bookkeeper.counts['alive_good'] + self.bookkeeper.counts['alive_bad'] > 0
+
+    def get_states(self):
+        """
+        The states of the grid (int8), as published by the workers after the last sub-step.
+        """
+        return self.arrays['state']
+
+    def close(self):
+        """
+        Stop the workers and free the shared memory.
+        """
+        for connection in self.connections:
+            try:
+                connection.send("close")
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        for connection in self.connections:
+            connection.close()
+        self.processes = []
+        self.connections = []
+        self.arrays = {}
+        self.resources = None
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,255 @@
+"""
+Dosing of antibiotics and food.
+
+A dosing strategy ("middle", "quarters", "corner", "uniform" or anything else for
+the whole grid) is turned once into the flat grid indices it covers, cached per grid
+shape, and a dose is then added with a single vectorized scatter-add.
+
+A DosingSchedule holds the doses of a run: at given steps, every n steps, with a
+strategy, a custom 3D mask or a gradient over the layers.
+
+    schedule = DosingSchedule(grid_size=50, grid_height=50)
+    schedule.add("antibiotics", 0.5, at=[10, 20], strategy="middle", dump_size=20)
+    schedule.add("food", 10, every=75)
+    schedule.add("antibiotics", 0.2, at=[30], layer_weights=np.linspace(1, 0, 50))
+    sim = simulate(..., dosing_schedule=schedule)
+"""
+from functools import lru_cache
+import numpy as np
+
+RESOURCES = ('antibiotics', 'food')
+
+
+@lru_cache(maxsize=None)
+def strategy_indices(strategy, size, height, dump_size):
+    """
+    Flat indices of the grid positions a strategy doses, in the order of the
+    original loops over layers, rows and columns, or None for the whole grid, and
+    whether the indices are distinct. Cached per (strategy, grid shape, dump size),
+    so the array is read-only.
+    """
+    n = size
+    if strategy == "middle":
+        start = round(n/2) - int(np.floor(dump_size/2))
+        end = round(n/2) + int(np.ceil(dump_size/2))
+        rows = range(start, end)
+        cols = range(start, end)
+    elif strategy == "quarters":
+        # For quarters, we inject in four separate blocks
+        rows = []
+        for factor in [1, 3]:
+            r_start = round(factor * n/4) - int(np.floor(dump_size/4))
+            r_end = round(factor * n/4) + int(np.ceil(dump_size/4))
+            rows.extend(range(r_start, r_end))
+        # Remove duplicates and sort:
+        rows = sorted(set(rows))
+        cols = rows
+    elif strategy == "corner":
+        # Inject in the top-left corner
+        rows = range(dump_size)
+        cols = range(dump_size)
+    else:
+        # "uniform" and the default strategy inject everywhere
+        return None, True
+
+    z, r, c = np.meshgrid(np.arange(height), np.asarray(rows, dtype=np.int64),
+                          np.asarray(cols, dtype=np.int64), indexing='ij')
+    indices = (z * n * n + r * n + c).ravel()
+    num_cells = n * n * height
+    if indices.size and (indices.max() >= num_cells or indices.min() < -num_cells):
+        raise IndexError(f"dump_size {dump_size} does not fit strategy '{strategy}' "
+                         f"on a grid of size {n}")
+    indices = np.where(indices < 0, indices + num_cells, indices)  # as numpy indexing does
+    indices.flags.writeable = False
+    return indices, len(np.unique(indices)) == len(indices)
+
+
+def strategy_amount(strategy, amount, size, dump_size):
+    # "uniform" spreads the amount of (2 * dump_size)^2 positions over every position.
+    if strategy == "uniform":
+        return amount * ((2 * dump_size)**2) / (size**2)
+    return amount
+
+
+def add_dose(field, indices, values, unique=None):
+    """
+    Add values to field at indices (None for the whole grid) in one operation.
+    Repeated indices get the dose once per occurrence, like the original loops;
+    pass unique=True when the indices are known to be distinct.
+    """
+    if unique is None:
+        unique = indices is None or len(np.unique(indices)) == len(indices)
+    if indices is None:
+        field += values
+    elif unique:
+        field[indices] += values
+    else:
+        np.add.at(field, indices, values)
+
+
+class Dose:
+    """
+    One dose of a resource compiled for a grid: the flat indices it covers (None
+    for the whole grid) and the amount added there, one number or one per index.
+    """
+
+    def __init__(self, resource, indices, values, unique=None):
+        if resource not in RESOURCES:
+            raise ValueError(f"Unknown resource: {resource}")
+        self.resource = resource
+        self.indices = indices
+        self.values = values
+        if unique is None:
+            unique = indices is None or len(np.unique(indices)) == len(indices)
+        self.unique = unique
+
+    def apply(self, resource_manager):
+        add_dose(getattr(resource_manager, self.resource), self.indices, self.values,
+                 self.unique)
+
+
+class DosingSchedule:
+    """
+    The doses of a run. Every rule doses at a set of steps (`at`, a list of steps
+    or a dict of step -> amount) and/or every `every` steps. Looking up the doses
+    of a step costs a dictionary lookup or a modulo per rule, whatever the length
+    of the run. Rules are applied in the order they were added.
+    """
+
+    def __init__(self, grid_size, grid_height):
+        self.grid_size = grid_size
+        self.grid_height = grid_height
+        self.num_cells = grid_size * grid_size * grid_height
+        # Per rule: (dict of step -> Dose, interval or None, Dose for the interval)
+        self.rules = []
+
+    def compile(self, resource, amount, strategy="", dump_size=10, mask=None,
+                layer_weights=None):
+        """
+        Dose of `amount` per grid position, placed by a strategy, by a custom mask of
+        shape (height, size, size) (booleans, or weights that multiply the amount),
+        and/or scaled per layer by layer_weights (one weight per layer).
+        """
+        shape = (self.grid_height, self.grid_size, self.grid_size)
+        if mask is not None:
+            mask = np.asarray(mask).reshape(shape)
+            indices = np.flatnonzero(mask)
+            unique = True
+            values = amount if mask.dtype == bool else amount * mask.ravel()[indices]
+        else:
+            indices, unique = strategy_indices(strategy, self.grid_size, self.grid_height,
+                                               dump_size)
+            values = strategy_amount(strategy, amount, self.grid_size, dump_size)
+        if layer_weights is not None:
+            layer_weights = np.asarray(layer_weights, dtype=np.float64)
+            if layer_weights.shape != (self.grid_height,):
+                raise ValueError(f"layer_weights needs {self.grid_height} values")
+            layer_size = self.grid_size * self.grid_size
+            layers = (np.arange(self.num_cells) if indices is None else indices) // layer_size
+            values = values * layer_weights[layers]
+        return Dose(resource, indices, values, unique)
+
+    def add(self, resource, amount, at=None, every=None, strategy="", dump_size=10,
+            mask=None, layer_weights=None):
+        """
+        Add a rule: dose `resource` at the steps in `at` and/or every `every` steps.
+        `at` may be a dict of step -> amount to use a different amount per step.
+        The placement arguments are those of compile.
+        """
+        if at is None and every is None:
+            raise ValueError("A dose needs `at` or `every`")
+        timed = {}
+        if at is not None:
+            amounts = at if isinstance(at, dict) else {step: amount for step in at}
+            for step, step_amount in amounts.items():
+                timed[int(step)] = self.compile(resource, step_amount, strategy, dump_size,
+                                                mask, layer_weights)
+        periodic = None
+        if every is not None:
+            periodic = self.compile(resource, amount, strategy, dump_size, mask,
+                                    layer_weights)
+        self.rules.append((timed, every, periodic))
+        return self
+
+    def doses_at(self, step):
+        doses = []
+        for timed, every, periodic in self.rules:
+            if step in timed:
+                doses.append(timed[step])
+            if every and step % every == 0:
+                doses.append(periodic)
+        return doses
+
+    def apply(self, step, resource_manager):
+        """
+        Add the doses that are due at `step` to the resources.
+        """
+        for dose in self.doses_at(step):
+            dose.apply(resource_manager)
+
+    @classmethod
+    def from_parameters(cls, grid_size, grid_height, antibiotics_steps,
+                        antibiotics_concentrations, dump_strat, dump_size, concentration,
+                        antibiotics_interval, food_interval, food_dump_strat, food_dump_size,
+                        amount):
+        """
+        The schedule of the simulate parameters: antibiotics at antibiotics_steps with
+        their antibiotics_concentrations, antibiotics every antibiotics_interval steps
+        and food every food_interval steps.
+        """
+        schedule = cls(grid_size, grid_height)
+        at = {}
+        for step, step_concentration in zip(antibiotics_steps, antibiotics_concentrations):
+            at.setdefault(int(step), step_concentration)  # the first one of a step counts
+        if len(antibiotics_concentrations) < len(antibiotics_steps):
+            raise ValueError("antibiotics_steps needs one of antibiotics_concentrations each")
+        if at:
+            schedule.add("antibiotics", None, at=at, strategy=dump_strat,
+                         dump_size=dump_size)
+        schedule.add("antibiotics", concentration, every=antibiotics_interval,
+                     strategy=dump_strat, dump_size=dump_size)
+        schedule.add("food", amount, every=food_interval, strategy=food_dump_strat,
+                     dump_size=food_dump_size)
+        return schedule
+
+    # --- Saving in checkpoints --- #
+    def to_arrays(self):
+        """
+        The schedule as a JSON-compatible description plus the arrays it refers to.
+        """
+        rules = []
+        arrays = {}
+
+        def describe(dose, name):
+            if dose.indices is not None:
+                arrays[f"{name}/indices"] = dose.indices
+            if np.ndim(dose.values):
+                arrays[f"{name}/values"] = dose.values
+            return {'resource': dose.resource, 'indices': dose.indices is not None,
+                    'values': None if np.ndim(dose.values) else float(dose.values)}
+
+        for r, (timed, every, periodic) in enumerate(self.rules):
+            rules.append({
+                'timed': [[step, describe(dose, f"{r}/at/{step}")]
+                          for step, dose in timed.items()],
+                'every': every,
+                'periodic': None if periodic is None else describe(periodic, f"{r}/every"),
+            })
+        return {'grid_size': self.grid_size, 'grid_height': self.grid_height,
+                'rules': rules}, arrays
+
+    @classmethod
+    def from_arrays(cls, description, arrays):
+        schedule = cls(description['grid_size'], description['grid_height'])
+
+        def restore(entry, name):
+            indices = arrays[f"{name}/indices"] if entry['indices'] else None
+            values = arrays[f"{name}/values"] if entry['values'] is None else entry['values']
+            return Dose(entry['resource'], indices, values)
+
+        for r, rule in enumerate(description['rules']):
+            timed = {step: restore(entry, f"{r}/at/{step}") for step, entry in rule['timed']}
+            periodic = None if rule['periodic'] is None else restore(rule['periodic'],
+                                                                     f"{r}/every")
+            schedule.rules.append((timed, rule['every'], periodic))
+        return schedule
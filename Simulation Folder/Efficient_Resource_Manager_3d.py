@@ -1,14 +1,17 @@
+from functools import lru_cache
 import numpy as np
-from numba import njit, typed, types
+from numba import njit, prange
+from Profiler_3d import NULL_PROFILER
+from Precision_3d import precision_dtypes
 
-@njit
-def diffusion_step_food_numba(food, neighbors, D_food, dt, dx):
+@njit(cache=True)
+def diffusion_step_food_numba(food, neighbor_offsets, neighbor_indices, D_food, dt, dx):
     n = food.shape[0]
     C_new = food.copy()
     for j in range(n):
         flux = 0.0
-        # neighbors[j] is expected to be a list or array of indices
-        for k in neighbors[j]:
+        # The neighbors of j are neighbor_indices[neighbor_offsets[j]:neighbor_offsets[j + 1]]
+        for k in neighbor_indices[neighbor_offsets[j]:neighbor_offsets[j + 1]]:
             D_avg = 0.5 * (D_food[j] + D_food[k])
             flux += D_avg * (food[k] - food[j])
         C_new[j] += dt / (dx**2) * flux
@@ -16,13 +19,14 @@ def diffusion_step_food_numba(food, neighbors, D_food, dt, dx):
             C_new[j] = 0.0
     return C_new
 
-@njit
-def diffusion_step_antibiotics_numba(antibiotics, neighbors, D_antibiotics, dt, dx):
+@njit(cache=True)
+def diffusion_step_antibiotics_numba(antibiotics, neighbor_offsets, neighbor_indices,
+                                     D_antibiotics, dt, dx):
     n = antibiotics.shape[0]
     C_new = antibiotics.copy()
     for j in range(n):
         flux = 0.0
-        for k in neighbors[j]:
+        for k in neighbor_indices[neighbor_offsets[j]:neighbor_offsets[j + 1]]:
             D_avg = 0.5 * (D_antibiotics[j] + D_antibiotics[k])
             flux += D_avg * (antibiotics[k] - antibiotics[j])
         C_new[j] += dt / (dx**2) * flux
@@ -30,15 +34,16 @@ def diffusion_step_antibiotics_numba(antibiotics, neighbors, D_antibiotics, dt,
             C_new[j] = 0.0
     return C_new
 
-@njit
-def diffusion_steps_antibiotics_FAST(antibiotics, neighbors, D_antibiotics, dt, dx, steps):
+@njit(cache=True)
+def diffusion_steps_antibiotics_FAST(antibiotics, neighbor_offsets, neighbor_indices,
+                                     D_antibiotics, dt, dx, steps):
     # Perform diffusion for a specified number of steps
     n = antibiotics.shape[0]
     for _ in range(steps):
         C_new = antibiotics.copy()
         for j in range(n):
             flux = 0.0
-            for k in neighbors[j]:
+            for k in neighbor_indices[neighbor_offsets[j]:neighbor_offsets[j + 1]]:
                 D_avg = 0.5 * (D_antibiotics[j] + D_antibiotics[k])
                 flux += D_avg * (antibiotics[k] - antibiotics[j])
             C_new[j] += dt / (dx**2) * flux
@@ -47,8 +52,9 @@ def diffusion_steps_antibiotics_FAST(antibiotics, neighbors, D_antibiotics, dt,
         antibiotics = C_new
     return antibiotics
 
-@njit
-def diffusion_steps_antibiotics_FAST_optimized(antibiotics, buffer, neighbors, D_antibiotics, dt, dx, steps):
+@njit(cache=True)
+def diffusion_steps_antibiotics_FAST_optimized(antibiotics, buffer, neighbor_offsets,
+                                               neighbor_indices, D_antibiotics, dt, dx, steps):
     n = antibiotics.shape[0]
     src = antibiotics
     dst = buffer
@@ -63,7 +69,7 @@ def diffusion_steps_antibiotics_FAST_optimized(antibiotics, buffer, neighbors, D
             src_j = src[j]
             
             sum_of_neighbor_terms = 0.0
-            for k in neighbors[j]:
+            for k in neighbor_indices[neighbor_offsets[j]:neighbor_offsets[j + 1]]:
                 # D_k = D_antibiotics[k] # Accessed directly
                 # src_k = src[k]         # Accessed directly
                 
@@ -83,6 +89,182 @@ def diffusion_steps_antibiotics_FAST_optimized(antibiotics, buffer, neighbors, D
         return antibiotics
     return src
 
+@njit(cache=True)
+def stencil_layer_numba(src_f, src_a, dst_f, dst_a, food_faces_z, food_faces_r, food_faces_c,
+                        antibiotics_faces_z, antibiotics_faces_r, antibiotics_faces_c,
+                        coeff_prime, z):
+    # One explicit diffusion step of layer z of both (height, size, size) fields,
+    # computed in the dtype of the fields (coeff_prime should have it as well).
+    height, size, _ = src_f.shape
+    zero = src_f.dtype.type(0.0)
+    for r in range(size):
+        for c in range(size):
+            f_j = src_f[z, r, c]
+            a_j = src_a[z, r, c]
+            flux_f = zero
+            flux_a = zero
+            if r > 0:
+                flux_f += food_faces_r[z, r - 1, c] * (src_f[z, r - 1, c] - f_j)
+                flux_a += antibiotics_faces_r[z, r - 1, c] * (src_a[z, r - 1, c] - a_j)
+            if r < size - 1:
+                flux_f += food_faces_r[z, r, c] * (src_f[z, r + 1, c] - f_j)
+                flux_a += antibiotics_faces_r[z, r, c] * (src_a[z, r + 1, c] - a_j)
+            if c > 0:
+                flux_f += food_faces_c[z, r, c - 1] * (src_f[z, r, c - 1] - f_j)
+                flux_a += antibiotics_faces_c[z, r, c - 1] * (src_a[z, r, c - 1] - a_j)
+            if c < size - 1:
+                flux_f += food_faces_c[z, r, c] * (src_f[z, r, c + 1] - f_j)
+                flux_a += antibiotics_faces_c[z, r, c] * (src_a[z, r, c + 1] - a_j)
+            if z > 0:
+                flux_f += food_faces_z[z - 1, r, c] * (src_f[z - 1, r, c] - f_j)
+                flux_a += antibiotics_faces_z[z - 1, r, c] * (src_a[z - 1, r, c] - a_j)
+            if z < height - 1:
+                flux_f += food_faces_z[z, r, c] * (src_f[z + 1, r, c] - f_j)
+                flux_a += antibiotics_faces_z[z, r, c] * (src_a[z + 1, r, c] - a_j)
+
+            new_f = f_j + coeff_prime * flux_f
+            new_a = a_j + coeff_prime * flux_a
+            dst_f[z, r, c] = new_f if new_f > 0 else zero
+            dst_a[z, r, c] = new_a if new_a > 0 else zero
+
+
+@njit(parallel=True, cache=True)
+def diffusion_steps_stencil_numba(food, antibiotics, food_buffer, antibiotics_buffer,
+                                  food_faces_z, food_faces_r, food_faces_c,
+                                  antibiotics_faces_z, antibiotics_faces_r,
+                                  antibiotics_faces_c, dt, dx, steps):
+    """
+    Diffuse food and antibiotics together for a number of steps.
+    The fields are (height, size, size) views of the grid and the *_faces_* arrays hold
+    D_j + D_k for the faces between neighbors along each axis (see face_sums).
+    The face-sharing neighbors are reached with a stencil instead of neighbor lists,
+    the layers are split over threads, and the fields ping-pong between the buffers.
+    """
+    height = food.shape[0]
+    coeff_prime = food.dtype.type(0.5 * dt / (dx**2))
+
+    src_f, dst_f = food, food_buffer
+    src_a, dst_a = antibiotics, antibiotics_buffer
+    for _ in range(steps):
+        for z in prange(height):
+            stencil_layer_numba(src_f, src_a, dst_f, dst_a, food_faces_z, food_faces_r,
+                                food_faces_c, antibiotics_faces_z, antibiotics_faces_r,
+                                antibiotics_faces_c, coeff_prime, z)
+        # Swap source and destination arrays for the next iteration
+        src_f, dst_f = dst_f, src_f
+        src_a, dst_a = dst_a, src_a
+
+    if steps % 2 == 1:
+        # The result ended up in the buffers, copy it back
+        food[:] = food_buffer
+        antibiotics[:] = antibiotics_buffer
+
+
+def face_sums(D):
+    """
+    D_j + D_k for every face between neighbors of a (height, size, size) array, per
+    axis: shapes (height-1, size, size), (height, size-1, size), (height, size, size-1).
+    """
+    return D[:-1] + D[1:], D[:, :-1] + D[:, 1:], D[:, :, :-1] + D[:, :, 1:]
+
+
+@njit(cache=True)
+def update_faces_numba(D, faces_z, faces_r, faces_c, indices):
+    # Recompute the face sums around the grid positions in indices after D changed there.
+    height, size, _ = D.shape
+    layer_size = size * size
+    for index in indices:
+        z = index // layer_size
+        r = (index % layer_size) // size
+        c = index % size
+        if z > 0:
+            faces_z[z - 1, r, c] = D[z - 1, r, c] + D[z, r, c]
+        if z < height - 1:
+            faces_z[z, r, c] = D[z, r, c] + D[z + 1, r, c]
+        if r > 0:
+            faces_r[z, r - 1, c] = D[z, r - 1, c] + D[z, r, c]
+        if r < size - 1:
+            faces_r[z, r, c] = D[z, r, c] + D[z, r + 1, c]
+        if c > 0:
+            faces_c[z, r, c - 1] = D[z, r, c - 1] + D[z, r, c]
+        if c < size - 1:
+            faces_c[z, r, c] = D[z, r, c] + D[z, r, c + 1]
+
+
+@njit(parallel=True, cache=True)
+def implicit_lines_numba(u, faces, coeff):
+    """
+    Backward Euler diffusion along the last axis of a 3D array, solved line by line
+    with the Thomas algorithm. faces holds D_j + D_k between the neighbors along that
+    axis, so the face coefficients are coeff * 0.5 * faces, and the ends of every
+    line are closed (no flux), like the grid boundaries.
+    The arrays may be transposed views, so any axis can be put last.
+    """
+    n0, n1, m = u.shape
+    for a in prange(n0):
+        c_prime = np.empty(m, dtype=u.dtype)
+        d_prime = np.empty(m, dtype=u.dtype)
+        for b in range(n1):
+            # Forward elimination
+            k_left = 0.0
+            for i in range(m):
+                k_right = coeff * 0.5 * faces[a, b, i] if i < m - 1 else 0.0
+                diag = 1.0 + k_left + k_right
+                if i == 0:
+                    c_prime[i] = -k_right / diag
+                    d_prime[i] = u[a, b, i] / diag
+                else:
+                    denom = diag + k_left * c_prime[i - 1]
+                    c_prime[i] = -k_right / denom
+                    d_prime[i] = (u[a, b, i] + k_left * d_prime[i - 1]) / denom
+                k_left = k_right
+            # Back substitution
+            u[a, b, m - 1] = d_prime[m - 1]
+            for i in range(m - 2, -1, -1):
+                u[a, b, i] = d_prime[i] - c_prime[i] * u[a, b, i + 1]
+
+
+def implicit_step_3d(u, faces, h, dx):
+    """
+    One locally one-dimensional (LOD) backward Euler step of size h on a
+    (height, size, size) field, in place, with the face sums of face_sums(D).
+    Unconditionally stable and keeps the field non-negative, whatever h, dx and D are.
+    """
+    coeff = h / dx**2
+    faces_z, faces_r, faces_c = faces
+    implicit_lines_numba(u.transpose(1, 2, 0), faces_z.transpose(1, 2, 0), coeff)
+    implicit_lines_numba(u.transpose(0, 2, 1), faces_r.transpose(0, 2, 1), coeff)
+    implicit_lines_numba(u, faces_c, coeff)
+
+
+@lru_cache(maxsize=None)
+def neighbor_table(size, height):
+    """
+    The face-sharing neighbors of every grid position as a CSR table: the neighbors
+    of j are indices[offsets[j]:offsets[j + 1]], in the order of
+    get_close_neighbors_3d. Built with array operations and cached per grid shape,
+    so the arrays are read-only and shared by everything on a grid of that shape.
+    """
+    layer_size = size * size
+    num_cells = layer_size * height
+    index = np.arange(num_cells, dtype=np.int64)
+    z = index // layer_size
+    row = (index % layer_size) // size
+    col = index % size
+    # (exists, neighbor) per direction, in the order of get_close_neighbors_3d
+    directions = [(row > 0, index - size), (row < size - 1, index + size),
+                  (col > 0, index - 1), (col < size - 1, index + 1),
+                  (z > 0, index - layer_size), (z < height - 1, index + layer_size)]
+    exists = np.stack([d[0] for d in directions], axis=1)
+    neighbors = np.stack([d[1] for d in directions], axis=1)
+    offsets = np.zeros(num_cells + 1, dtype=np.int64)
+    np.cumsum(exists.sum(axis=1), out=offsets[1:])
+    indices = neighbors[exists]  # row by row, so per position in direction order
+    offsets.flags.writeable = False
+    indices.flags.writeable = False
+    return offsets, indices
+
+
 def get_close_neighbors_3d(index, size, height):
     """
     Get the immediate (face-sharing) neighbors for a cell in a 3D grid with customizable height.
@@ -113,9 +295,45 @@ def get_close_neighbors_3d(index, size, height):
 class ResourceManager:
 
     def __init__(self, grid_size, grid_height, resource_steps_per_time_unit, dx,
-                 D_antibiotics, D_food, D_antibiotics_multiplyer, D_food_multiplyer):
+                 D_antibiotics, D_food, D_antibiotics_multiplyer, D_food_multiplyer,
+                 diffusion_backend="neighbors", solver="explicit", cfl_safety=0.9,
+                 max_substeps=100000, implicit_tolerance=1e-3, implicit_min_step=1e-9,
+                 precision="float64"):
+        """
+        diffusion_backend: "neighbors" diffuses each field separately over the neighbor
+                           lists, "stencil" diffuses both fields in one parallel call.
+        solver: "explicit" takes resource_steps_per_time_unit explicit steps per time unit,
+                "cfl" takes as many explicit steps as the stability limit requires
+                (times cfl_safety), and "implicit" uses LOD backward Euler steps whose
+                size is controlled by step doubling with relative implicit_tolerance.
+                "cfl" raises when more than max_substeps steps are needed, e.g. for
+                the dx and D_food of the notebook (about 10^12 steps per time unit).
+        The number of steps used in the last time unit is kept in effective_substeps.
+        For "implicit" these are the accepted steps; rejected_substeps counts the
+        rejected ones and implicit_solves the LOD solves of both (three per step:
+        one of size h and two of size h/2). A step size below implicit_min_step
+        raises instead of retrying forever.
+        precision: "float64", or "float32" to store the fields, their buffers, D and
+                   the face sums in float32 (see Precision_3d.py).
+        """
+        if diffusion_backend not in ("neighbors", "stencil"):
+            raise ValueError(f"Unknown diffusion backend: {diffusion_backend}")
+        if solver not in ("explicit", "cfl", "implicit"):
+            raise ValueError(f"Unknown diffusion solver: {solver}")
+        self.diffusion_backend = diffusion_backend
+        self.solver = solver
+        self.cfl_safety = cfl_safety
+        self.max_substeps = max_substeps
+        self.implicit_tolerance = implicit_tolerance
+        self.implicit_min_step = implicit_min_step
         self.dt = 1/resource_steps_per_time_unit
         self.resource_steps_per_time_unit = resource_steps_per_time_unit
+        self.substeps = resource_steps_per_time_unit
+        self.effective_substeps = {'food': 0, 'antibiotics': 0}
+        self.rejected_substeps = {'food': 0, 'antibiotics': 0}
+        self.implicit_solves = {'food': 0, 'antibiotics': 0}
+        # Last accepted implicit step size per field, reused as the next first guess.
+        self.implicit_h = {'food': self.dt, 'antibiotics': self.dt}
         self.dx = dx
 
         self.D_antibiotics = D_antibiotics
@@ -124,49 +342,165 @@ class ResourceManager:
         self.D_food_multiplyer = D_food_multiplyer
 
         self.num_cells = grid_size * grid_size * grid_height
+        self.shape = (grid_height, grid_size, grid_size)  # (layer, row, column) view
 
         # For speed we now use numpy arrays instead of dictionaries.
-        self.food = np.zeros(self.num_cells, dtype=np.float64)
-        self.antibiotics = np.zeros(self.num_cells, dtype=np.float64)
-        self.antibiotics_buffer = np.zeros(self.num_cells, dtype=np.float64)
+        self.dtype = precision_dtypes(precision)['field']
+        self.food = np.zeros(self.num_cells, dtype=self.dtype)
+        self.antibiotics = np.zeros(self.num_cells, dtype=self.dtype)
+        self.antibiotics_buffer = np.zeros(self.num_cells, dtype=self.dtype)
+        self.food_buffer = np.zeros(self.num_cells, dtype=self.dtype)
         # Create arrays for D values (dictionary data converted to numpy arrays)
-        self.D_food_arr = np.full(self.num_cells, D_food, dtype=np.float64)
-        self.D_antibiotics_arr = np.full(self.num_cells, D_antibiotics, dtype=np.float64)
+        self.D_food_arr = np.full(self.num_cells, D_food, dtype=self.dtype)
+        self.D_antibiotics_arr = np.full(self.num_cells, D_antibiotics, dtype=self.dtype)
+
+        # Neighbors of every position as a CSR table, shared with the cells
+        self.neighbor_offsets, self.neighbor_indices = neighbor_table(grid_size, grid_height)
 
-        # Precompute neighbors as a typed list of arrays for numba compatibility.
-        self.neighbors = typed.List()
-        for index in range(self.num_cells):
-            neigh = np.array(get_close_neighbors_3d(index, grid_size, grid_height), 
-                             dtype=np.int64)
-            self.neighbors.append(neigh)
+        # D_j + D_k per face and axis for the stencil and implicit kernels, kept up
+        # to date by update_D and update_D_changed.
+        self.faces = {}
+        self.rebuild_faces()
+        # simulate hands over its profiler; the fields are timed as sub-phases
+        self.profiler = NULL_PROFILER
+
+    def rebuild_faces(self):
+        # The face sums of both fields from scratch, e.g. after D was set directly.
+        self.faces['food'] = face_sums(self.D_food_arr.reshape(self.shape))
+        self.faces['antibiotics'] = face_sums(self.D_antibiotics_arr.reshape(self.shape))
 
     def diffusion_step_food(self):
-        self.food = diffusion_step_food_numba(self.food, self.neighbors, self.D_food_arr, 
+        self.food = diffusion_step_food_numba(self.food, self.neighbor_offsets,
+                                              self.neighbor_indices, self.D_food_arr,
                                               self.dt, self.dx)
     
     def diffusion_step_antibiotics(self):
-        self.antibiotics = diffusion_step_antibiotics_numba(self.antibiotics,  self.neighbors, 
-                                                            self.D_antibiotics_arr, self.dt, 
+        self.antibiotics = diffusion_step_antibiotics_numba(self.antibiotics,
+                                                            self.neighbor_offsets,
+                                                            self.neighbor_indices,
+                                                            self.D_antibiotics_arr, self.dt,
                                                             self.dx)
     
+    def diffusion_step_stencil(self):
+        diffusion_steps_stencil_numba(self.food.reshape(self.shape),
+                                      self.antibiotics.reshape(self.shape),
+                                      self.food_buffer.reshape(self.shape),
+                                      self.antibiotics_buffer.reshape(self.shape),
+                                      *self.faces['food'], *self.faces['antibiotics'],
+                                      self.dt, self.dx, self.substeps)
+
+    def cfl_substeps(self):
+        """
+        Number of explicit steps per time unit needed for stability. A voxel has at
+        most 6 faces with D_avg <= max(D), so dt <= dx^2 / (6 * max(D)) is stable.
+        """
+        D_max = max(self.D_food_arr.max(), self.D_antibiotics_arr.max())
+        if D_max <= 0:
+            return 1
+        dt_max = self.cfl_safety * self.dx**2 / (6 * D_max)
+        substeps = int(np.ceil(1 / dt_max))
+        if substeps > self.max_substeps:
+            raise ValueError(f"The CFL condition needs {substeps} explicit steps per time "
+                             f"unit (max_substeps={self.max_substeps}), "
+                             "use solver='implicit' instead.")
+        return max(substeps, 1)
+
+    def diffusion_step_implicit_field(self, name, field):
+        """
+        Advance one field by a time unit with adaptive LOD backward Euler steps.
+        Each step of size h is compared with two steps of size h/2; the step is
+        accepted when they agree within implicit_tolerance, and h is adapted from
+        the error estimate (first order method, so the error scales with h^2).
+        Raises ValueError when h has to go below implicit_min_step.
+        """
+        u = field.reshape(self.shape)
+        faces = self.faces[name]
+        t = 0.0
+        h = self.implicit_h[name]
+        accepted = 0
+        rejected = 0
+        while t < 1.0:
+            h = min(h, 1.0 - t)
+            full = u.copy()
+            implicit_step_3d(full, faces, h, self.dx)
+            half = u.copy()
+            implicit_step_3d(half, faces, h / 2, self.dx)
+            implicit_step_3d(half, faces, h / 2, self.dx)
+            scale = self.implicit_tolerance * max(np.abs(half).max(), 1e-12)
+            error = np.abs(full - half).max() / scale
+            if error <= 1.0:
+                u[:] = half
+                t += h
+                accepted += 1
+                if 1.0 - t < 1e-12:
+                    break
+                self.implicit_h[name] = h
+                h *= min(4.0, 0.9 / np.sqrt(max(error, 1e-16)))
+            else:
+                rejected += 1
+                h *= max(0.2, 0.9 / np.sqrt(error))
+                if h < self.implicit_min_step:
+                    raise ValueError(f"The implicit {name} step fell below "
+                                     f"implicit_min_step={self.implicit_min_step} at "
+                                     f"t={t:.6g}, raise implicit_tolerance.")
+        self.effective_substeps[name] = accepted
+        self.rejected_substeps[name] = rejected
+        self.implicit_solves[name] = 3 * (accepted + rejected)
+
     def diffusion_step(self):
-        for _ in range(self.resource_steps_per_time_unit):
-            self.diffusion_step_food()
-            self.diffusion_step_antibiotics()
+        profiler = self.profiler
+        if self.solver == "implicit":
+            with profiler.phase("diffusion/food"):
+                self.diffusion_step_implicit_field('food', self.food)
+            with profiler.phase("diffusion/antibiotics"):
+                self.diffusion_step_implicit_field('antibiotics', self.antibiotics)
+            return
+        if self.solver == "cfl":
+            self.substeps = self.cfl_substeps()
+            self.dt = 1 / self.substeps
+        self.effective_substeps = {'food': self.substeps, 'antibiotics': self.substeps}
+        if self.diffusion_backend == "stencil":
+            with profiler.phase("diffusion/stencil"):
+                self.diffusion_step_stencil()
+            return
+        for _ in range(self.substeps):
+            with profiler.phase("diffusion/food"):
+                self.diffusion_step_food()
+            with profiler.phase("diffusion/antibiotics"):
+                self.diffusion_step_antibiotics()
 
 
         # Perform diffusion for a specified number of steps efficiently ignoring food
     # def diffusion_step(self):
-    #     self.antibiotics = diffusion_steps_antibiotics_FAST_optimized(self.antibiotics, self.antibiotics_buffer, self.neighbors, 
+    #     self.antibiotics = diffusion_steps_antibiotics_FAST_optimized(self.antibiotics, self.antibiotics_buffer, self.neighbor_offsets, self.neighbor_indices, 
     #                                                          self.D_antibiotics_arr, self.dt, 
     #                                                          self.dx, self.resource_steps_per_time_unit)
         
 
     def update_D(self, states):
-        for i, s in enumerate(states):
-            if s == 0:
-                self.D_food_arr[i] = self.D_food
-                self.D_antibiotics_arr[i] = self.D_antibiotics
-            else:
-                self.D_food_arr[i] = self.D_food * self.D_food_multiplyer
-                self.D_antibiotics_arr[i] = self.D_antibiotics * self.D_antibiotics_multiplyer
\ No newline at end of file
+        """
+        Set the diffusion coefficients of every grid position from its state:
+        D in empty positions, D * multiplyer in positions with (dead) cells.
+        """
+        empty = np.asarray(states) == 0
+        self.D_food_arr[:] = np.where(empty, self.D_food, self.D_food * self.D_food_multiplyer)
+        self.D_antibiotics_arr[:] = np.where(empty, self.D_antibiotics,
+                                             self.D_antibiotics * self.D_antibiotics_multiplyer)
+        self.rebuild_faces()
+
+    def update_D_changed(self, indices, states):
+        """
+        Like update_D, but only for the grid positions in indices, whose new states
+        are given in states. The face sums around them are updated as well.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) == 0:
+            return
+        empty = np.asarray(states) == 0
+        self.D_food_arr[indices] = np.where(empty, self.D_food,
+                                            self.D_food * self.D_food_multiplyer)
+        self.D_antibiotics_arr[indices] = np.where(
+            empty, self.D_antibiotics, self.D_antibiotics * self.D_antibiotics_multiplyer)
+        update_faces_numba(self.D_food_arr.reshape(self.shape), *self.faces['food'], indices)
+        update_faces_numba(self.D_antibiotics_arr.reshape(self.shape),
+                           *self.faces['antibiotics'], indices)
\ No newline at end of file
@@ -0,0 +1,307 @@
+"""
+Many replicas of one parameter set advanced together.
+
+The replicas share the grid shape, the neighbor table and the dosing, so instead of
+one simulate per trial, Ensemble stacks R replicas along a first axis of the cell,
+food, antibiotics and diffusion arrays, shape (R, num_cells). Every phase of a time
+unit is one kernel call for all replicas (the replicas are split over the threads),
+and every replica draws from its own xoroshiro128+ stream, so its results do not
+depend on the other replicas or on the number of threads.
+
+    ensemble = Ensemble(50, 50, initial_grids, seed=1, steps_per_time_unit=2)
+    while ensemble.advance():
+        pass
+    save_aggregated_trial_data(ensemble.trial_results(), "aggregated_trial_data.csv")
+
+The replicas follow the rules of simulate(engine="arrays", diffusion_backend="stencil")
+with the explicit solver, and each has its own Bookkeeper. A replica stops (no more
+cell updates, antibiotics decay, dosing, diffusion or step summaries) once it has
+no alive cells, like a simulate run whose advance() returned False.
+"""
+from types import SimpleNamespace
+import numpy as np
+from numba import njit, prange
+from Cell_3d import Cell
+from Cell_Arrays_3d import cell_sweep_numba, exponential_numba, rng_streams
+from BookKeepers_3d import Bookkeeper
+from Dosing_3d import DosingSchedule, strategy_indices, strategy_amount, add_dose
+from Efficient_Resource_Manager_3d import (neighbor_table, face_sums, update_faces_numba,
+                                           stencil_layer_numba)
+
+
+@njit(parallel=True, cache=True)
+def ensemble_init_timers_numba(state, lambd, death_date, alive_time, reproduction_timer,
+                               lambd_good, lambd_bad, rng):
+    # The initial timers of CellArrays for every replica, from its own stream.
+    replicas, n = state.shape
+    for i in prange(replicas):
+        for j in range(n):
+            if state[i, j] == 1 or state[i, j] == -1:
+                lambd[i, j] = lambd_good if state[i, j] == 1 else lambd_bad
+                death_date[i, j] = exponential_numba(rng[i], 3 / lambd[i, j])
+                alive_time[i, j] = death_date[i, j]
+        for j in range(n):
+            if state[i, j] == 1 or state[i, j] == -1:
+                reproduction_timer[i, j] = exponential_numba(rng[i], 1 / lambd[i, j])
+
+
+@njit(parallel=True, cache=True)
+def ensemble_sweep_numba(live, n_live, state, death_date, reproduction_timer, lambd,
+                         alive_time, reproduction_count, good_dead_due_to_antibiotics,
+                         bad_dead_due_to_antibiotics, neighbor_offsets, neighbor_indices, food,
+                         antibiotics, antibiotics_decay, dt, lambd_good, lambd_bad, p_mutation,
+                         antibiotics_resistance, antibiotics_consumption, eat_amount, ev_index,
+                         ev_type, ev_cause, ev_reproduction, ev_alive, ev_changed, birth_index,
+                         birth_type, heap_key, heap_index, n_events, n_births, rng, active):
+    """
+    One sub-step of every active replica: the antibiotics decay and cell_sweep_numba
+    on its row of the arrays, with its own random stream. The numbers of deaths and
+    births of every replica are written to n_events and n_births.
+    """
+    replicas, n = state.shape
+    for i in prange(replicas):
+        if not active[i]:
+            n_events[i] = 0
+            n_births[i] = 0
+            continue
+        for j in range(n):
+            antibiotics[i, j] -= antibiotics_decay
+            if antibiotics[i, j] < 0:
+                antibiotics[i, j] = 0.0
+        n_events[i], n_births[i], n_live[i] = cell_sweep_numba(
+            live[i], n_live[i], state[i], death_date[i], reproduction_timer[i], lambd[i],
+            alive_time[i], reproduction_count[i], good_dead_due_to_antibiotics[i],
+            bad_dead_due_to_antibiotics[i], neighbor_offsets, neighbor_indices, food[i],
+            antibiotics[i], dt, lambd_good, lambd_bad, p_mutation, antibiotics_resistance,
+            antibiotics_consumption, eat_amount, ev_index[i], ev_type[i], ev_cause[i],
+            ev_reproduction[i], ev_alive[i], ev_changed[i], birth_index[i], birth_type[i],
+            heap_key[i], heap_index[i], 0, n, rng[i])
+
+
+@njit(parallel=True, cache=True)
+def ensemble_diffusion_numba(food, antibiotics, food_buffer, antibiotics_buffer,
+                             food_faces_z, food_faces_r, food_faces_c, antibiotics_faces_z,
+                             antibiotics_faces_r, antibiotics_faces_c, dt, dx, steps,
+                             active):
+    """
+    diffusion_steps_stencil_numba for (replicas, height, size, size) fields and face
+    sums of the active replicas; the layers of all replicas are split over the threads.
+    """
+    replicas, height = food.shape[0], food.shape[1]
+    coeff_prime = food.dtype.type(0.5 * dt / (dx**2))
+
+    src_f, dst_f = food, food_buffer
+    src_a, dst_a = antibiotics, antibiotics_buffer
+    for _ in range(steps):
+        for k in prange(replicas * height):
+            i = k // height
+            if not active[i]:
+                continue
+            stencil_layer_numba(src_f[i], src_a[i], dst_f[i], dst_a[i], food_faces_z[i],
+                                food_faces_r[i], food_faces_c[i], antibiotics_faces_z[i],
+                                antibiotics_faces_r[i], antibiotics_faces_c[i], coeff_prime,
+                                k % height)
+        src_f, dst_f = dst_f, src_f
+        src_a, dst_a = dst_a, src_a
+
+    if steps % 2 == 1:
+        for i in range(replicas):
+            if active[i]:
+                food[i] = food_buffer[i]
+                antibiotics[i] = antibiotics_buffer[i]
+
+
+class Ensemble:
+    """
+    R replicas of a simulation with the parameters of simulate (see the module
+    docstring). init_states is one grid for every replica, shape (num_cells,) with
+    `replicas` given, or one grid per replica, shape (R, num_cells). The replica
+    streams are derived from seed (see Cell_Arrays_3d.rng_streams).
+    """
+
+    def __init__(self, grid_size, grid_height, init_states, replicas=None, seed=None,
+                 steps_per_time_unit=1, antibiotics_interval=100, antibiotics_steps=[10],
+                 dump_strat="quarters", dump_size=10, concentration=1,
+                 antibiotics_concentrations=[1], food_interval=100, food_dump_strat="quarters",
+                 food_dump_size=10, amount=1, resource_steps_per_time_unit=4, dx=0.000002,
+                 D_antibiotics=1, D_food=1, D_antibiotics_multiplyer=2, D_food_multiplyer=2,
+                 dosing_schedule=None, timeframe=None):
+        states = np.asarray(init_states, dtype=np.int64)
+        if states.ndim == 1:
+            if replicas is None:
+                raise ValueError("replicas is needed for a single initial grid")
+            states = np.repeat(states[None, :], replicas, axis=0)
+        self.replicas = R = states.shape[0]
+        self.num_cells = n = grid_size * grid_size * grid_height
+        if states.shape[1] != n:
+            raise ValueError(f"init_states needs {n} grid positions per replica")
+        self.grid_size = grid_size
+        self.grid_height = grid_height
+        self.shape = (grid_height, grid_size, grid_size)
+        self.steps = 0
+        self.steps_per_time_unit = steps_per_time_unit
+        self.resource_steps_per_time_unit = resource_steps_per_time_unit
+        self.dx = dx
+        self.timeframe = None if timeframe is None else tuple(timeframe)
+        self.neighbor_offsets, self.neighbor_indices = neighbor_table(grid_size, grid_height)
+        self.rng = rng_streams(seed, R)
+
+        # --- Cells, one row per replica, as in CellArrays --- #
+        self.state = states.copy()
+        self.lambd = np.zeros((R, n), dtype=np.float64)
+        self.death_date = np.full((R, n), np.nan, dtype=np.float64)
+        self.alive_time = np.full((R, n), np.nan, dtype=np.float64)
+        self.reproduction_timer = np.full((R, n), np.nan, dtype=np.float64)
+        self.reproduction_count = np.zeros((R, n), dtype=np.int64)
+        self.good_dead_due_to_antibiotics = np.zeros((R, n), dtype=np.bool_)
+        self.bad_dead_due_to_antibiotics = np.zeros((R, n), dtype=np.bool_)
+        ensemble_init_timers_numba(self.state, self.lambd, self.death_date, self.alive_time,
+                                   self.reproduction_timer, Cell.lambd_map[Cell.good],
+                                   Cell.lambd_map[Cell.bad], self.rng)
+        self.live = np.zeros((R, n), dtype=np.int64)
+        self.n_live = np.zeros(R, dtype=np.int64)
+        for i in range(R):
+            alive = np.flatnonzero((self.state[i] == Cell.good) | (self.state[i] == Cell.bad))
+            self.n_live[i] = len(alive)
+            self.live[i, :len(alive)] = alive
+        self.heap_key = np.zeros((R, n), dtype=np.float64)
+        self.heap_index = np.zeros((R, n), dtype=np.int64)
+        self.ev_index = np.zeros((R, 2 * n), dtype=np.int64)
+        self.ev_type = np.zeros((R, 2 * n), dtype=np.int64)
+        self.ev_cause = np.zeros((R, 2 * n), dtype=np.int64)
+        self.ev_reproduction = np.zeros((R, 2 * n), dtype=np.int64)
+        self.ev_alive = np.zeros((R, 2 * n), dtype=np.float64)
+        self.ev_changed = np.zeros((R, 2 * n), dtype=np.bool_)
+        self.birth_index = np.zeros((R, n), dtype=np.int64)
+        self.birth_type = np.zeros((R, n), dtype=np.int64)
+        self.n_events = np.zeros(R, dtype=np.int64)
+        self.n_births = np.zeros(R, dtype=np.int64)
+
+        # --- Bookkeepers --- #
+        self.bookkeepers = [Bookkeeper() for _ in range(R)]
+        for i, bookkeeper in enumerate(self.bookkeepers):
+            bookkeeper.initialize_counts(self.state[i])
+        self.births_applied = [0] * R
+        self.active = np.ones(R, dtype=bool)  # replicas with alive cells left
+        self.finished_steps = np.full(R, np.nan)
+
+        # --- Resources, as in the ResourceManager with the stencil backend --- #
+        self.D = {'food': (D_food, D_food_multiplyer),
+                  'antibiotics': (D_antibiotics, D_antibiotics_multiplyer)}
+        self.food = np.zeros((R, n), dtype=np.float64)
+        self.antibiotics = np.zeros((R, n), dtype=np.float64)
+        self.food_buffer = np.empty_like(self.food)
+        self.antibiotics_buffer = np.empty_like(self.antibiotics)
+        self.D_arr = {}
+        self.faces = {}
+        for name, (D, multiplyer) in self.D.items():
+            self.D_arr[name] = np.where(self.state == 0, D, D * multiplyer)
+            # face_sums of every replica, stacked
+            self.faces[name] = tuple(np.stack(faces) for faces in zip(
+                *(face_sums(D_i.reshape(self.shape)) for D_i in self.D_arr[name])))
+        # The fields of every replica, as simulate's resources for dosing and summaries
+        self.resources = [SimpleNamespace(food=self.food[i], antibiotics=self.antibiotics[i])
+                          for i in range(R)]
+
+        # --- Dosing, as in simulate --- #
+        indices, unique = strategy_indices(food_dump_strat, grid_size, grid_height,
+                                           food_dump_size)
+        for resources in self.resources:
+            add_dose(resources.food, indices,
+                     strategy_amount(food_dump_strat, amount, grid_size, food_dump_size), unique)
+        self.dosing = dosing_schedule or DosingSchedule.from_parameters(
+            grid_size, grid_height, antibiotics_steps, antibiotics_concentrations, dump_strat,
+            dump_size, concentration, antibiotics_interval, food_interval, food_dump_strat,
+            food_dump_size, amount)
+
+    def step(self):
+        """
+        The cell sub-steps of one time unit for all replicas.
+        """
+        dt = 1 / self.steps_per_time_unit
+        for _ in range(self.steps_per_time_unit):
+            ensemble_sweep_numba(
+                self.live, self.n_live, self.state, self.death_date, self.reproduction_timer,
+                self.lambd, self.alive_time, self.reproduction_count,
+                self.good_dead_due_to_antibiotics, self.bad_dead_due_to_antibiotics,
+                self.neighbor_offsets, self.neighbor_indices, self.food, self.antibiotics,
+                Cell.antibiotics_decay * dt, dt, Cell.lambd_map[Cell.good],
+                Cell.lambd_map[Cell.bad], Cell.p_mutation, Cell.antibiotics_resistance,
+                Cell.antibiotics_consumption, Cell.eat_amount, self.ev_index, self.ev_type,
+                self.ev_cause, self.ev_reproduction, self.ev_alive, self.ev_changed,
+                self.birth_index, self.birth_type, self.heap_key, self.heap_index,
+                self.n_events, self.n_births, self.rng, self.active)
+            for i in np.flatnonzero(self.active):
+                bookkeeper = self.bookkeepers[i]
+                bookkeeper.current_step = self.steps
+                n_births, n_events = self.n_births[i], self.n_events[i]
+                bookkeeper.record_births(self.birth_index[i, :n_births],
+                                         self.birth_type[i, :n_births])
+                bookkeeper.record_deaths(self.ev_index[i, :n_events], self.ev_type[i, :n_events],
+                                         self.ev_cause[i, :n_events],
+                                         self.ev_reproduction[i, :n_events],
+                                         self.ev_alive[i, :n_events],
+                                         self.ev_changed[i, :n_events])
+            self.steps += dt
+
+    def update_D(self):
+        # Like ResourceManager.update_D_changed with the births since the last call.
+        for i in np.flatnonzero(self.active):
+            births = self.bookkeepers[i].births
+            indices = births['cell_index'][self.births_applied[i]:]
+            self.births_applied[i] = len(births)
+            if len(indices) == 0:
+                continue
+            for name, (D, multiplyer) in self.D.items():
+                self.D_arr[name][i, indices] = D * multiplyer  # births never leave a position empty
+                update_faces_numba(self.D_arr[name][i].reshape(self.shape),
+                                   *(faces[i] for faces in self.faces[name]), indices)
+
+    def advance(self):
+        """
+        Run one time unit of every replica that still has alive cells: the cell
+        sub-steps, the dosing, the update of D, the diffusion and the step summary.
+        Returns False once no replica has alive cells left.
+        """
+        self.step()
+        for i in np.flatnonzero(self.active):
+            self.dosing.apply(int(self.steps), self.resources[i])
+        self.update_D()
+        shape = (self.replicas,) + self.shape
+        ensemble_diffusion_numba(self.food.reshape(shape), self.antibiotics.reshape(shape),
+                                 self.food_buffer.reshape(shape),
+                                 self.antibiotics_buffer.reshape(shape),
+                                 *self.faces['food'], *self.faces['antibiotics'],
+                                 1 / self.resource_steps_per_time_unit, self.dx,
+                                 self.resource_steps_per_time_unit, self.active)
+        for i in np.flatnonzero(self.active):
+            bookkeeper = self.bookkeepers[i]
+            bookkeeper.record_step_summary(step=int(self.steps), resource_manager=self.resources[i])
+            if bookkeeper.counts['alive_good'] + bookkeeper.counts['alive_bad'] == 0:
+                self.active[i] = False
+                self.finished_steps[i] = self.steps
+        return bool(self.active.any())
+
+    # --- Results per replica --- #
+    def replica(self, i):
+        """
+        Replica i with the attributes of a finished simulate that trial_result and the
+        CSV functions of Trial_Runner_3d use: bookkeeper, steps and timeframe.
+        """
+        steps = self.steps if np.isnan(self.finished_steps[i]) else self.finished_steps[i]
+        return SimpleNamespace(bookkeeper=self.bookkeepers[i], steps=steps,
+                               timeframe=self.timeframe, grid_size=self.grid_size,
+                               grid_height=self.grid_height, state=self.state[i],
+                               resources=self.resources[i])
+
+    def trial_results(self, first_trial=1, seeds=None):
+        """
+        The trial_result of every replica, as trials first_trial, first_trial + 1, ...
+        for save_aggregated_trial_data and save_timeframe_aggregated_data.
+        """
+        from Trial_Runner_3d import trial_result
+        if self.timeframe is None:
+            raise ValueError("Build the ensemble with a timeframe first")
+        return [trial_result(self.replica(i), first_trial + i,
+                             None if seeds is None else seeds[i])
+                for i in range(self.replicas)]
@@ -0,0 +1,233 @@
+import bisect
+import json
+import os
+import zlib
+import numpy as np
+
+FIELDS = ('states', 'antibiotics', 'food')
+
+
+class FieldHistory:
+    """
+    Read-only sequence of the snapshots of one field in a HistoryStore.
+    Indexing returns a 1D numpy array for that snapshot, loaded only when asked for,
+    so it can be used where the lists of snapshots were used before.
+    """
+
+    def __init__(self, store, field):
+        self.store = store
+        self.field = field
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"snapshot {i} out of range")
+        return self.store.read(self.field, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def grid(self, i):
+        # Snapshot i as a (height, size, size) array.
+        return self[i].reshape(self.store.shape)
+
+    def layer(self, i, z):
+        # Layer z of snapshot i as a (size, size) array.
+        return self.store.read_layer(self.field, i, z)
+
+    def at_step(self, step):
+        # The snapshot saved at simulation step `step`.
+        return self[self.store.steps.index(step)]
+
+
+class HistoryStore:
+    """
+    On-disk history of the grid states and the resource fields.
+
+    Snapshots are written as they are produced to one file per field in the
+    directory `path`: states as int8 and the fields as `field_dtype`. Without
+    compression the files are plain arrays that are read back with np.memmap.
+    With compression, `chunk_size` snapshots are collected, compressed with zlib and
+    appended as one chunk; only one chunk per field is kept in memory.
+    The layout is described in meta.json, which is rewritten on every flush, so a
+    store of an interrupted run can be read up to its last flush.
+    """
+
+    def __init__(self, path, mode="r", shape=None, field_dtype=np.float32, compress=False,
+                 chunk_size=16, compression_level=1):
+        self.path = path
+        self.mode = mode
+        self.meta_path = os.path.join(path, "meta.json")
+        if mode == "w":
+            os.makedirs(path, exist_ok=True)
+            self.shape = tuple(shape)
+            self.dtypes = {'states': np.dtype(np.int8).str,
+                           'antibiotics': np.dtype(field_dtype).str,
+                           'food': np.dtype(field_dtype).str}
+            self.compress = compress
+            self.chunk_size = chunk_size
+            self.compression_level = compression_level
+            self.steps = []
+            # [offset, length, first snapshot, number of snapshots] per chunk
+            self.chunks = {field: [] for field in FIELDS}
+            for field in FIELDS:
+                open(self.file_path(field), "wb").close()
+            self.write_meta()
+        elif mode in ("r", "a"):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            self.shape = tuple(meta['shape'])
+            self.dtypes = meta['dtypes']
+            self.compress = meta['compress']
+            self.chunk_size = meta['chunk_size']
+            self.compression_level = meta['compression_level']
+            self.steps = meta['steps']
+            self.chunks = meta['chunks']
+        else:
+            raise ValueError(f"Unknown mode: {mode}")
+        self.num_cells = int(np.prod(self.shape))
+        self.pending = {field: [] for field in FIELDS}  # not yet compressed snapshots
+        self.cache = {}  # field -> (chunk number, decompressed chunk)
+        self.memmaps = {}
+        self.states = FieldHistory(self, 'states')
+        self.antibiotics = FieldHistory(self, 'antibiotics')
+        self.food = FieldHistory(self, 'food')
+
+    def file_path(self, field):
+        return os.path.join(self.path, f"{field}.bin")
+
+    def write_meta(self):
+        meta = {'shape': list(self.shape), 'dtypes': self.dtypes, 'compress': self.compress,
+                'chunk_size': self.chunk_size, 'compression_level': self.compression_level,
+                'steps': self.steps, 'chunks': self.chunks}
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def __len__(self):
+        return len(self.steps)
+
+    @property
+    def nbytes(self):
+        # Bytes of the snapshots held in memory: not yet compressed or cached chunks
+        pending = sum(data.nbytes for field in FIELDS for data in self.pending[field])
+        return pending + sum(data.nbytes for _, data in self.cache.values())
+
+    # --- Writing --- #
+    def append(self, step, states, antibiotics, food):
+        """
+        Add one snapshot. The arrays are converted to the dtypes of the store.
+        """
+        if self.mode == "r":
+            raise ValueError("store is opened read-only")
+        snapshot = {'states': states, 'antibiotics': antibiotics, 'food': food}
+        for field in FIELDS:
+            # Copy, the simulation keeps changing its arrays in place
+            data = np.array(snapshot[field], dtype=self.dtypes[field]).ravel()
+            if data.size != self.num_cells:
+                raise ValueError(f"{field} has {data.size} values, expected {self.num_cells}")
+            if self.compress:
+                self.pending[field].append(data)
+            else:
+                with open(self.file_path(field), "ab") as f:
+                    f.write(data.tobytes())
+                self.memmaps.pop(field, None)  # the file grew, map it again on next read
+        self.steps.append(int(step))
+        if not self.compress or len(self.pending['states']) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.compress and self.pending['states']:
+            first = len(self.steps) - len(self.pending['states'])
+            for field in FIELDS:
+                raw = np.concatenate(self.pending[field]).tobytes()
+                packed = zlib.compress(raw, self.compression_level)
+                with open(self.file_path(field), "ab") as f:
+                    offset = f.tell()
+                    f.write(packed)
+                self.chunks[field].append([offset, len(packed), first,
+                                           len(self.pending[field])])
+                self.pending[field] = []
+        self.write_meta()
+
+    def truncate(self, n):
+        """
+        Keep only the first n snapshots, e.g. to drop the ones written after the
+        checkpoint a run is restarted from.
+        """
+        if self.mode == "r":
+            raise ValueError("store is opened read-only")
+        self.flush()
+        if n >= len(self):
+            return
+        for field in FIELDS:
+            if self.compress:
+                kept = [chunk for chunk in self.chunks[field] if chunk[2] + chunk[3] <= n]
+                cut = self.chunks[field][len(kept)] if len(kept) < len(self.chunks[field]) else None
+                if cut is not None and cut[2] < n:
+                    # The chunk with snapshot n goes back to the pending snapshots.
+                    rows = self.chunk(field, len(kept))
+                    self.pending[field] = [np.array(row) for row in rows[:n - cut[2]]]
+                size = kept[-1][0] + kept[-1][1] if kept else 0
+                self.chunks[field] = kept
+            else:
+                size = n * self.num_cells * np.dtype(self.dtypes[field]).itemsize
+            with open(self.file_path(field), "r+b") as f:
+                f.truncate(size)
+        self.steps = self.steps[:n]
+        self.memmaps.clear()
+        self.cache.clear()
+        self.write_meta()
+
+    def close(self):
+        if self.mode != "r":
+            self.flush()
+        self.memmaps.clear()
+        self.cache.clear()
+
+    # --- Reading --- #
+    def memmap(self, field):
+        if field not in self.memmaps:
+            self.memmaps[field] = np.memmap(self.file_path(field), dtype=self.dtypes[field],
+                                            mode="r", shape=(len(self), self.num_cells))
+        return self.memmaps[field]
+
+    def chunk(self, field, c):
+        if field in self.cache and self.cache[field][0] == c:
+            return self.cache[field][1]
+        offset, length, _, _ = self.chunks[field][c]
+        with open(self.file_path(field), "rb") as f:
+            f.seek(offset)
+            raw = zlib.decompress(f.read(length))
+        data = np.frombuffer(raw, dtype=self.dtypes[field]).reshape(-1, self.num_cells)
+        self.cache[field] = (c, data)
+        return data
+
+    def snapshot_rows(self, field, i):
+        # The 2D block of snapshots holding snapshot i, and the row of i in that block.
+        if not self.compress:
+            return self.memmap(field), i
+        n_stored = len(self.steps) - len(self.pending[field])
+        if i >= n_stored:
+            return self.pending[field], i - n_stored
+        # Chunks can be shorter than chunk_size after a flush, so look up the chunk.
+        firsts = [chunk[2] for chunk in self.chunks[field]]
+        c = bisect.bisect_right(firsts, i) - 1
+        return self.chunk(field, c), i - firsts[c]
+
+    def read(self, field, i):
+        rows, row = self.snapshot_rows(field, i)
+        return np.array(rows[row])
+
+    def read_layer(self, field, i, z):
+        rows, row = self.snapshot_rows(field, i)
+        layer_size = self.shape[1] * self.shape[2]
+        return np.array(rows[row][z * layer_size:(z + 1) * layer_size]).reshape(self.shape[1:])
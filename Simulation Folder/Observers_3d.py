@@ -0,0 +1,281 @@
+"""
+Observers that reduce the grid while a simulation runs.
+
+Instead of keeping full 3D snapshots in the history and reducing them afterwards,
+give simulate a list of observers. Each one is called at the steps where the
+history would take a snapshot (the start of the run and every `every` time units,
+after the cell sub-steps) and keeps only its reduction:
+
+    projection = ZProjection(every=10)
+    layers = LayerTotals(every=1)
+    sim = simulate(..., grid_history_interval=None, observers=[projection, layers])
+    while sim.advance():
+        pass
+    projection.stacked("alive_good")   # (records, size, size) counts over the layers
+    layers.stacked("food")             # (records, height) food per layer
+
+Memory is bounded by max_records: when an observer is full it drops every other
+record and doubles its cadence, so the records still cover the whole run. Records
+taken with force (e.g. the last step of a run) are never dropped.
+"""
+from functools import lru_cache
+import numpy as np
+from numba import njit
+
+STATES = {'alive_good': 1, 'alive_bad': -1, 'dead_good': 2, 'dead_bad': -2}
+FIELDS = ('food', 'antibiotics')
+
+
+def quantity(sim, name):
+    """
+    A per-position quantity of sim: a field ("food", "antibiotics") or the
+    indicator of a state ("alive_good", "alive_bad", "dead_good", "dead_bad").
+    """
+    if name in FIELDS:
+        return getattr(sim.resources, name)
+    if name in STATES:
+        return sim.get_states() == STATES[name]
+    raise ValueError(f"Unknown quantity: {name}")
+
+
+@njit(cache=True)
+def project_states_numba(state, values, out):
+    # out[k, r, c] = number of layers z with state[z, r, c] == values[k]
+    height, size, _ = state.shape
+    out[:] = 0
+    for z in range(height):
+        for r in range(size):
+            for c in range(size):
+                s = state[z, r, c]
+                for k in range(values.shape[0]):
+                    if s == values[k]:
+                        out[k, r, c] += 1
+                        break
+
+
+@njit(cache=True)
+def label_colonies_numba(member, neighbor_offsets, neighbor_indices, labels, stack):
+    """
+    Label the connected groups of member positions (6-neighborhood) with 0, 1, ...
+    and -1 elsewhere. Returns the number of groups and the size of every group.
+    """
+    n = member.shape[0]
+    sizes = np.zeros(n, dtype=np.int64)
+    labels[:] = -1
+    n_colonies = 0
+    for start in range(n):
+        if not member[start] or labels[start] >= 0:
+            continue
+        labels[start] = n_colonies
+        top = 0
+        stack[top] = start
+        top += 1
+        size = 0
+        while top > 0:
+            top -= 1
+            j = stack[top]
+            size += 1
+            for k in neighbor_indices[neighbor_offsets[j]:neighbor_offsets[j + 1]]:
+                if member[k] and labels[k] < 0:
+                    labels[k] = n_colonies
+                    stack[top] = k
+                    top += 1
+        sizes[n_colonies] = size
+        n_colonies += 1
+    return n_colonies, sizes[:n_colonies]
+
+
+@lru_cache(maxsize=None)
+def radial_bins(size):
+    # Distance in the plane of every position to the vertical axis through the
+    # middle of the grid, rounded to whole positions. Read-only, cached per size.
+    centre = (size - 1) / 2
+    r, c = np.meshgrid(np.arange(size), np.arange(size), indexing='ij')
+    bins = np.rint(np.hypot(r - centre, c - centre)).astype(np.int64).ravel()
+    bins.flags.writeable = False
+    return bins
+
+
+class Observer:
+    """
+    Base class of the observers: calls compute(sim) every `every` time units and
+    keeps the (step, value) records, at most max_records of them (None: no limit).
+    """
+
+    def __init__(self, every=1, max_records=None):
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        if max_records is not None and max_records < 2:
+            raise ValueError("max_records must be at least 2")
+        self.every = every
+        self.max_records = max_records
+        self.records = []
+        self.forced = set()  # steps recorded with force, kept when thinning out
+
+    def compute(self, sim):
+        raise NotImplementedError
+
+    def observe(self, step, sim, force=False):
+        """
+        Record the reduction of sim if `step` is on the cadence of the observer, or
+        in any case with force (e.g. for the last step of a run). A step is
+        recorded once.
+        """
+        if not force and step % self.every != 0:
+            return
+        if self.records and self.records[-1][0] == step:
+            return
+        if self.max_records is not None and len(self.records) >= self.max_records:
+            # Thin out: keep the records that stay on the doubled cadence and the
+            # forced ones
+            self.every *= 2
+            self.records = [record for record in self.records
+                            if record[0] % self.every == 0 or record[0] in self.forced]
+            if not force and step % self.every != 0:
+                return
+        if force:
+            self.forced.add(step)
+        self.records.append((step, self.compute(sim)))
+
+    @property
+    def steps(self):
+        return np.array([step for step, _ in self.records], dtype=np.int64)
+
+    def stacked(self, key=None):
+        """
+        The recorded values stacked along a first axis, one row per record. For
+        observers that record a dict, key selects the entry.
+        """
+        values = [value if key is None else value[key] for _, value in self.records]
+        return np.stack(values) if values else np.zeros(0)
+
+    @property
+    def nbytes(self):
+        total = 0
+        for _, value in self.records:
+            items = value.values() if isinstance(value, dict) else [value]
+            total += sum(np.asarray(item).nbytes for item in items)
+        return total
+
+
+class ZProjection(Observer):
+    """
+    The number of cells of every state summed over the layers, as (size, size)
+    counts per state, and the mean of the fields over the layers. These are the
+    images of visualize_history_separate.
+    """
+
+    def __init__(self, every=1, max_records=None, states=tuple(STATES),
+                 fields=FIELDS):
+        super().__init__(every, max_records)
+        self.states = tuple(states)
+        self.fields = tuple(fields)
+        self.values = np.array([STATES[name] for name in self.states], dtype=np.int64)
+
+    def compute(self, sim):
+        shape = (sim.grid_height, sim.grid_size, sim.grid_size)
+        states = np.asarray(sim.get_states()).reshape(shape)
+        counts = np.empty((len(self.states), sim.grid_size, sim.grid_size), dtype=np.int32)
+        project_states_numba(states, self.values.astype(states.dtype), counts)
+        value = dict(zip(self.states, counts))
+        for name in self.fields:
+            value[name] = quantity(sim, name).reshape(shape).mean(axis=0)
+        return value
+
+
+class LayerTotals(Observer):
+    """
+    The total of every field per layer, as arrays of length grid_height.
+    """
+
+    def __init__(self, every=1, max_records=None, fields=FIELDS):
+        super().__init__(every, max_records)
+        self.fields = tuple(fields)
+
+    def compute(self, sim):
+        shape = (sim.grid_height, sim.grid_size * sim.grid_size)
+        return {name: quantity(sim, name).reshape(shape).sum(axis=1) for name in self.fields}
+
+
+class DepthProfile(Observer):
+    """
+    The mean of a quantity (see quantity) per layer: the concentration of a field
+    or the fraction of positions in a state, from the bottom to the top layer.
+    """
+
+    def __init__(self, name, every=1, max_records=None):
+        super().__init__(every, max_records)
+        self.name = name
+
+    def compute(self, sim):
+        shape = (sim.grid_height, sim.grid_size * sim.grid_size)
+        return quantity(sim, self.name).reshape(shape).mean(axis=1)
+
+
+class RadialProfile(Observer):
+    """
+    The mean of a quantity over all layers by distance to the vertical axis
+    through the middle of the grid, in whole positions (index 0 is the axis).
+    """
+
+    def __init__(self, name, every=1, max_records=None):
+        super().__init__(every, max_records)
+        self.name = name
+
+    def compute(self, sim):
+        bins = radial_bins(sim.grid_size)
+        plane = quantity(sim, self.name).reshape(sim.grid_height, -1).sum(axis=0)
+        totals = np.bincount(bins, weights=plane)
+        positions = np.bincount(bins) * sim.grid_height
+        return totals / positions
+
+
+class ColonyCounts(Observer):
+    """
+    The colonies: groups of cells in the given states that touch through a face.
+    Records the number of colonies, the size of the largest and their mean size.
+    """
+
+    def __init__(self, every=1, max_records=None, states=('alive_good', 'alive_bad')):
+        super().__init__(every, max_records)
+        self.values = np.array([STATES[name] for name in states])
+        self.labels = None
+        self.stack = None
+
+    def compute(self, sim):
+        member = np.isin(sim.get_states(), self.values)
+        if self.labels is None or len(self.labels) != len(member):
+            self.labels = np.empty(len(member), dtype=np.int64)
+            self.stack = np.empty(len(member), dtype=np.int64)
+        n_colonies, sizes = label_colonies_numba(member, sim.resources.neighbor_offsets,
+                                                 sim.resources.neighbor_indices, self.labels,
+                                                 self.stack)
+        return np.array([n_colonies, sizes.max(initial=0),
+                         sizes.mean() if n_colonies else 0.0])
+
+    def stacked(self, key=None):
+        # One column per entry when key is "count", "largest" or "mean_size"
+        values = super().stacked()
+        if key is None or len(values) == 0:
+            return values
+        return values[:, ("count", "largest", "mean_size").index(key)]
+
+
+class FieldStats(Observer):
+    """
+    Minimum, maximum, mean and percentiles of a field over the grid.
+    """
+
+    def __init__(self, name, every=1, max_records=None, percentiles=(5, 50, 95)):
+        super().__init__(every, max_records)
+        if name not in FIELDS:
+            raise ValueError(f"Unknown field: {name}")
+        self.name = name
+        self.percentiles = tuple(percentiles)
+
+    def compute(self, sim):
+        field = quantity(sim, self.name)
+        value = {'min': field.min(), 'max': field.max(), 'mean': field.mean()}
+        for p, v in zip(self.percentiles, np.percentile(field, self.percentiles)):
+            value[f'p{p}'] = v
+        return value
@@ -0,0 +1,327 @@
+"""
+Parameter sweeps with a cache of the results on disk.
+
+A sweep runs every combination of the values in a parameter space, with `trials`
+seeds per combination, in a pool of worker processes. The result of every
+(parameters, seed) job is stored in the cache directory under a hash of the full
+parameter set, the seed and the version of the simulation code, so:
+
+  - running a sweep again only runs the jobs that are not in the cache yet, which
+    also resumes an interrupted sweep;
+  - the results can be queried and saved again without running anything.
+
+From the command line, in the Simulation Folder:
+
+    python Parameter_Sweep_3d.py --space space.json --trials 5 --seed 1 --processes 8 \
+        --cache-dir sweep_cache --output sweep_results.csv
+
+where space.json holds a list of values to try per parameter, e.g.
+{"dump_strat": ["", "middle"], "concentration": [0.1, 0.3], "antibiotics_steps": [[10], [10, 20]]}.
+With --query the cached results of the space are saved without running anything.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from Trial_Runner_3d import (DEFAULT_PARAMETERS, METRIC_KEYS, TIMEFRAME_METRIC_KEYS,
+                             run_trial, trial_seeds, parse_parameters)
+
+# Modules whose source defines the simulation results; part of the code version.
+SIMULATION_MODULES = (
+    "Cell_3d.py",
+    "Cell_Arrays_3d.py",
+    "Cell_Events_3d.py",
+    "Cell_Parallel_3d.py",
+    "Counter_RNG_3d.py",
+    "BookKeepers_3d.py",
+    "Efficient_Resource_Manager_3d.py",
+    "Precision_3d.py",
+    "Dosing_3d.py",
+    "Simulation_3d.py",
+    "Trial_Runner_3d.py",
+)
+
+# Parameters and output options that only change what a job writes or records, not
+# its results; they are left out of the cache keys.
+NON_RESULT_PARAMETERS = ('grid_interval', 'verbose', 'history_path', 'history_dtype',
+                         'history_compress', 'checkpoint_path', 'checkpoint_interval',
+                         'profile', 'profiler', 'observers')
+
+
+def code_version():
+    """
+    Hash of the source files of the simulation. Changing any of them invalidates
+    the cached results.
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for name in SIMULATION_MODULES:
+        digest.update(name.encode())
+        with open(os.path.join(folder, name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def to_json(value):
+    # numpy scalars and arrays in parameters and metrics
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def full_parameters(parameters):
+    p = {**DEFAULT_PARAMETERS, **parameters}
+    for key in NON_RESULT_PARAMETERS:
+        p.pop(key, None)
+    return p
+
+
+def parameter_key(parameters):
+    """
+    Hash of the full parameter set (defaults included), the same for every seed.
+    """
+    text = json.dumps(full_parameters(parameters), sort_keys=True, default=to_json)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def job_key(parameters, seed, version):
+    """
+    Cache key of one job: hash of the full parameter set, the seed and the code version.
+    """
+    text = json.dumps({'parameters': full_parameters(parameters), 'seed': seed,
+                       'code_version': version}, sort_keys=True, default=to_json)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def expand_space(space, base=None):
+    """
+    All combinations of a parameter space, a dict of parameter -> list of values,
+    each combined with the fixed parameters in `base`.
+    """
+    base = base or {}
+    for key in list(space) + list(base):
+        if key not in DEFAULT_PARAMETERS and key not in NON_RESULT_PARAMETERS:
+            raise ValueError(f"Unknown parameter: {key}")
+    keys = list(space)
+    return [{**base, **dict(zip(keys, values))}
+            for values in itertools.product(*(space[key] for key in keys))]
+
+
+class ResultCache:
+    """
+    Directory with one entry per finished job, named after its job_key:
+
+        <path>/<key[:2]>/<key>/result.json       parameters, seed, code version, trial_result
+        <path>/<key[:2]>/<key>/step_summaries.csv
+
+    Entries are written to a temporary directory and renamed into place, so an
+    interrupted job never leaves a partial entry behind.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.entry_path(key), "result.json"))
+
+    def load(self, key):
+        with open(os.path.join(self.entry_path(key), "result.json")) as f:
+            return json.load(f)
+
+    def begin(self, key):
+        # Temporary directory for the outputs of a job, unique per worker process.
+        tmp_path = os.path.join(self.path, "tmp", f"{key}-{os.getpid()}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        return tmp_path
+
+    def commit(self, key, tmp_path, record):
+        with open(os.path.join(tmp_path, "result.json"), "w") as f:
+            json.dump(record, f, default=to_json)
+        final_path = self.entry_path(key)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        try:
+            os.rename(tmp_path, final_path)
+        except OSError:
+            # Another worker stored the same job first.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def records(self, version=None):
+        """
+        All cached records, optionally only those of one code version.
+        """
+        for prefix in sorted(os.listdir(self.path)):
+            if len(prefix) != 2:
+                continue
+            for key in sorted(os.listdir(os.path.join(self.path, prefix))):
+                if key in self:
+                    record = self.load(key)
+                    if version is None or record['code_version'] == version:
+                        yield record
+
+
+def sweep_jobs(space, trials=1, seed=None, base=None, version=None):
+    """
+    The (parameters, seed) jobs of a sweep. Every combination gets the same trial
+    seeds, so the combinations are compared on the same random streams.
+    """
+    if seed is None:
+        # Without a seed the jobs could never be found in the cache again.
+        raise ValueError("a cached sweep needs a seed")
+    version = version or code_version()
+    seeds = trial_seeds(seed, trials)
+    jobs = []
+    for parameters in expand_space(space, base):
+        for trial, trial_seed in enumerate(seeds, start=1):
+            jobs.append({'key': job_key(parameters, trial_seed, version),
+                         'parameter_key': parameter_key(parameters),
+                         'parameters': parameters, 'seed': trial_seed, 'trial': trial,
+                         'code_version': version})
+    return jobs
+
+
+def run_job(job, cache_dir, threads=None):
+    """
+    Run one job and store its result in the cache. Returns the cached record.
+    """
+    cache = ResultCache(cache_dir)
+    tmp_path = cache.begin(job['key'])
+    result = run_trial(job['parameters'], job['seed'], job['trial'], output_dir=tmp_path,
+                       threads=threads, csv_name="step_summaries.csv",
+                       profile=job['parameters'].get('profile', False))
+    record = {'key': job['key'], 'parameter_key': job['parameter_key'],
+              'parameters': full_parameters(job['parameters']), 'seed': job['seed'],
+              'trial': job['trial'], 'code_version': job['code_version'], 'result': result}
+    cache.commit(job['key'], tmp_path, record)
+    return record
+
+
+def run_sweep(space, trials=1, seed=None, cache_dir="sweep_cache", base=None, processes=None,
+              threads_per_process=None):
+    """
+    Run the jobs of a sweep that are not cached yet and return the records of all
+    jobs of the sweep, in the order of sweep_jobs.
+    """
+    cache = ResultCache(cache_dir)
+    jobs = sweep_jobs(space, trials, seed, base)
+    todo = [job for job in jobs if job['key'] not in cache]
+    print(f"{len(jobs)} jobs, {len(jobs) - len(todo)} cached, {len(todo)} to run.")
+    if todo:
+        processes = min(processes or os.cpu_count(), len(todo))
+        if threads_per_process is None:
+            threads_per_process = max(1, os.cpu_count() // processes)
+        # Numba's thread pool is not fork-safe, so the workers are started fresh.
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+            futures = [pool.submit(run_job, job, cache_dir, threads_per_process)
+                       for job in todo]
+            for done, future in enumerate(as_completed(futures), start=1):
+                record = future.result()
+                print(f"Job {record['key'][:12]} finished after "
+                      f"{record['result']['steps']} steps ({done}/{len(todo)} done).")
+    return [cache.load(job['key']) for job in jobs]
+
+
+def cached_records(space, trials=1, seed=None, cache_dir="sweep_cache", base=None):
+    """
+    The cached records of the jobs of a sweep, without running anything.
+    Jobs that are not cached are left out.
+    """
+    cache = ResultCache(cache_dir)
+    return [cache.load(job['key']) for job in sweep_jobs(space, trials, seed, base)
+            if job['key'] in cache]
+
+
+def query(cache_dir="sweep_cache", version=None, **parameters):
+    """
+    Table of the cached jobs whose parameters match the given values, e.g.
+    query("sweep_cache", dump_strat="middle"). By default only the results of the
+    current code version are returned; pass version="any" for all of them.
+    """
+    if version is None:
+        version = code_version()
+    cache = ResultCache(cache_dir)
+    records = [record for record in cache.records(None if version == "any" else version)
+               if all(record['parameters'].get(key) == value
+                      for key, value in parameters.items())]
+    return sweep_table(records)
+
+
+def step_summaries(record, cache_dir="sweep_cache"):
+    """
+    The step summaries of a cached job as a DataFrame.
+    """
+    import pandas as pd
+    path = os.path.join(ResultCache(cache_dir).entry_path(record['key']), "step_summaries.csv")
+    return pd.read_csv(path, sep=';', decimal=',')
+
+
+def sweep_table(records):
+    """
+    One row per job: the parameters that differ between the jobs, the seed and the
+    trial, followed by the trial metrics and the timeframe metrics.
+    """
+    import pandas as pd
+    rows = []
+    for record in records:
+        row = {'parameter_key': record['parameter_key'], 'trial': record['trial'],
+               'seed': record['seed'], 'steps': record['result']['steps']}
+        row.update({f"param_{key}": value for key, value in record['parameters'].items()})
+        row.update({key: record['result']['metrics'].get(key, np.nan) for key in METRIC_KEYS})
+        row.update({f"timeframe_{key}": record['result']['timeframe_metrics'].get(key, np.nan)
+                    for key in TIMEFRAME_METRIC_KEYS})
+        rows.append(row)
+    df = pd.DataFrame(rows)
+    if len(df):
+        # Keep only the parameter columns that vary; lists are compared as text.
+        fixed = [column for column in df.columns if column.startswith("param_")
+                 and df[column].astype(str).nunique() == 1]
+        df = df.drop(columns=fixed)
+    return df
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a cached parameter sweep of the 3D "
+                                                 "bacterial growth simulation.")
+    parser.add_argument("--space", required=True,
+                        help="JSON file with a list of values per swept parameter")
+    parser.add_argument("--trials", type=int, default=1, help="seeds per combination")
+    parser.add_argument("--seed", type=int, required=True, help="seed for the trial seeds")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="number of worker processes (default: all cores)")
+    parser.add_argument("--threads-per-process", type=int, default=None,
+                        help="numba threads per worker (default: cores / processes)")
+    parser.add_argument("--cache-dir", default="sweep_cache", help="directory of the cache")
+    parser.add_argument("--output", default="sweep_results.csv", help="CSV file of the results")
+    parser.add_argument("--param", action="append", default=[], metavar="KEY=VALUE",
+                        help="fixed parameter for all jobs, e.g. --param grid_size=30")
+    parser.add_argument("--query", action="store_true",
+                        help="only save the cached results, do not run anything")
+    args = parser.parse_args(argv)
+
+    with open(args.space) as f:
+        space = json.load(f)
+    base = parse_parameters(args.param)
+    if args.query:
+        records = cached_records(space, args.trials, args.seed, args.cache_dir, base)
+    else:
+        records = run_sweep(space, args.trials, args.seed, args.cache_dir, base,
+                            args.processes, args.threads_per_process)
+    sweep_table(records).to_csv(args.output, index=False, sep=';', decimal=',')
+    print(f"{len(records)} results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
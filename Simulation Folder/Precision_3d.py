@@ -0,0 +1,173 @@
+"""
+Storage precision of the simulation.
+
+simulate(..., precision="float32") halves the memory of the food and antibiotics
+fields and their diffusion coefficients, and with engine="arrays" stores the cell
+states as int8, the reproduction counts as uint16 and the timers as float32:
+
+    dtype     state   reproduction_count   timers    fields
+    float64   int64   int64                float64   float64
+    float32   int8    uint16               float32   float32
+
+The "cells" and "events" engines only reduce the fields; their cells keep full
+precision. The stencil diffusion kernel computes in the dtype of the fields; the
+neighbors and implicit kernels compute in float64 and store the result in float32. The draws of
+the cells compare float32 timers, so a float32 run is not the same trajectory as a
+float64 run with the same seed. accuracy_check measures how far apart they are,
+by default on a 20^3 grid with the "arrays" engine (ACCURACY_PARAMETERS):
+
+    python Precision_3d.py --time-units 50 --seeds 0 1 2 --tolerance 0.05
+"""
+import argparse
+import sys
+import numpy as np
+
+PRECISIONS = {
+    'float64': {'state': np.int64, 'count': np.int64, 'timer': np.float64,
+                'field': np.float64},
+    'float32': {'state': np.int8, 'count': np.uint16, 'timer': np.float32,
+                'field': np.float32},
+}
+
+# Defaults of accuracy_check on top of Trial_Runner_3d.DEFAULT_PARAMETERS: a small
+# grid, and a dx and D for which the explicit diffusion is stable (it is not for the
+# dx and D of the notebook).
+ACCURACY_PARAMETERS = dict(grid_size=20, grid_height=20, engine="arrays",
+                           diffusion_backend="stencil", num_bad_patches=2,
+                           resource_steps_per_time_unit=4, dx=1, D_food=0.02,
+                           D_antibiotics=0.02, dump_strat="middle", dump_size=8, amount=0.3)
+
+# Columns of the step summaries compared by accuracy_check
+COMPARED_KEYS = ('alive_good', 'alive_bad', 'dead_good', 'dead_bad',
+                 'antibiotics_concentration')
+
+
+def precision_dtypes(precision):
+    """
+    The numpy dtypes of the cell states, reproduction counts, timers and fields
+    for a precision ("float64" or "float32").
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision}")
+    return PRECISIONS[precision]
+
+
+def summary_trajectories(parameters, seed, time_units):
+    # The step summaries of one run as {key: array}, one entry per time unit
+    from Trial_Runner_3d import DEFAULT_PARAMETERS, make_simulation, seed_everything
+
+    p = {**DEFAULT_PARAMETERS, **parameters, 'grid_interval': None}
+    seed_everything(seed)
+    sim = make_simulation(p)
+    while sim.steps < time_units and sim.advance():
+        pass
+    summaries = sim.bookkeeper.summaries
+    return {key: np.asarray(summaries[key], dtype=np.float64) for key in COMPARED_KEYS}
+
+
+def mean_trajectories(runs, length):
+    # Mean over the runs; a run that stopped early keeps its last value
+    means = {}
+    for key in COMPARED_KEYS:
+        padded = [np.pad(run[key], (0, length - len(run[key])), mode="edge")
+                  for run in runs]
+        means[key] = np.mean(padded, axis=0)
+    return means
+
+
+def field_error(parameters, precision, time_units):
+    """
+    Largest difference between the food and antibiotics fields of a run without
+    cells in `precision` and in float64, relative to the largest value of the
+    float64 field.
+    """
+    from Trial_Runner_3d import DEFAULT_PARAMETERS
+    from Efficient_Resource_Manager_3d import ResourceManager
+
+    p = {**DEFAULT_PARAMETERS, **parameters}
+    managers = []
+    for dtype in ("float64", precision):
+        rm = ResourceManager(p['grid_size'], p['grid_height'],
+                             p['resource_steps_per_time_unit'], p['dx'],
+                             p['D_antibiotics'], p['D_food'],
+                             p['D_antibiotics_multiplyer'], p['D_food_multiplyer'],
+                             diffusion_backend=p['diffusion_backend'],
+                             solver=p['diffusion_solver'], precision=dtype)
+        rng = np.random.default_rng(0)
+        rm.food[:] = rng.random(rm.num_cells) * p['amount']
+        rm.antibiotics[:] = rng.random(rm.num_cells) * p['concentration']
+        states = np.zeros(rm.num_cells, dtype=np.int64)
+        rm.update_D(states)
+        for _ in range(time_units):
+            rm.diffusion_step()
+        managers.append(rm)
+    errors = {}
+    for name in ('food', 'antibiotics'):
+        reference = getattr(managers[0], name)
+        values = getattr(managers[1], name).astype(np.float64)
+        scale = max(np.abs(reference).max(), np.finfo(np.float64).tiny)
+        errors[name] = float(np.abs(values - reference).max() / scale)
+    return errors
+
+
+def accuracy_check(parameters=None, time_units=50, seeds=(0, 1, 2), precision="float32",
+                   tolerance=0.05):
+    """
+    Compare runs in `precision` with float64 runs of the same parameters and seeds.
+    `parameters` override ACCURACY_PARAMETERS.
+
+    The step summaries are averaged over the seeds and compared per time unit,
+    relative to the largest value of the float64 mean (the runs draw different
+    random numbers, so only the means are expected to agree). The diffusion alone
+    is compared on a run without cells. Returns the errors per quantity and
+    'passed': whether all of them are within tolerance.
+    """
+    parameters = {**ACCURACY_PARAMETERS, **(parameters or {})}
+    precision_dtypes(precision)
+    runs = {dtype: [summary_trajectories({**parameters, 'precision': dtype}, seed, time_units)
+                    for seed in seeds]
+            for dtype in ("float64", precision)}
+    length = max(len(run[COMPARED_KEYS[0]]) for dtype_runs in runs.values()
+                 for run in dtype_runs)
+    reference = mean_trajectories(runs["float64"], length)
+    reduced = mean_trajectories(runs[precision], length)
+
+    errors = {}
+    for key in COMPARED_KEYS:
+        scale = max(np.abs(reference[key]).max(), 1.0)
+        errors[key] = float(np.abs(reduced[key] - reference[key]).max() / scale)
+    for name, error in field_error(parameters, precision, time_units).items():
+        errors[f"{name}_field"] = error
+    return {'precision': precision, 'time_units': time_units, 'seeds': list(seeds),
+            'tolerance': tolerance, 'errors': errors,
+            'passed': all(error <= tolerance for error in errors.values())}
+
+
+def main(argv=None):
+    from Trial_Runner_3d import parse_parameters
+
+    parser = argparse.ArgumentParser(
+        description="Compare a reduced-precision run with a float64 run.")
+    parser.add_argument("--precision", default="float32", choices=sorted(PRECISIONS))
+    parser.add_argument("--time-units", type=int, default=50,
+                        help="time units per run")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2],
+                        help="seeds of the runs that are averaged")
+    parser.add_argument("--tolerance", type=float, default=0.05,
+                        help="largest relative error that passes")
+    parser.add_argument("--param", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a parameter of ACCURACY_PARAMETERS or "
+                             "Trial_Runner_3d.DEFAULT_PARAMETERS")
+    args = parser.parse_args(argv)
+
+    result = accuracy_check(parse_parameters(args.param), time_units=args.time_units,
+                            seeds=args.seeds, precision=args.precision,
+                            tolerance=args.tolerance)
+    for name, error in result['errors'].items():
+        print(f"{name:30s} {error:.3e}")
+    print("passed" if result['passed'] else f"failed (tolerance {args.tolerance})")
+    return 0 if result['passed'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
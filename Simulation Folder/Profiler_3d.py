@@ -0,0 +1,168 @@
+"""
+Opt-in profiling of simulation runs.
+
+Give simulate a Profiler and every time unit records the wall time and number of
+calls of its phases (the cell sweeps, history snapshots, observers, dosing, the
+update of the diffusion coefficients, the diffusion and its fields, the step summary
+and checkpoints), the number of alive cells and the bytes held by the history and the
+Bookkeeper:
+
+    profiler = Profiler()
+    sim = simulate(..., profiler=profiler)
+    while sim.advance():
+        pass
+    profiler.summary()                       # one row per phase
+    profiler.save_csv("profile.csv")         # one row per time unit
+    profiler.save_trace("profile.trace.json")
+
+The trace opens in chrome://tracing or https://ui.perfetto.dev. Without a profiler
+simulate uses NULL_PROFILER, whose phases are one shared no-op context manager.
+"""
+import json
+import os
+import time
+
+
+class NullPhase:
+    # Context manager that does nothing; shared by all phases of the NullProfiler.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullProfiler:
+    """
+    The profiler used when profiling is off: records nothing.
+    """
+    enabled = False
+    null_phase = NullPhase()
+
+    def phase(self, name):
+        return self.null_phase
+
+    def end_step(self, step, sim):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, self.start, time.perf_counter())
+        return False
+
+
+class Profiler:
+    """
+    Records the phases of a run as spans of wall time. Phases can be nested, e.g.
+    "diffusion/food" inside "diffusion"; the time of a phase includes its children.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.spans = []  # (name, start, end) in seconds since origin
+        self.steps = []  # per time unit: step, alive cells, bytes and its phases
+        self.current = {}  # phase -> [calls, seconds] of the running time unit
+        self.step_start = None  # start of the first phase of the running time unit
+        self.phase_names = []  # in the order they first ran
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add(self, name, start, end):
+        self.spans.append((name, start - self.origin, end - self.origin))
+        if self.step_start is None or start < self.step_start:
+            self.step_start = start
+        if name not in self.current:
+            self.current[name] = [0, 0.0]
+            if name not in self.phase_names:
+                self.phase_names.append(name)
+        self.current[name][0] += 1
+        self.current[name][1] += end - start
+
+    def end_step(self, step, sim):
+        """
+        Close the time unit `step` of `sim`: store the times of its phases with the
+        number of alive cells and the memory held by the histories.
+        """
+        counts = sim.bookkeeper.counts
+        now = time.perf_counter()
+        self.steps.append({
+            'step': int(step),
+            'time': now - self.origin,
+            'wall_s': now - (self.step_start if self.step_start is not None else now),
+            'alive_cells': counts['alive_good'] + counts['alive_bad'],
+            'history_bytes': sim.history_nbytes(),
+            'bookkeeper_bytes': sim.bookkeeper.nbytes,
+            'phases': self.current,
+        })
+        self.current = {}
+        self.step_start = None
+
+    # --- Results --- #
+    def step_table(self):
+        """
+        One row per time unit: the step, its wall time, alive cells, history and
+        Bookkeeper bytes, and the seconds and calls of every phase.
+        """
+        import pandas as pd
+        rows = []
+        for record in self.steps:
+            row = {key: record[key] for key in ('step', 'wall_s', 'alive_cells',
+                                                'history_bytes', 'bookkeeper_bytes')}
+            for name in self.phase_names:
+                calls, seconds = record['phases'].get(name, (0, 0.0))
+                row[f"{name}_s"] = seconds
+                row[f"{name}_calls"] = calls
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def summary(self):
+        """
+        One row per phase: calls, total, mean and max seconds per time unit and the
+        share of the wall time of the profiled time units.
+        """
+        import pandas as pd
+        total = sum(record['wall_s'] for record in self.steps)
+        rows = []
+        for name in self.phase_names:
+            per_step = [record['phases'].get(name, (0, 0.0)) for record in self.steps]
+            seconds = [s for _, s in per_step]
+            rows.append({'phase': name, 'calls': sum(c for c, _ in per_step),
+                         'total_s': sum(seconds),
+                         'mean_s_per_step': sum(seconds) / len(seconds) if seconds else 0.0,
+                         'max_s_per_step': max(seconds, default=0.0),
+                         'share': sum(seconds) / total if total else 0.0})
+        return pd.DataFrame(rows)
+
+    def save_csv(self, csv_path):
+        self.step_table().to_csv(csv_path, index=False, sep=';', decimal=',')
+
+    def save_trace(self, path):
+        """
+        Write the spans and the per step counters in the Chrome trace event format.
+        """
+        pid = os.getpid()
+        events = [{'name': name, 'cat': "simulation", 'ph': "X", 'ts': start * 1e6,
+                   'dur': (end - start) * 1e6, 'pid': pid, 'tid': 0}
+                  for name, start, end in self.spans]
+        for record in self.steps:
+            events.append({'name': "cells", 'ph': "C", 'ts': record['time'] * 1e6,
+                           'pid': pid, 'args': {'alive': record['alive_cells']}})
+            events.append({'name': "memory", 'ph': "C", 'ts': record['time'] * 1e6,
+                           'pid': pid, 'args': {'history_bytes': record['history_bytes'],
+                                                'bookkeeper_bytes': record['bookkeeper_bytes']}})
+        with open(path, "w") as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': "ms"}, f)
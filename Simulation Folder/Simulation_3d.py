@@ -0,0 +1,396 @@
+import numpy as np
+import os
+import random
+import sys
+from Cell_3d import Cell as GridCell
+from Cell_Arrays_3d import CellArrays
+from Cell_Events_3d import CellEvents
+from Cell_Parallel_3d import CellParallel
+from BookKeepers_3d import Bookkeeper
+from History_Store_3d import HistoryStore
+from Dosing_3d import DosingSchedule, strategy_indices, strategy_amount, add_dose
+from Efficient_Resource_Manager_3d import ResourceManager
+from Profiler_3d import NULL_PROFILER
+
+
+def initialize_3d_grid_random_positions(size, height, num_good_cell_patches, 
+                                        num_bad_cell_patches):
+    """
+    Initialize a 3D grid with random positions for good and bad bacteria patches.
+    Only includes the direct neighbors of the initial position (6 neighbors + initial position).
+    """
+    grid = np.zeros(size * size * height, dtype=int)  # Initialize a 1D array
+    layer_size = size * size
+
+    # Randomly select positions for good bacteria patches
+    good_indices = np.random.choice(range(size * size * height), num_good_cell_patches, 
+                                    replace=False)
+    for index in good_indices:
+        grid[index] = 1  # Good bacteria
+        z = index // layer_size
+        rem = index % layer_size
+        row = rem // size
+        col = rem % size
+
+        # Add direct neighbors for good bacteria
+        for dz, dr, dc in [(0, 0, 1), (0, 0, -1), (0, 1, 0), (0, -1, 0), (1, 0, 0), (-1, 0, 0)]:
+            nz = z + dz
+            nr = row + dr
+            nc = col + dc
+            if 0 <= nz < height and 0 <= nr < size and 0 <= nc < size:
+                neighbor_index = nz * layer_size + nr * size + nc
+                grid[neighbor_index] = 1
+
+    # Randomly select positions for bad bacteria patches
+    bad_indices = np.random.choice(range(size * size * height), num_bad_cell_patches, 
+                                   replace=False)
+    for index in bad_indices:
+        grid[index] = -1  # Bad bacteria
+        z = index // layer_size
+        rem = index % layer_size
+        row = rem // size
+        col = rem % size
+
+        # Add direct neighbors for bad bacteria
+        for dz, dr, dc in [(0, 0, 1), (0, 0, -1), (0, 1, 0), (0, -1, 0), (1, 0, 0), (-1, 0, 0)]:
+            nz = z + dz
+            nr = row + dr
+            nc = col + dc
+            if 0 <= nz < height and 0 <= nr < size and 0 <= nc < size:
+                neighbor_index = nz * layer_size + nr * size + nc
+                grid[neighbor_index] = -1
+    
+    return grid
+
+
+class simulate():
+    def __init__(self, grid_size, grid_height, init_states, steps_per_time_unit=1, 
+                 grid_history_interval=1, 
+                 antibiotics_interval=100, antibiotics_steps=[10], dump_strat="quarters", 
+                 dump_size=10, concentration=1, antibiotics_concentrations=[1], 
+                 food_interval=100, food_dump_strat="quarters", food_dump_size=10, amount=1,
+                 resource_steps_per_time_unit=4, dx=0.000002, D_antibiotics=1, D_food=1, 
+                 D_antibiotics_multiplyer=2, D_food_multiplyer=2, engine="cells",
+                 diffusion_backend="neighbors", diffusion_solver="explicit",
+                 history_path=None, history_dtype=np.float32, history_compress=False,
+                 checkpoint_path=None, checkpoint_interval=None, dosing_schedule=None,
+                 profiler=None, observers=None, precision="float64", seed=None,
+                 timeframe=None, verbose=False):
+        """
+        engine: "cells" keeps one Cell object per grid position, "arrays" stores the
+                cells as numpy arrays (CellArrays) and sweeps them in a compiled kernel,
+                "events" processes reproductions and deaths in time order (CellEvents),
+                with steps_per_time_unit only setting the antibiotics kill rate, and
+                "parallel" updates the cells of a sub-step in parallel with random
+                numbers keyed by seed, sub-step and cell (CellParallel).
+        diffusion_backend: passed on to the ResourceManager ("neighbors" or "stencil").
+        diffusion_solver: passed on to the ResourceManager ("explicit", "cfl" or "implicit").
+        history_path: directory to stream the grid, antibiotics and food history to
+                      (a HistoryStore with the fields as history_dtype, zlib compressed
+                      if history_compress). By default the history is kept in lists.
+                      With grid_history_interval=None no history is kept at all.
+        checkpoint_path: file that advance() overwrites with a checkpoint every
+                         checkpoint_interval time units (see Checkpoint_3d.py).
+        dosing_schedule: a Dosing_3d.DosingSchedule used instead of the antibiotics and
+                         food doses of the parameters above. The food dump at the
+                         start still comes from amount, food_dump_size and food_dump_strat.
+        profiler: a Profiler_3d.Profiler that records the time of the phases of every
+                  time unit of advance(). Off by default.
+        observers: Observers_3d observers that reduce the grid at the start and after
+                   the cell sub-steps of every time unit on their cadence, instead of
+                   keeping full snapshots. They are not saved in checkpoints.
+        precision: "float64" or "float32" (see Precision_3d.py). With "float32" the
+                   food and antibiotics fields are float32 for every engine, and the
+                   arrays and parallel engines keep the states as int8, the
+                   reproduction counts as uint16 and the timers as float32. The cells
+                   and events engines keep their cells in full precision.
+        seed: seed of the random numbers of the parallel engine; by default drawn
+              from numpy's global generator. The other engines ignore it.
+        timeframe: (start, end) in time units of the timeframe metrics of the run (see
+                   Trial_Runner_3d.trial_result), or None if they are not needed.
+        verbose: print a line for every history snapshot.
+        """
+        if engine not in ("cells", "arrays", "events", "parallel"):
+            raise ValueError(f"Unknown engine: {engine}")
+        self.engine = engine
+        # Everything except the initial grid, to rebuild the simulation from a checkpoint
+        self.parameters = dict(
+            grid_size=grid_size, grid_height=grid_height,
+            steps_per_time_unit=steps_per_time_unit,
+            grid_history_interval=grid_history_interval,
+            antibiotics_interval=antibiotics_interval, antibiotics_steps=list(antibiotics_steps),
+            dump_strat=dump_strat, dump_size=dump_size, concentration=concentration,
+            antibiotics_concentrations=list(antibiotics_concentrations),
+            food_interval=food_interval, food_dump_strat=food_dump_strat,
+            food_dump_size=food_dump_size, amount=amount,
+            resource_steps_per_time_unit=resource_steps_per_time_unit, dx=dx,
+            D_antibiotics=D_antibiotics, D_food=D_food,
+            D_antibiotics_multiplyer=D_antibiotics_multiplyer,
+            D_food_multiplyer=D_food_multiplyer, engine=engine,
+            diffusion_backend=diffusion_backend, diffusion_solver=diffusion_solver,
+            history_path=None if history_path is None else os.fspath(history_path),
+            history_dtype=np.dtype(history_dtype).str, history_compress=history_compress,
+            checkpoint_path=None if checkpoint_path is None else os.fspath(checkpoint_path),
+            checkpoint_interval=checkpoint_interval, precision=precision, seed=seed,
+            timeframe=None if timeframe is None else list(timeframe), verbose=verbose)
+        self.checkpoint_path = checkpoint_path
+        self.timeframe = None if timeframe is None else tuple(timeframe)
+        self.profiler = profiler or NULL_PROFILER
+        self.observers = list(observers or [])
+        self.checkpoint_interval = checkpoint_interval
+        self.bookkeeper = Bookkeeper()
+        self.concentration = concentration
+        self.grid_size = grid_size
+        self.grid_height = grid_height
+        self.steps = 0
+        self.steps_per_time_unit = steps_per_time_unit
+        
+
+        # Initialize the ResourceManager here.
+        self.resources = ResourceManager(grid_size, grid_height, 
+                                         resource_steps_per_time_unit, dx, D_antibiotics, 
+                                         D_food, D_antibiotics_multiplyer,
+                                         D_food_multiplyer,
+                                         diffusion_backend=diffusion_backend,
+                                         solver=diffusion_solver, precision=precision)
+        self.resources.profiler = self.profiler
+
+
+        # --- History of the grid and the resources --- #
+        self.history_store = None
+        if history_path is not None:
+            self.history_store = HistoryStore(history_path, "w",
+                                              shape=(grid_height, grid_size, grid_size),
+                                              field_dtype=history_dtype,
+                                              compress=history_compress)
+            # Lazy, read-only views of the snapshots on disk
+            self.grid_history = self.history_store.states
+            self.antibiotics_history = self.history_store.antibiotics
+            self.food_history = self.history_store.food
+        else:
+            self.grid_history = []
+            self.antibiotics_history = []
+            self.food_history = []
+        # Side files with the in-memory history already written by save_checkpoint
+        self.checkpoint_history = {}
+
+        # --- Create the grid --- #
+        initial_states = init_states
+
+        offsets = self.resources.neighbor_offsets
+        neighbor_indices = self.resources.neighbor_indices
+        if self.engine == "arrays":
+            # The cells share the neighbor table of the ResourceManager
+            self.grid = CellArrays(initial_states, offsets, neighbor_indices,
+                                   precision=precision)
+        elif self.engine == "events":
+            self.grid = CellEvents(initial_states, offsets, neighbor_indices)
+        elif self.engine == "parallel":
+            self.grid = CellParallel(initial_states, offsets, neighbor_indices,
+                                     precision=precision, seed=seed)
+        else:
+            # Initialize the grid with Cell objects, with their neighbors cut from the
+            # neighbor table instead of computed per cell
+            flat = neighbor_indices.tolist()
+            bounds = offsets.tolist()
+            self.grid = [None] * len(initial_states)  # List to store Cell objects
+            for index, state in enumerate(initial_states):
+                self.grid[index] = GridCell(index, state, grid_size, grid_height, 
+                                            self.bookkeeper,
+                                            flat[bounds[index]:bounds[index + 1]])
+        self.indices = np.arange(len(self.grid))
+        self.bookkeeper.initialize_counts(self.get_states())
+        # Only births turn empty positions into occupied ones, so after this the
+        # diffusion coefficients are updated from the births recorded since.
+        self.resources.update_D(self.get_states())
+        self.births_applied = 0
+        self.grid_history_interval = grid_history_interval
+        self.verbose = verbose
+
+        # --- Antibiotics and Food Initialization --- #
+        self.antibiotics_steps = antibiotics_steps  # steps at which to add antibiotics
+        self.antibiotics_concentrations = antibiotics_concentrations  # concentrations
+        self.dump_strat = dump_strat
+        self.dump_size = dump_size
+        self.antibiotics_interval = antibiotics_interval
+
+        # Add food to the grid at the start
+        self.add_food(amount, food_dump_size, food_dump_strat)
+        self.food_interval = food_interval
+        self.food_dump_strat = food_dump_strat
+        self.food_dump_size = food_dump_size
+        self.amount = amount
+
+        # The doses of the run, looked up once per time unit
+        self.dosing_key = (dump_size, dump_strat, concentration, food_dump_size,
+                           food_dump_strat, amount)
+        if dosing_schedule is None:
+            dosing_schedule = self.parameter_dosing(*self.dosing_key)
+        self.dosing = dosing_schedule
+
+        # Save the initial grid and resources
+        self.save_history_snapshot()
+        self.observe()
+
+    def step(self, dump_size=None, dump_strat=None, concentration=None, food_dump_size=None,
+             food_dump_strat=None, amount=None):
+        """
+        Advance the cells by one time unit and add the doses that are due. The dosing
+        arguments default to those given at construction.
+        """
+        dt = 1 / self.steps_per_time_unit  # Fraction of a time unit per sub-step
+
+        if self.engine == "events":
+            # The whole time unit at once; the events carry their own times
+            self.bookkeeper.current_step = self.steps
+            with self.profiler.phase("cells"):
+                self.grid.step_time_unit(self.resources, self.bookkeeper, self.steps,
+                                         self.steps_per_time_unit)
+            self.steps += 1
+        else:
+            for _ in range(self.steps_per_time_unit):
+                self.bookkeeper.current_step = self.steps  # Tag the events of this sub-step
+
+                with self.profiler.phase("cells"):
+                    if self.engine in ("arrays", "parallel"):
+                        # Shuffling and updating happen inside the compiled sweep
+                        self.grid.step(self.resources, self.bookkeeper, dt)
+                    else:
+                        random.shuffle(self.indices)
+
+                        # Update cells in the order of the shuffled indices
+                        for index in self.indices:
+                            self.grid[index].step(self.grid, self.resources, dt)
+                self.steps += dt  # Increase the simulation time accordingly
+
+        # Optionally save a snapshot of the grid (e.g. once per time unit)
+        if self.grid_history_interval and int(self.steps) % self.grid_history_interval == 0:
+            with self.profiler.phase("history"):
+                self.save_history_snapshot()
+            if self.verbose:
+                print(f"Step {int(self.steps)}: Grid history saved.")
+        if self.observers:
+            with self.profiler.phase("observers"):
+                self.observe()
+
+        # Add the antibiotics and food that are due at this step.
+        given = (dump_size, dump_strat, concentration, food_dump_size, food_dump_strat, amount)
+        key = tuple(old if new is None else new for old, new in zip(self.dosing_key, given))
+        if key != self.dosing_key:
+            # Called with other dosing arguments than before, the masks come from the cache
+            self.dosing = self.parameter_dosing(*key)
+            self.dosing_key = key
+        with self.profiler.phase("dosing"):
+            self.dosing.apply(int(self.steps), self.resources)
+
+    def parameter_dosing(self, dump_size, dump_strat, concentration, food_dump_size,
+                         food_dump_strat, amount):
+        """
+        The DosingSchedule of the simulate parameters: antibiotics at antibiotics_steps
+        and every antibiotics_interval steps, food every food_interval steps.
+        """
+        return DosingSchedule.from_parameters(
+            self.grid_size, self.grid_height, self.antibiotics_steps,
+            self.antibiotics_concentrations, dump_strat, dump_size, concentration,
+            self.antibiotics_interval, self.food_interval, food_dump_strat, food_dump_size,
+            amount)
+
+    def advance(self):
+        """
+        Run one time unit with the dosing parameters given at construction: the cell
+        sub-steps and dosing, the diffusion of the resources and the step summary.
+        Returns False once no alive cells are left.
+        """
+        profiler = self.profiler
+        with profiler.phase("time_unit"):
+            self.step()
+            with profiler.phase("update_D"):
+                births = self.bookkeeper.births
+                self.resources.update_D_changed(births['cell_index'][self.births_applied:],
+                                                births['cell_type'][self.births_applied:])
+                self.births_applied = len(births)
+            with profiler.phase("diffusion"):
+                self.resources.diffusion_step()
+            with profiler.phase("summary"):
+                self.bookkeeper.record_step_summary(step=int(self.steps),
+                                                    resource_manager=self.resources)
+            if self.checkpoint_interval and int(self.steps) % self.checkpoint_interval == 0:
+                with profiler.phase("checkpoint"):
+                    self.save_checkpoint()
+        if profiler.enabled:
+            profiler.end_step(self.steps, self)
+        return self.bookkeeper.counts['alive_good'] + self.bookkeeper.counts['alive_bad'] > 0
+
+    def save_checkpoint(self, path=None):
+        """
+        Write the full state of the simulation to `path` (default: checkpoint_path).
+        Restore it with Checkpoint_3d.load_checkpoint.
+        """
+        from Checkpoint_3d import save_checkpoint
+        save_checkpoint(self, path or self.checkpoint_path)
+
+    def save_history_snapshot(self):
+        """
+        Save the current grid states, antibiotics and food to the history.
+        """
+        if self.grid_history_interval is None:
+            return
+        if self.history_store is not None:
+            self.history_store.append(int(self.steps), self.get_states(),
+                                      self.resources.antibiotics, self.resources.food)
+        else:
+            self.grid_history.append(self.get_states().tolist())
+            self.antibiotics_history.append(list(self.resources.antibiotics))
+            self.food_history.append(list(self.resources.food))
+
+    def observe(self, force=False):
+        """
+        Let the observers reduce the current grid and resources; with force also
+        the observers whose cadence does not include the current step.
+        """
+        for observer in self.observers:
+            observer.observe(int(self.steps), self, force)
+
+    def history_nbytes(self):
+        """
+        Bytes of the grid and resource history held in memory. A HistoryStore only
+        holds its unwritten and cached snapshots; the lists hold python objects
+        (the states are small cached ints, the fields 24 byte floats).
+        """
+        if self.grid_history_interval is None:
+            return 0
+        if self.history_store is not None:
+            return self.history_store.nbytes
+        n = len(self.grid_history)
+        if n == 0:
+            return 0
+        list_bytes = sys.getsizeof(self.grid_history[0])
+        return (n * 3 * list_bytes + 2 * n * len(self.grid_history[0]) * sys.getsizeof(0.5)
+                + sys.getsizeof(self.grid_history) * 3)
+
+    def get_states(self):
+        """
+        Return the state of every grid position as a numpy array.
+        """
+        if self.engine in ("arrays", "events", "parallel"):
+            return self.grid.state
+        return np.array([cell.state for cell in self.grid])
+
+    def add_antibiotics(self, concentration, dump_size, dump_strat):
+        """
+        Add antibiotics with a dosing strategy: "middle", "quarters", "corner",
+        "uniform" or anything else for the whole grid (see Dosing_3d.py).
+        """
+        indices, unique = strategy_indices(dump_strat, self.grid_size, self.grid_height,
+                                           dump_size)
+        add_dose(self.resources.antibiotics, indices,
+                 strategy_amount(dump_strat, concentration, self.grid_size, dump_size), unique)
+
+    def add_food(self, amount, dump_size, dump_strat):
+        """
+        Add food with a dosing strategy, like add_antibiotics.
+        """
+        indices, unique = strategy_indices(dump_strat, self.grid_size, self.grid_height,
+                                           dump_size)
+        add_dose(self.resources.food, indices,
+                 strategy_amount(dump_strat, amount, self.grid_size, dump_size), unique)
@@ -0,0 +1,472 @@
+"""
+Run many trials of one parameter set in parallel and save their results.
+
+From the command line, in the Simulation Folder:
+
+    python Trial_Runner_3d.py --trials 30 --seed 1 --processes 8 --output-dir results \
+        --param grid_size=50 --param dump_strat='"middle"' --param antibiotics_steps=[10,20]
+
+Every trial runs in a worker process with its own seed derived from --seed, and
+returns only its metrics. The per-trial step summaries are written by the workers,
+and the aggregated CSV files are rewritten every time a trial finishes. With
+--ensemble the trials run instead as the replicas of one Ensemble (Ensemble_3d.py)
+in this process, which is faster for many trials of small grids.
+"""
+import argparse
+import ast
+import json
+import multiprocessing
+import os
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from Simulation_3d import simulate, initialize_3d_grid_random_positions
+
+# Parameters of the notebook; anything not given to run_trial falls back to these.
+DEFAULT_PARAMETERS = {
+    # Simulation parameters
+    'grid_size': 50,
+    'grid_height': 50,
+    'grid_interval': None,  # history snapshots are not needed for the CSV files
+    'steps_per_time_unit': 2,
+    'num_good_patches': 3,
+    'num_bad_patches': 0,
+    'max_steps': None,  # stop after this many time units even if cells are left
+    'engine': "cells",
+    'diffusion_backend': "neighbors",
+    'diffusion_solver': "explicit",
+    'precision': "float64",
+    # Resource parameters
+    'resource_steps_per_time_unit': 160,
+    'dx': 0.000002,
+    'D_antibiotics': 0.0000000001,
+    'D_food': 1,
+    'D_antibiotics_multiplyer': 0.5,
+    'D_food_multiplyer': 0.5,
+    # Strategy parameters antibiotics
+    'antibiotics_interval': 1000,
+    'dump_strat': "",
+    'dump_size': 20,
+    'concentration': 0.3,
+    'antibiotics_steps': [10],
+    'antibiotics_concentrations': [0.5],
+    # Strategy parameters food
+    'food_interval': 75,
+    'food_dump_strat': "",
+    'food_dump_size': 40,
+    'amount': 10,
+    # Timeframe for analysis
+    'timeframe_start': 5,
+    'timeframe_end': 85,
+}
+
+METRIC_KEYS = [
+    "mean_reproduction",
+    "mean_alive_time_good",
+    "mean_alive_time_bad",
+    "total_alive_time_good",
+    "total_alive_time_bad",
+    "total_death_counts_good_age",
+    "total_death_counts_good_antibiotics",
+    "total_death_counts_good_food",
+    "total_death_counts_bad_age",
+    "total_death_counts_bad_antibiotics",
+    "total_death_counts_bad_food",
+    "total_death_counts_good",
+    "total_death_counts_bad",
+]
+
+TIMEFRAME_METRIC_KEYS = METRIC_KEYS + [
+    "alive_good_at_timeframe_end",
+    "alive_bad_at_timeframe_end",
+]
+
+
+def seed_everything(seed):
+    """
+    Seed the python, numpy and numba random generators used by the simulation.
+    """
+    from Cell_Arrays_3d import seed_numba_rng
+    random.seed(seed)
+    np.random.seed(seed)
+    seed_numba_rng(seed)
+
+
+def trial_seeds(seed, trials):
+    """
+    Independent, reproducible seeds for every trial, derived from one seed.
+    """
+    return [int(child.generate_state(1)[0]) for child in np.random.SeedSequence(seed).spawn(trials)]
+
+
+# Options of simulate that do not change the results; passed on when the
+# parameters hold them.
+SIMULATION_OPTIONS = ('verbose', 'history_dtype', 'history_compress', 'checkpoint_path',
+                      'checkpoint_interval', 'profiler', 'observers')
+
+
+def make_simulation(parameters, history_path=None):
+    """
+    Build the initial grid and the simulate instance for a set of parameters.
+    """
+    p = {**DEFAULT_PARAMETERS, **parameters}
+    initial_grid = initialize_3d_grid_random_positions(p['grid_size'], p['grid_height'],
+                                                       p['num_good_patches'],
+                                                       p['num_bad_patches'])
+    return simulate(
+        grid_size=p['grid_size'],
+        grid_height=p['grid_height'],
+        init_states=initial_grid,
+        steps_per_time_unit=p['steps_per_time_unit'],
+        grid_history_interval=p['grid_interval'],
+        antibiotics_interval=p['antibiotics_interval'],
+        antibiotics_steps=p['antibiotics_steps'],
+        dump_strat=p['dump_strat'],
+        dump_size=p['dump_size'],
+        concentration=p['concentration'],
+        antibiotics_concentrations=p['antibiotics_concentrations'],
+        food_interval=p['food_interval'],
+        food_dump_strat=p['food_dump_strat'],
+        food_dump_size=p['food_dump_size'],
+        amount=p['amount'],
+        resource_steps_per_time_unit=p['resource_steps_per_time_unit'],
+        dx=p['dx'],
+        D_antibiotics=p['D_antibiotics'],
+        D_food=p['D_food'],
+        D_antibiotics_multiplyer=p['D_antibiotics_multiplyer'],
+        D_food_multiplyer=p['D_food_multiplyer'],
+        engine=p['engine'],
+        diffusion_backend=p['diffusion_backend'],
+        diffusion_solver=p['diffusion_solver'],
+        history_path=history_path if history_path is not None else p.get('history_path'),
+        precision=p['precision'],
+        timeframe=(p['timeframe_start'], p['timeframe_end']),
+        **{key: p[key] for key in SIMULATION_OPTIONS if key in p},
+    )
+
+
+def calculate_metrics_for_sim(bookkeeper):
+    """
+    Metrics of a whole trial, plus the sums and counts needed to pool the means
+    over trials in save_aggregated_trial_data.
+    """
+    metrics = {}
+    totals = {}
+    repro_records_list = list(bookkeeper.reproduction_records.values())
+    totals["reproduction_sum"] = float(np.sum(repro_records_list))
+    totals["reproduction_n"] = len(repro_records_list)
+    metrics["mean_reproduction"] = np.mean(repro_records_list) if repro_records_list else np.nan
+
+    alive_times = bookkeeper.alive_times
+    for cell_type in ('good', 'bad'):
+        alive_list = alive_times[cell_type]
+        metrics[f"mean_alive_time_{cell_type}"] = np.mean(alive_list) if alive_list else np.nan
+        metrics[f"total_alive_time_{cell_type}"] = sum(alive_list)
+        totals[f"alive_time_sum_{cell_type}"] = float(sum(alive_list))
+        totals[f"alive_time_n_{cell_type}"] = len(alive_list)
+
+    for cell_type in ('good', 'bad'):
+        for cause in ('age', 'antibiotics', 'food'):
+            metrics[f"total_death_counts_{cell_type}_{cause}"] = bookkeeper.death_counts[cell_type][cause]
+        metrics[f"total_death_counts_{cell_type}"] = sum(bookkeeper.death_counts[cell_type].values())
+    return {key: metrics[key] for key in METRIC_KEYS}, totals
+
+
+def trial_result(sim, trial, seed=None, timeframe=None):
+    """
+    The compact result of a finished trial: metrics, timeframe metrics and totals.
+    timeframe: (start, end) of the timeframe metrics; by default the timeframe the
+               simulation was built with.
+    """
+    if timeframe is None:
+        timeframe = sim.timeframe
+    if timeframe is None:
+        raise ValueError("No timeframe: pass one to trial_result or to simulate")
+    metrics, totals = calculate_metrics_for_sim(sim.bookkeeper)
+    timeframe_start, timeframe_end = timeframe
+    return {
+        'trial': trial,
+        'seed': seed,
+        'steps': int(sim.steps),
+        'metrics': metrics,
+        'totals': totals,
+        'timeframe_metrics': sim.bookkeeper.timeframe_metrics(timeframe_start, timeframe_end),
+    }
+
+
+def run_trial(parameters, seed, trial=1, output_dir=None, threads=None, history_path=None,
+              csv_name=None, profile=False):
+    """
+    Run one trial until no alive cells are left (or max_steps time units) and return
+    its trial_result. The step summaries are saved to output_dir/trial{trial}_data.csv,
+    or to output_dir/csv_name if given. With profile=True the time of the phases of
+    every time unit is saved to output_dir/trial{trial}_profile.csv and
+    trial{trial}_profile.trace.json (see Profiler_3d.py).
+    """
+    if threads is not None:
+        import numba
+        numba.set_num_threads(threads)
+    p = {**DEFAULT_PARAMETERS, **parameters}
+    seed_everything(seed)
+    sim = make_simulation(p, history_path=history_path)
+    if profile:
+        from Profiler_3d import Profiler
+        sim.profiler = sim.resources.profiler = Profiler()
+
+    keep_simulating = True
+    while keep_simulating:
+        keep_simulating = sim.advance()
+        if p['max_steps'] is not None and sim.steps >= p['max_steps']:
+            keep_simulating = False
+    sim.save_history_snapshot()  # Save the final grid and resources
+    if sim.history_store is not None:
+        sim.history_store.close()
+
+    if output_dir is not None:
+        save_step_summaries(sim, os.path.join(output_dir, csv_name or f"trial{trial}_data.csv"))
+        if profile:
+            sim.profiler.save_csv(os.path.join(output_dir, f"trial{trial}_profile.csv"))
+            sim.profiler.save_trace(os.path.join(output_dir, f"trial{trial}_profile.trace.json"))
+    return trial_result(sim, trial, seed)
+
+
+def save_step_summaries(sim, csv_path):
+    """
+    Save step summaries for each step in a trial to a CSV file.
+
+    Parameters:
+      sim     : a simulate instance after the trial has run.
+      csv_path: path to the output CSV file.
+    """
+    import pandas as pd
+    # Create a DataFrame from the step summaries of the Bookkeeper
+    df = pd.DataFrame(sim.bookkeeper.step_summaries)
+    df.to_csv(csv_path, index=False, sep=';', decimal=',')
+
+
+def save_aggregated_trial_data(results, csv_path):
+    """
+    Save data for each trial and aggregated data for all trials combined to a CSV file.
+    Each trial will be a column, followed by an aggregated column. Metrics will be rows.
+
+    Parameters:
+      results : list of trial_result dictionaries.
+      csv_path: path to the output CSV file.
+    """
+    import pandas as pd
+    if not results:
+        print("Warning: No trial data provided. CSV will reflect empty/NaN aggregated data.")
+
+    all_columns_data = {}
+    grand_totals = {}
+    grand_death_counts = {key: 0 for key in METRIC_KEYS if key.startswith("total_death_counts")}
+    for result in sorted(results, key=lambda r: r['trial']):
+        all_columns_data[f"Trial {result['trial']}"] = result['metrics']
+        for key, value in result['totals'].items():
+            grand_totals[key] = grand_totals.get(key, 0) + value
+        for key in grand_death_counts:
+            grand_death_counts[key] += result['metrics'][key]
+
+    # Means are pooled over the records of all trials, totals are summed.
+    aggregated = {}
+    n = grand_totals.get("reproduction_n", 0)
+    aggregated["mean_reproduction"] = grand_totals["reproduction_sum"] / n if n else np.nan
+    for cell_type in ('good', 'bad'):
+        n = grand_totals.get(f"alive_time_n_{cell_type}", 0)
+        total = grand_totals.get(f"alive_time_sum_{cell_type}", 0)
+        aggregated[f"mean_alive_time_{cell_type}"] = total / n if n else np.nan
+        aggregated[f"total_alive_time_{cell_type}"] = total
+    aggregated.update(grand_death_counts)
+    all_columns_data['Aggregated'] = aggregated
+
+    df = pd.DataFrame(all_columns_data)
+    # Ensure the order of metrics (rows) and add any missing metric rows with NaN
+    df = df.reindex(METRIC_KEYS)
+    df = df.reset_index().rename(columns={'index': 'Metric'})
+    df.to_csv(csv_path, index=False, sep=';', decimal=',')
+
+
+def save_timeframe_aggregated_data(results, csv_path, timeframe_name="Timeframe"):
+    """
+    Save aggregated data for a specific timeframe from the timeframe metrics of the trials.
+    Output format is similar to save_aggregated_trial_data.
+    """
+    import pandas as pd
+    all_columns_data = {}
+    trial_metrics = []
+    for result in sorted(results, key=lambda r: r['trial']):
+        all_columns_data[f"Trial {result['trial']}"] = result['timeframe_metrics']
+        trial_metrics.append(result['timeframe_metrics'])
+
+    aggregated = {}
+    for key in TIMEFRAME_METRIC_KEYS:
+        values = [m.get(key, np.nan) for m in trial_metrics]
+        valid_values = [v for v in values if not np.isnan(v)]
+        if key.startswith("total_death_counts") or key.startswith("total_alive_time"):
+            # Sum-based metrics (total deaths, total alive time sum)
+            aggregated[key] = sum(valid_values)
+        else:
+            # Average of the per-trial means and of the alive counts at timeframe end
+            aggregated[key] = np.mean(valid_values) if valid_values else np.nan
+    all_columns_data['Aggregated'] = aggregated
+
+    df = pd.DataFrame(all_columns_data, columns=list(all_columns_data))
+    df = df.reindex(TIMEFRAME_METRIC_KEYS)
+    df = df.reset_index().rename(columns={'index': 'Metric'})
+    df.to_csv(csv_path, index=False, sep=';', decimal=',')
+    print(f"{timeframe_name} aggregated data saved to {csv_path}")
+
+
+def run_trials(parameters, trials, seed=None, processes=None, output_dir=".",
+               threads_per_process=None, profile=False):
+    """
+    Run `trials` trials of one parameter set in a pool of `processes` worker processes
+    and return their results, ordered by trial. The CSV files in output_dir are
+    updated as trials finish.
+    """
+    p = {**DEFAULT_PARAMETERS, **parameters}
+    os.makedirs(output_dir, exist_ok=True)
+    processes = processes or os.cpu_count()
+    if threads_per_process is None:
+        # Share the cores between the workers instead of oversubscribing them.
+        threads_per_process = max(1, os.cpu_count() // processes)
+    seeds = trial_seeds(seed, trials)
+    aggregated_csv = os.path.join(output_dir, "aggregated_trial_data.csv")
+    timeframe_csv = os.path.join(
+        output_dir, f"timeframe_aggregated_data_{p['timeframe_start']}_{p['timeframe_end']}.csv")
+
+    results = []
+    # Numba's thread pool is not fork-safe, so the workers are started fresh.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+        futures = [pool.submit(run_trial, parameters, seeds[i], i + 1, output_dir,
+                               threads_per_process, profile=profile)
+                   for i in range(trials)]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(f"Trial {result['trial']}/{trials} finished after {result['steps']} steps "
+                  f"({len(results)}/{trials} done).")
+            save_aggregated_trial_data(results, aggregated_csv)
+            save_timeframe_aggregated_data(
+                results, timeframe_csv,
+                timeframe_name=f"Timeframe ({p['timeframe_start']}-{p['timeframe_end']})")
+    return sorted(results, key=lambda r: r['trial'])
+
+
+def make_ensemble(parameters, seeds, seed=None):
+    """
+    Build an Ensemble with one replica per trial seed in `seeds`. The initial grid of
+    every replica is the one make_simulation would build after seed_everything with
+    its trial seed; the replica streams are derived from `seed`.
+    """
+    from Ensemble_3d import Ensemble
+    p = {**DEFAULT_PARAMETERS, **parameters}
+    initial_grids = []
+    for trial_seed in seeds:
+        seed_everything(trial_seed)
+        initial_grids.append(initialize_3d_grid_random_positions(
+            p['grid_size'], p['grid_height'], p['num_good_patches'], p['num_bad_patches']))
+    return Ensemble(
+        p['grid_size'], p['grid_height'], np.array(initial_grids), seed=seed,
+        steps_per_time_unit=p['steps_per_time_unit'],
+        antibiotics_interval=p['antibiotics_interval'],
+        antibiotics_steps=p['antibiotics_steps'], dump_strat=p['dump_strat'],
+        dump_size=p['dump_size'], concentration=p['concentration'],
+        antibiotics_concentrations=p['antibiotics_concentrations'],
+        food_interval=p['food_interval'], food_dump_strat=p['food_dump_strat'],
+        food_dump_size=p['food_dump_size'], amount=p['amount'],
+        resource_steps_per_time_unit=p['resource_steps_per_time_unit'], dx=p['dx'],
+        D_antibiotics=p['D_antibiotics'], D_food=p['D_food'],
+        D_antibiotics_multiplyer=p['D_antibiotics_multiplyer'],
+        D_food_multiplyer=p['D_food_multiplyer'],
+        timeframe=(p['timeframe_start'], p['timeframe_end']))
+
+
+def run_ensemble(parameters, trials, seed=None, output_dir=".", threads=None):
+    """
+    Run `trials` trials of one parameter set as the replicas of one Ensemble in this
+    process and return their results, ordered by trial. The initial grid of every
+    trial is the one run_trial would build from its seed; the cells then draw from
+    the replica streams of the ensemble. The engine and diffusion parameters are
+    ignored: the ensemble follows the "arrays" engine with the explicit stencil.
+    """
+    if threads is not None:
+        import numba
+        numba.set_num_threads(threads)
+    p = {**DEFAULT_PARAMETERS, **parameters}
+    os.makedirs(output_dir, exist_ok=True)
+    seeds = trial_seeds(seed, trials)
+    ensemble = make_ensemble(p, seeds, seed=seed)
+
+    keep_simulating = True
+    while keep_simulating:
+        keep_simulating = ensemble.advance()
+        if p['max_steps'] is not None and ensemble.steps >= p['max_steps']:
+            keep_simulating = False
+
+    results = ensemble.trial_results(seeds=seeds)
+    for i, result in enumerate(results):
+        save_step_summaries(ensemble.replica(i),
+                            os.path.join(output_dir, f"trial{result['trial']}_data.csv"))
+    save_aggregated_trial_data(results, os.path.join(output_dir, "aggregated_trial_data.csv"))
+    save_timeframe_aggregated_data(
+        results, os.path.join(output_dir, f"timeframe_aggregated_data_{p['timeframe_start']}_"
+                                          f"{p['timeframe_end']}.csv"),
+        timeframe_name=f"Timeframe ({p['timeframe_start']}-{p['timeframe_end']})")
+    return results
+
+
+def parse_parameters(items):
+    """
+    Parse key=value strings; values are python literals, or plain strings otherwise.
+    """
+    parameters = {}
+    for item in items:
+        key, _, value = item.partition("=")
+        if key not in DEFAULT_PARAMETERS:
+            raise ValueError(f"Unknown parameter: {key}")
+        try:
+            parameters[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            parameters[key] = value
+    return parameters
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run trials of the 3D bacterial growth simulation.")
+    parser.add_argument("--trials", type=int, default=1, help="number of trials")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the trial seeds")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="number of worker processes (default: all cores)")
+    parser.add_argument("--threads-per-process", type=int, default=None,
+                        help="numba threads per worker (default: cores / processes)")
+    parser.add_argument("--output-dir", default=".", help="directory for the CSV files")
+    parser.add_argument("--params-json", default=None,
+                        help="JSON file with parameters (overridden by --param)")
+    parser.add_argument("--param", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a parameter, e.g. --param dump_strat='\"middle\"'")
+    parser.add_argument("--profile", action="store_true",
+                        help="save the time of the phases of every trial (Profiler_3d.py)")
+    parser.add_argument("--ensemble", action="store_true",
+                        help="run the trials as the replicas of one Ensemble (Ensemble_3d.py) "
+                             "in this process")
+    args = parser.parse_args(argv)
+
+    parameters = {}
+    if args.params_json is not None:
+        with open(args.params_json) as f:
+            parameters.update(json.load(f))
+    parameters.update(parse_parameters(args.param))
+    if args.ensemble:
+        run_ensemble(parameters, args.trials, seed=args.seed, output_dir=args.output_dir,
+                     threads=args.threads_per_process)
+        return
+    run_trials(parameters, args.trials, seed=args.seed, processes=args.processes,
+               output_dir=args.output_dir, threads_per_process=args.threads_per_process,
+               profile=args.profile)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
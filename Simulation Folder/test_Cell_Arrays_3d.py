@@ -0,0 +1,86 @@
+import numpy as np
+from Simulation_3d import simulate
+from Trial_Runner_3d import make_simulation, seed_everything
+
+SIZE = 12
+TIMER_FIELDS = ('lambd', 'death_date', 'alive_time', 'reproduction_timer')
+
+
+def full_grid_sim(engine):
+    # A grid without empty positions and without antibiotics: no cell can reproduce
+    # and no random number decides anything after the initial timers.
+    rng = np.random.default_rng(0)
+    init = rng.choice([1, -1], size=SIZE**3)
+    seed_everything(0)
+    return simulate(SIZE, SIZE, init, steps_per_time_unit=2, grid_history_interval=None,
+                    antibiotics_steps=[], antibiotics_interval=10**6, food_interval=10**6,
+                    food_dump_strat="", amount=0.6, dx=1, D_food=0.02, D_antibiotics=0.02,
+                    engine=engine)
+
+
+def sorted_deaths(bookkeeper):
+    deaths = bookkeeper.deaths
+    order = np.lexsort((deaths['cause'], deaths['cell_index'], deaths['step']))
+    return {name: deaths[name][order] for name in deaths.dtypes}
+
+
+def test_arrays_follow_cell_step():
+    cells = full_grid_sim("cells")
+    arrays = full_grid_sim("arrays")
+    # Same initial timers, so both engines have to take the same steps
+    for name in TIMER_FIELDS:
+        getattr(arrays.grid, name)[:] = [getattr(cell, name) for cell in cells.grid]
+
+    for _ in range(12):
+        cells.advance()
+        arrays.advance()
+        assert np.array_equal(cells.get_states(), arrays.get_states())
+        assert np.array_equal(cells.resources.food, arrays.resources.food)
+        assert cells.bookkeeper.counts == arrays.bookkeeper.counts
+
+    assert cells.bookkeeper.death_counts == arrays.bookkeeper.death_counts
+    assert cells.bookkeeper.death_counts['good']['age'] > 0
+    assert cells.bookkeeper.death_counts['good']['food'] > 0
+    expected = sorted_deaths(cells.bookkeeper)
+    actual = sorted_deaths(arrays.bookkeeper)
+    for name in expected:
+        assert np.array_equal(expected[name], actual[name]), name
+    for name in TIMER_FIELDS:
+        values = np.array([np.nan if getattr(cell, name) is None else getattr(cell, name)
+                           for cell in cells.grid])
+        assert np.array_equal(values, getattr(arrays.grid, name), equal_nan=True), name
+
+
+# Patches of both kinds with a dose of antibiotics and little food, so cells
+# reproduce, die of age, antibiotics and hunger
+STATISTICS_PARAMETERS = dict(grid_size=SIZE, grid_height=SIZE, num_good_patches=3,
+                             num_bad_patches=2, resource_steps_per_time_unit=4, dx=1,
+                             D_food=0.02, D_antibiotics=0.02, diffusion_backend="stencil",
+                             dump_strat="middle", dump_size=6, antibiotics_steps=[8],
+                             antibiotics_concentrations=[0.5], amount=0.3)
+
+
+def final_counts(engine, seeds=range(12), time_units=20):
+    rows = []
+    for seed in seeds:
+        seed_everything(seed)
+        sim = make_simulation({**STATISTICS_PARAMETERS, 'engine': engine})
+        while sim.steps < time_units and sim.advance():
+            pass
+        counts = sim.bookkeeper.counts
+        deaths = sim.bookkeeper.death_counts
+        rows.append([counts['alive_good'], counts['alive_bad'],
+                     sum(deaths['good'].values()), sum(deaths['bad'].values()),
+                     deaths['good']['antibiotics'] + deaths['bad']['antibiotics'],
+                     deaths['good']['food'] + deaths['bad']['food']])
+    return np.array(rows, dtype=np.float64)
+
+
+def test_arrays_match_cells_in_distribution():
+    # The live list changes the visiting order, so only the distribution is kept
+    cells = final_counts("cells")
+    arrays = final_counts("arrays")
+    assert cells[:, 4].min() > 0 and cells[:, 5].min() > 0
+    standard_error = np.sqrt(cells.var(axis=0, ddof=1) / len(cells) +
+                             arrays.var(axis=0, ddof=1) / len(arrays))
+    assert np.all(np.abs(cells.mean(axis=0) - arrays.mean(axis=0)) <= 3 * standard_error)
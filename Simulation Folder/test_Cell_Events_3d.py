@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from Trial_Runner_3d import make_simulation, seed_everything
+
+SIZE = 12
+# Patches of both kinds with a dose of antibiotics
+PARAMETERS = dict(grid_size=SIZE, grid_height=SIZE, num_good_patches=3, num_bad_patches=2,
+                  resource_steps_per_time_unit=4, dx=1, D_food=0.02, D_antibiotics=0.02,
+                  diffusion_backend="stencil", dump_strat="middle", dump_size=6,
+                  antibiotics_steps=[8], antibiotics_concentrations=[0.5])
+
+
+def final_alive_counts(engine, amount, seeds=range(16), time_units=20):
+    rows = []
+    for seed in seeds:
+        seed_everything(seed)
+        sim = make_simulation({**PARAMETERS, 'engine': engine, 'amount': amount})
+        while sim.steps < time_units and sim.advance():
+            pass
+        counts = sim.bookkeeper.counts
+        rows.append([counts['alive_good'], counts['alive_bad']])
+    return np.array(rows, dtype=np.float64)
+
+
+# With and without food-limited growth
+@pytest.mark.parametrize("amount", [10, 0.3])
+def test_events_match_arrays_in_distribution(amount):
+    # Only the final counts are compared: the sub-steps of the array engine round
+    # the event times, which changes the turnover (births and deaths) of a run
+    # until the sub-steps are much shorter than a reproduction time.
+    arrays = final_alive_counts("arrays", amount)
+    events = final_alive_counts("events", amount)
+    assert arrays.mean(axis=0).min() > 0
+    standard_error = np.sqrt(arrays.var(axis=0, ddof=1) / len(arrays) +
+                             events.var(axis=0, ddof=1) / len(events))
+    assert np.all(np.abs(arrays.mean(axis=0) - events.mean(axis=0)) <= 3 * standard_error)
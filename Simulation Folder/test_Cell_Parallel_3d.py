@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+import numpy as np
+from Checkpoint_3d import load_checkpoint
+from Simulation_3d import initialize_3d_grid_random_positions, simulate
+
+SIZE = 12
+PARAMETERS = dict(grid_history_interval=None, engine="parallel", seed=1, dx=1.0,
+                  D_food=0.01, D_antibiotics=0.01, resource_steps_per_time_unit=4,
+                  steps_per_time_unit=2, antibiotics_steps=[4])
+
+# Runs the parallel engine with 1 and with 4 numba threads in a fresh process, as
+# the number of threads is fixed when numba starts; prints whether they agree.
+THREADS_SCRIPT = """
+import hashlib
+import numba
+import numpy as np
+from Simulation_3d import initialize_3d_grid_random_positions, simulate
+
+def run_hash(threads):
+    numba.set_num_threads(threads)
+    np.random.seed(2)
+    init = initialize_3d_grid_random_positions({size}, {size}, 3, 2)
+    sim = simulate({size}, {size}, init, **{parameters!r})
+    for _ in range(10):
+        sim.advance()
+    digest = hashlib.sha256()
+    for values in (sim.get_states(), sim.resources.food, sim.resources.antibiotics,
+                   sim.bookkeeper.deaths['cell_index'], sim.bookkeeper.deaths['alive_time']):
+        digest.update(np.ascontiguousarray(values).tobytes())
+    digest.update(repr(sim.bookkeeper.counts).encode())
+    return digest.hexdigest(), sim.grid.n_live
+
+single, n_live = run_hash(1)
+multiple, _ = run_hash(4)
+print(numba.get_num_threads(), n_live > 0, single == multiple)
+"""
+
+
+def empty_sim(**options):
+    return simulate(SIZE, SIZE, np.zeros(SIZE**3, dtype=np.int64), **PARAMETERS, **options)
+
+
+def test_empty_grid():
+    sim = empty_sim()
+    for _ in range(3):
+        sim.advance()
+    assert sim.grid.n_live == 0
+    assert not np.any(sim.get_states())
+
+
+def test_restore_without_alive_cells(tmp_path):
+    sim = empty_sim(checkpoint_path=tmp_path / "run.ckpt.npz", checkpoint_interval=2)
+    for _ in range(2):
+        sim.advance()
+    restored = load_checkpoint(tmp_path / "run.ckpt.npz")
+    for _ in range(3):
+        sim.advance()
+        restored.advance()
+    assert np.array_equal(sim.resources.food, restored.resources.food)
+    assert np.array_equal(sim.resources.antibiotics, restored.resources.antibiotics)
+
+
+def test_results_do_not_depend_on_threads():
+    env = {**os.environ, 'NUMBA_NUM_THREADS': "4", 'NUMBA_THREADING_LAYER': "workqueue"}
+    script = THREADS_SCRIPT.format(size=SIZE, parameters=PARAMETERS)
+    result = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True,
+                            text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split() == ["4", "True", "True"]
@@ -0,0 +1,98 @@
+import random
+import numpy as np
+import pytest
+import Checkpoint_3d
+from Checkpoint_3d import load_checkpoint
+from Trial_Runner_3d import make_simulation, seed_everything
+
+SIZE = 12
+PARAMETERS = dict(grid_size=SIZE, grid_height=SIZE, diffusion_backend="stencil",
+                  resource_steps_per_time_unit=4, dx=1, D_food=0.02, D_antibiotics=0.02,
+                  dump_size=4, food_dump_size=4, dump_strat="middle", antibiotics_steps=[3],
+                  grid_interval=2, steps_per_time_unit=3, timeframe_start=2, timeframe_end=8)
+
+
+def seeded_sim(engine, solver, history_path=None):
+    seed_everything(5)
+    return make_simulation({**PARAMETERS, 'engine': engine, 'diffusion_solver': solver},
+                           history_path=history_path)
+
+
+def run_state(sim):
+    deaths = sim.bookkeeper.deaths
+    return {'states': sim.get_states().copy(), 'food': sim.resources.food.copy(),
+            'antibiotics': sim.resources.antibiotics.copy(),
+            'counts': dict(sim.bookkeeper.counts), 'death_steps': deaths['step'].copy(),
+            'alive_times': deaths['alive_time'].copy(),
+            'timeframe_metrics': str(sim.bookkeeper.timeframe_metrics(*sim.timeframe))}
+
+
+def assert_restore_is_identical(engine, solver, tmp_path, history=False):
+    reference = seeded_sim(engine, solver, tmp_path / "reference" if history else None)
+    for _ in range(12):
+        reference.advance()
+
+    sim = seeded_sim(engine, solver, tmp_path / "run" if history else None)
+    for _ in range(5):
+        sim.advance()
+    sim.save_checkpoint(tmp_path / "run.ckpt.npz")
+    # Run on and draw from every generator, which the restore has to undo
+    for _ in range(3):
+        sim.advance()
+    random.random()
+    np.random.random()
+
+    restored = load_checkpoint(tmp_path / "run.ckpt.npz")
+    for _ in range(7):
+        restored.advance()
+
+    expected = run_state(reference)
+    actual = run_state(restored)
+    for name, value in expected.items():
+        if isinstance(value, np.ndarray):
+            assert np.array_equal(value, actual[name]), name
+        else:
+            assert value == actual[name], name
+    assert len(reference.grid_history) == len(restored.grid_history)
+    for expected_food, food in zip(reference.food_history, restored.food_history):
+        assert np.array_equal(np.asarray(expected_food), np.asarray(food))
+
+
+@pytest.mark.parametrize("engine", ["cells", "arrays", "events", "parallel"])
+def test_restore_is_identical(engine, tmp_path):
+    assert_restore_is_identical(engine, "explicit", tmp_path)
+
+
+@pytest.mark.parametrize("solver", ["cfl", "implicit"])
+def test_restore_is_identical_with_solver(solver, tmp_path):
+    assert_restore_is_identical("arrays", solver, tmp_path)
+
+
+@pytest.mark.parametrize("engine", ["arrays", "events"])
+def test_restore_is_identical_with_history_store(engine, tmp_path):
+    assert_restore_is_identical(engine, "explicit", tmp_path, history=True)
+
+
+def test_checkpoints_write_only_new_history(tmp_path):
+    path = tmp_path / "run.ckpt.npz"
+    sim = seeded_sim("arrays", "explicit")
+    for _ in range(4):
+        sim.advance()
+    sim.save_checkpoint(path)
+    for _ in range(4):
+        sim.advance()
+    sim.save_checkpoint(path)
+    first = np.load(tmp_path / "run.ckpt.npz.history0.npz")['states']
+    second = np.load(tmp_path / "run.ckpt.npz.history1.npz")['states']
+    assert len(first) + len(second) == len(sim.grid_history)
+    assert np.array_equal(second, np.array(sim.grid_history[len(first):]))
+
+    restored = load_checkpoint(path)
+    assert restored.grid_history == sim.grid_history
+    assert restored.food_history == sim.food_history
+
+
+def test_missing_numba_random_state_raises(monkeypatch, tmp_path):
+    monkeypatch.setattr(Checkpoint_3d, "_helperlib", None)
+    with pytest.raises(RuntimeError, match="numba._helperlib"):
+        seeded_sim("arrays", "explicit").save_checkpoint(tmp_path / "run.ckpt.npz")
@@ -0,0 +1,70 @@
+import numpy as np
+from Distributed_3d import DistributedSimulation
+from Simulation_3d import simulate
+from Trial_Runner_3d import seed_everything
+
+SIZE = 12
+PARAMETERS = dict(steps_per_time_unit=2, antibiotics_steps=[5], food_interval=7,
+                  antibiotics_interval=9)
+
+
+def initial_states():
+    return np.random.default_rng(0).choice([0, 1, -1], size=SIZE**3, p=[0.9, 0.05, 0.05])
+
+
+def test_single_worker_matches_simulate():
+    seed_everything(3)
+    sim = simulate(SIZE, SIZE, initial_states(), grid_history_interval=None,
+                   engine="arrays", diffusion_backend="stencil", **PARAMETERS)
+    with DistributedSimulation(SIZE, SIZE, initial_states(), workers=1, seed=3,
+                               threads_per_worker=1, **PARAMETERS) as distributed:
+        for _ in range(20):
+            assert sim.advance() == distributed.advance()
+            assert np.array_equal(sim.get_states(), distributed.get_states())
+            assert np.array_equal(sim.resources.food, distributed.resources.food)
+        for name in ('alive_good', 'alive_bad'):
+            assert np.array_equal(sim.bookkeeper.summaries[name],
+                                  distributed.bookkeeper.summaries[name])
+        assert sim.bookkeeper.death_counts == distributed.bookkeeper.death_counts
+
+
+def run_three_workers(seed, time_units=12):
+    with DistributedSimulation(SIZE, SIZE, initial_states(), workers=3, seed=seed,
+                               threads_per_worker=1, **PARAMETERS) as distributed:
+        states = []
+        for _ in range(time_units):
+            distributed.advance()
+            published = distributed.get_states()
+            counts = distributed.bookkeeper.counts
+            for state, name in ((1, 'alive_good'), (-1, 'alive_bad'), (2, 'dead_good'),
+                                (-2, 'dead_bad')):
+                assert counts[name] == np.count_nonzero(published == state), name
+            states.append(published.copy())
+        layers = distributed.bookkeeper.births['cell_index'] // SIZE**2
+        # Cells were born on both sides of the slab boundaries (layers 3|4 and 7|8)
+        assert set(layers) >= {3, 4, 7, 8}
+        return states, distributed.resources.food.copy(), distributed.bookkeeper.death_counts
+
+
+def test_three_workers_are_consistent_and_reproducible():
+    states, food, death_counts = run_three_workers(seed=4)
+    repeated_states, repeated_food, repeated_death_counts = run_three_workers(seed=4)
+    assert all(np.array_equal(a, b) for a, b in zip(states, repeated_states))
+    assert np.array_equal(food, repeated_food)
+    assert death_counts == repeated_death_counts
+
+
+def test_three_workers_conserve_food_without_cells():
+    parameters = dict(antibiotics_steps=[], antibiotics_interval=1000, food_interval=1000,
+                      food_dump_strat="middle", food_dump_size=4, amount=10, dx=1,
+                      D_food=0.02, D_antibiotics=0.02)
+    with DistributedSimulation(SIZE, SIZE, np.zeros(SIZE**3, dtype=int), workers=3, seed=1,
+                               threads_per_worker=1, **parameters) as distributed:
+        food = distributed.resources.food
+        total = food.sum()
+        start = food.copy()
+        for _ in range(10):
+            distributed.advance()
+        assert not np.array_equal(food, start)  # the food spread over the slabs
+        assert np.count_nonzero(food.reshape(SIZE, SIZE, SIZE)[0]) > 0
+        assert np.isclose(food.sum(), total, rtol=1e-12)
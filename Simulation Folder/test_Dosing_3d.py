@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from Dosing_3d import DosingSchedule, add_dose, strategy_amount, strategy_indices
+
+SIZE = 12
+HEIGHT = 12
+STRATEGIES = ["middle", "quarters", "corner", "uniform", ""]
+
+
+def loop_dose(field, amount, dump_size, dump_strat, n=SIZE, height=HEIGHT):
+    # The nested loops of the former simulate.add_antibiotics and add_food
+    if dump_strat == "middle":
+        start = round(n/2) - int(np.floor(dump_size/2))
+        end = round(n/2) + int(np.ceil(dump_size/2))
+        rows = range(start, end)
+        cols = range(start, end)
+    elif dump_strat == "quarters":
+        rows = []
+        cols = []
+        for factor in [1, 3]:
+            r_start = round(factor * n/4) - int(np.floor(dump_size/4))
+            r_end = round(factor * n/4) + int(np.ceil(dump_size/4))
+            rows.extend(range(r_start, r_end))
+            cols.extend(range(r_start, r_end))
+        rows = sorted(set(rows))
+        cols = sorted(set(cols))
+    elif dump_strat == "corner":
+        rows = range(dump_size)
+        cols = range(dump_size)
+    elif dump_strat == "uniform":
+        rows = range(n)
+        cols = range(n)
+        amount = amount * ((2 * dump_size)**2) / (n**2)
+    else:
+        rows = range(n)
+        cols = range(n)
+    for z in range(height):
+        for r in rows:
+            for c in cols:
+                field[z * n * n + r * n + c] += amount
+
+
+def loop_step_doses(resources, step, antibiotics_steps, antibiotics_concentrations,
+                    antibiotics_interval, concentration, dump_size, dump_strat,
+                    food_interval, amount, food_dump_size, food_dump_strat):
+    # The dosing at the end of the former simulate.step
+    if step in antibiotics_steps:
+        step_idx = antibiotics_steps.index(step)
+        loop_dose(resources.antibiotics, antibiotics_concentrations[step_idx], dump_size,
+                  dump_strat)
+    if step % antibiotics_interval == 0:
+        loop_dose(resources.antibiotics, concentration, dump_size, dump_strat)
+    if step % food_interval == 0:
+        loop_dose(resources.food, amount, food_dump_size, food_dump_strat)
+
+
+def random_field(seed=0):
+    return np.random.default_rng(seed).random(SIZE * SIZE * HEIGHT)
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES)
+@pytest.mark.parametrize("dump_size", [0, 3, 4, 7, 12])
+def test_dose_matches_loops(strategy, dump_size):
+    expected = random_field()
+    loop_dose(expected, 0.3, dump_size, strategy)
+    field = random_field()
+    indices, unique = strategy_indices(strategy, SIZE, HEIGHT, dump_size)
+    add_dose(field, indices, strategy_amount(strategy, 0.3, SIZE, dump_size), unique)
+    assert np.array_equal(field, expected)
+
+
+@pytest.mark.parametrize("strategy", ["middle", "corner"])
+def test_oversized_dump_raises_like_loops(strategy):
+    with pytest.raises(IndexError):
+        loop_dose(random_field(), 0.3, 14, strategy)
+    with pytest.raises(IndexError):
+        strategy_indices(strategy, SIZE, HEIGHT, 14)
+
+
+def test_schedule_matches_step_doses():
+    # A repeated step counts once, with its first concentration
+    parameters = dict(antibiotics_steps=[3, 6, 3, 10],
+                      antibiotics_concentrations=[0.5, 0.2, 0.9, 0.1],
+                      antibiotics_interval=5, concentration=0.3, dump_size=4,
+                      dump_strat="quarters", food_interval=4, amount=2.0, food_dump_size=3,
+                      food_dump_strat="uniform")
+    schedule = DosingSchedule.from_parameters(SIZE, HEIGHT, **parameters)
+    expected = SimpleNamespace(antibiotics=random_field(0), food=random_field(1))
+    actual = SimpleNamespace(antibiotics=random_field(0), food=random_field(1))
+    for step in range(25):
+        loop_step_doses(expected, step, **parameters)
+        schedule.apply(step, actual)
+        assert np.array_equal(actual.antibiotics, expected.antibiotics), step
+        assert np.array_equal(actual.food, expected.food), step
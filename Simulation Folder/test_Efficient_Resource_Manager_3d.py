@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+from Efficient_Resource_Manager_3d import ResourceManager
+
+SIZE = 12
+# dx, D_antibiotics and resource steps of the notebook; its D_food of 1 would need
+# about 10^12 explicit steps per time unit at this dx, so food uses D_antibiotics too.
+DX = 0.000002
+D = 0.0000000001
+STEPS = 160
+
+
+def random_resources(backend, solver="explicit", seed=0):
+    rm = ResourceManager(SIZE, SIZE, STEPS, DX, D, D, 0.5, 0.5,
+                         diffusion_backend=backend, solver=solver)
+    rng = np.random.default_rng(seed)
+    rm.food[:] = rng.random(rm.num_cells) * 10
+    rm.antibiotics[:] = rng.random(rm.num_cells)
+    rm.update_D(rng.choice([0, 0, 1, -1, 2], size=rm.num_cells))
+    return rm, rng
+
+
+@pytest.mark.parametrize("solver", ["explicit", "cfl"])
+@pytest.mark.parametrize("coefficients", ["states", "random"])
+def test_stencil_matches_neighbor_lists(solver, coefficients):
+    managers = []
+    for backend in ("neighbors", "stencil"):
+        rm, rng = random_resources(backend, solver)
+        if coefficients == "random":
+            # A different D in every position, not only the two of update_D
+            rm.D_food_arr[:] = D * rng.uniform(0.1, 1.0, rm.num_cells)
+            rm.D_antibiotics_arr[:] = D * rng.uniform(0.1, 1.0, rm.num_cells)
+            rm.rebuild_faces()
+        managers.append(rm)
+    neighbors, stencil = managers
+    initial = neighbors.food.copy()
+    for _ in range(3):
+        neighbors.diffusion_step()
+        stencil.diffusion_step()
+    assert not np.allclose(neighbors.food, initial, rtol=1e-3)
+    assert np.allclose(neighbors.food, stencil.food, rtol=1e-12, atol=1e-12)
+    assert np.allclose(neighbors.antibiotics, stencil.antibiotics, rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize("backend", ["neighbors", "stencil"])
+def test_update_D_changed_matches_update_D(backend):
+    rm, rng = random_resources(backend)
+    states = np.zeros(rm.num_cells, dtype=np.int64)
+    rm.update_D(states)
+    born = rng.choice(rm.num_cells, size=200, replace=False)
+    states[born] = rng.choice([1, -1], size=len(born))
+    rm.update_D_changed(born, states[born])
+
+    reference, _ = random_resources(backend)
+    reference.update_D(states)
+    assert np.array_equal(rm.D_food_arr, reference.D_food_arr)
+    for name in ('food', 'antibiotics'):
+        for faces, expected in zip(rm.faces[name], reference.faces[name]):
+            assert np.array_equal(faces, expected)
+    rm.diffusion_step()
+    reference.diffusion_step()
+    assert np.array_equal(rm.food, reference.food)
+    assert np.array_equal(rm.antibiotics, reference.antibiotics)
+
+
+@pytest.mark.parametrize("solver", ["cfl", "implicit"])
+def test_solvers_match_fine_explicit_steps(solver):
+    reference, _ = random_resources("stencil")
+    reference.substeps = 4000
+    reference.dt = 1 / reference.substeps
+    rm, _ = random_resources("stencil", solver)
+    for _ in range(3):
+        reference.diffusion_step()
+        rm.diffusion_step()
+    for name in ('food', 'antibiotics'):
+        expected = getattr(reference, name)
+        error = np.abs(getattr(rm, name) - expected).max() / np.abs(expected).max()
+        assert error <= (1e-3 if solver == "cfl" else 5 * rm.implicit_tolerance), name
+    if solver == "implicit":
+        assert rm.implicit_solves['food'] == 3 * (rm.effective_substeps['food'] +
+                                                  rm.rejected_substeps['food'])
+
+
+def test_implicit_step_has_a_lower_bound():
+    rm, _ = random_resources("stencil", "implicit")
+    rm.implicit_tolerance = 1e-15
+    rm.implicit_min_step = 1e-3
+    with pytest.raises(ValueError, match="implicit_min_step"):
+        rm.diffusion_step()
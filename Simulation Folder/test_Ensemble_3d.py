@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+from Ensemble_3d import Ensemble
+from Trial_Runner_3d import (make_ensemble, make_simulation, save_aggregated_trial_data,
+                             save_timeframe_aggregated_data, seed_everything)
+
+SIZE = 12
+STATISTICS_PARAMETERS = dict(grid_size=SIZE, grid_height=SIZE, num_good_patches=3,
+                             num_bad_patches=2, resource_steps_per_time_unit=4, dx=1,
+                             D_food=0.02, D_antibiotics=0.02, engine="arrays",
+                             diffusion_backend="stencil", dump_strat="middle", dump_size=6,
+                             antibiotics_steps=[8], antibiotics_concentrations=[0.5],
+                             amount=0.3, timeframe_start=2, timeframe_end=10)
+
+
+def count_row(bookkeeper):
+    counts = bookkeeper.counts
+    deaths = bookkeeper.death_counts
+    return [counts['alive_good'], counts['alive_bad'],
+            sum(deaths['good'].values()), sum(deaths['bad'].values()),
+            deaths['good']['antibiotics'] + deaths['bad']['antibiotics'],
+            deaths['good']['food'] + deaths['bad']['food']]
+
+
+def final_counts(run, seeds=range(12)):
+    return np.array([count_row(run(seed)) for seed in seeds], dtype=np.float64)
+
+
+def simulate_run(seed, time_units=20):
+    seed_everything(seed)
+    sim = make_simulation(STATISTICS_PARAMETERS)
+    while sim.steps < time_units and sim.advance():
+        pass
+    return sim.bookkeeper
+
+
+def ensemble_run(seed, time_units=20):
+    ensemble = make_ensemble(STATISTICS_PARAMETERS, [seed], seed=seed)
+    while ensemble.steps < time_units and ensemble.advance():
+        pass
+    return ensemble.bookkeepers[0]
+
+
+def test_replica_matches_simulate_in_distribution():
+    # The replica streams differ from the generators of simulate, so only the
+    # distribution is kept
+    sims = final_counts(simulate_run)
+    replicas = final_counts(ensemble_run)
+    assert replicas[:, 4].min() > 0 and replicas[:, 5].min() > 0
+    standard_error = np.sqrt(sims.var(axis=0, ddof=1) / len(sims) +
+                             replicas.var(axis=0, ddof=1) / len(replicas))
+    assert np.all(np.abs(sims.mean(axis=0) - replicas.mean(axis=0)) <= 3 * standard_error)
+
+
+def test_inactive_replicas_are_frozen():
+    grids = np.zeros((2, SIZE**3), dtype=int)
+    grids[0, ::7] = 1
+    ensemble = Ensemble(SIZE, SIZE, grids, seed=1, steps_per_time_unit=2, dx=1, D_food=0.02,
+                        D_antibiotics=0.02, dump_strat="middle", dump_size=4,
+                        antibiotics_steps=[1, 3], antibiotics_concentrations=[1, 1],
+                        food_interval=2, food_dump_strat="middle", food_dump_size=4)
+    ensemble.advance()
+    assert list(ensemble.active) == [True, False]
+    food = ensemble.food[1].copy()
+    antibiotics = ensemble.antibiotics[1].copy()
+    assert antibiotics.max() > 0
+    for _ in range(4):
+        ensemble.advance()
+    assert np.array_equal(ensemble.food[1], food)
+    assert np.array_equal(ensemble.antibiotics[1], antibiotics)
+    assert len(ensemble.bookkeepers[1].summaries) == 1
+    assert ensemble.finished_steps[1] == 1
+
+
+def test_trial_results_are_saved(tmp_path):
+    ensemble = make_ensemble(STATISTICS_PARAMETERS, [3, 4], seed=2)
+    for _ in range(12):
+        ensemble.advance()
+    results = ensemble.trial_results(seeds=[3, 4])
+    assert [result['trial'] for result in results] == [1, 2]
+    save_aggregated_trial_data(results, tmp_path / "aggregated.csv")
+    save_timeframe_aggregated_data(results, tmp_path / "timeframe.csv")
+    for name in ("aggregated.csv", "timeframe.csv"):
+        table = pd.read_csv(tmp_path / name, sep=';', decimal=',')
+        assert list(table.columns) == ["Metric", "Trial 1", "Trial 2", "Aggregated"]
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from History_Store_3d import HistoryStore
+
+SHAPE = (12, 12, 12)
+
+
+def snapshots(n, seed=0, first_step=0):
+    rng = np.random.default_rng(seed)
+    size = int(np.prod(SHAPE))
+    return [(first_step + 5 * i, rng.choice([-1, 0, 1], size=size), rng.random(size),
+             rng.random(size) * 10) for i in range(n)]
+
+
+def assert_store_holds(store, written):
+    assert len(store) == len(written)
+    assert store.steps == [step for step, *_ in written]
+    for i, (step, states, antibiotics, food) in enumerate(written):
+        assert store.states[i].dtype == np.int8
+        assert np.array_equal(store.states[i], states)
+        assert np.array_equal(store.antibiotics[i], antibiotics.astype(np.float32))
+        assert np.array_equal(store.food.at_step(step), food.astype(np.float32))
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_round_trip(tmp_path, compress):
+    written = snapshots(10)
+    store = HistoryStore(tmp_path, "w", shape=SHAPE, compress=compress, chunk_size=4)
+    for snapshot in written:
+        store.append(*snapshot)
+    assert_store_holds(store, written)
+    store.close()
+
+    # Everything is read back from the files and meta.json
+    reader = HistoryStore(tmp_path)
+    assert reader.shape == SHAPE and reader.compress == compress
+    assert_store_holds(reader, written)
+    assert np.array_equal(reader.states[-1], written[-1][1])
+    assert len(reader.food[2:5]) == 3
+    assert np.array_equal(reader.states.grid(3), written[3][1].reshape(SHAPE))
+    assert np.array_equal(reader.food.layer(7, 4),
+                          written[7][3].astype(np.float32).reshape(SHAPE)[4])
+    with pytest.raises(IndexError):
+        reader.states[10]
+    with pytest.raises(ValueError):
+        reader.append(*written[0])
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_truncate_on_restore(tmp_path, compress):
+    written = snapshots(10)
+    store = HistoryStore(tmp_path, "w", shape=SHAPE, compress=compress, chunk_size=4)
+    for snapshot in written:
+        store.append(*snapshot)
+    store.close()
+
+    # A restored run drops the snapshots after its checkpoint and writes on
+    resumed = HistoryStore(tmp_path, "a")
+    resumed.truncate(6)  # inside the second chunk when compressed
+    replaced = snapshots(3, seed=1, first_step=30)
+    for snapshot in replaced:
+        resumed.append(*snapshot)
+    resumed.close()
+    assert_store_holds(HistoryStore(tmp_path), written[:6] + replaced)
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from Observers_3d import LayerTotals, Observer, ZProjection
+from Trial_Runner_3d import make_simulation, seed_everything
+
+PARAMETERS = dict(grid_size=12, grid_height=12, engine="arrays", diffusion_backend="stencil",
+                  resource_steps_per_time_unit=4, dx=1, D_food=0.02, D_antibiotics=0.02,
+                  grid_interval=None, timeframe_start=1, timeframe_end=3)
+
+
+class StepObserver(Observer):
+    def compute(self, sim):
+        return sim
+
+
+def observe_steps(observer, steps, forced=()):
+    for step in steps:
+        observer.observe(step, step, force=step in forced)
+    return list(observer.steps)
+
+
+def test_thinning_keeps_the_cadence():
+    observer = StepObserver(every=1, max_records=4)
+    assert observe_steps(observer, range(10)) == [0, 4, 8]
+    assert observer.every == 4
+    assert len(observer.records) <= 4
+
+
+def test_forced_records_survive_thinning():
+    observer = StepObserver(every=2, max_records=4)
+    # Step 6 fills the observer, which doubles its cadence to 4 and keeps step 5
+    assert observe_steps(observer, range(8), forced={5}) == [0, 4, 5]
+    assert observe_steps(observer, range(8, 20), forced={19}) == [0, 5, 16, 19]
+    assert observer.every == 16
+    assert [value for _, value in observer.records] == list(observer.steps)
+
+
+def test_observe_validates_its_arguments():
+    with pytest.raises(ValueError):
+        StepObserver(every=0)
+    with pytest.raises(ValueError):
+        StepObserver(max_records=1)
+
+
+def test_reductions_match_the_grid():
+    seed_everything(2)
+    projection = ZProjection(every=2)
+    layers = LayerTotals(every=1)
+    sim = make_simulation({**PARAMETERS, 'observers': [projection, layers]})
+    for _ in range(5):
+        sim.advance()
+    sim.observe(force=True)
+    assert list(projection.steps) == [0, 2, 4, 5]
+    assert list(layers.steps) == [0, 1, 2, 3, 4, 5]
+
+    shape = (sim.grid_height, sim.grid_size, sim.grid_size)
+    states = np.asarray(sim.get_states()).reshape(shape)
+    last = projection.records[-1][1]
+    assert np.array_equal(last['alive_good'], (states == 1).sum(axis=0))
+    assert np.array_equal(last['dead_bad'], (states == -2).sum(axis=0))
+    assert np.allclose(last['food'], sim.resources.food.reshape(shape).mean(axis=0))
+    assert np.allclose(layers.compute(sim)['food'],
+                       sim.resources.food.reshape(shape).sum(axis=(1, 2)))
+    assert layers.stacked('food').shape == (6, sim.grid_height)
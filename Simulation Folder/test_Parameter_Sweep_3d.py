@@ -0,0 +1,52 @@
+import shutil
+from Parameter_Sweep_3d import (ResultCache, code_version, job_key, query, run_sweep,
+                                step_summaries, sweep_jobs)
+
+BASE = dict(grid_size=12, grid_height=12, engine="arrays", diffusion_backend="stencil",
+            resource_steps_per_time_unit=4, dx=1, D_food=0.02, D_antibiotics=0.02,
+            max_steps=6, timeframe_start=1, timeframe_end=5)
+
+
+def test_job_key():
+    version = code_version()
+    key = job_key(BASE, 1, version)
+    assert job_key(dict(BASE), 1, version) == key
+    assert job_key({**BASE, 'concentration': 0.1}, 1, version) != key
+    assert job_key(BASE, 2, version) != key
+    assert job_key(BASE, 1, "other version") != key
+    # Output options do not change the results
+    for option in ({'grid_interval': 5}, {'verbose': True}, {'checkpoint_interval': 2},
+                   {'history_compress': True}, {'profile': True}):
+        assert job_key({**BASE, **option}, 1, version) == key
+
+
+def test_sweep_resumes_from_cache(tmp_path, capsys):
+    cache_dir = str(tmp_path / "cache")
+    space = {'concentration': [0.1, 0.3]}
+    records = run_sweep(space, trials=1, seed=1, cache_dir=cache_dir, base=BASE, processes=1,
+                        threads_per_process=1)
+    assert "2 jobs, 0 cached, 2 to run." in capsys.readouterr().out
+    assert [record['parameters']['concentration'] for record in records] == [0.1, 0.3]
+
+    # Nothing left to run; an interrupted sweep only runs its missing jobs
+    assert run_sweep(space, trials=1, seed=1, cache_dir=cache_dir, base=BASE) == records
+    assert "2 jobs, 2 cached, 0 to run." in capsys.readouterr().out
+    shutil.rmtree(ResultCache(cache_dir).entry_path(records[1]['key']))
+    resumed = run_sweep({'concentration': [0.1, 0.3, 0.5]}, trials=1, seed=1,
+                        cache_dir=cache_dir, base=BASE, processes=1, threads_per_process=1)
+    assert "3 jobs, 1 cached, 2 to run." in capsys.readouterr().out
+    assert resumed[:2] == records
+
+    table = query(cache_dir)
+    assert sorted(table['param_concentration']) == [0.1, 0.3, 0.5]
+    assert len(query(cache_dir, concentration=0.3)) == 1
+    assert len(query(cache_dir, concentration=0.3, version="other")) == 0
+    summaries = step_summaries(records[0], cache_dir)
+    assert len(summaries) == records[0]['result']['steps']
+
+
+def test_sweep_jobs_share_seeds():
+    jobs = sweep_jobs({'dump_strat': ["", "middle"]}, trials=3, seed=1, base=BASE)
+    assert len(jobs) == 6
+    assert [job['seed'] for job in jobs[:3]] == [job['seed'] for job in jobs[3:]]
+    assert len({job['key'] for job in jobs}) == 6
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from Precision_3d import accuracy_check, precision_dtypes
+from Trial_Runner_3d import make_simulation, seed_everything
+
+SMALL = dict(grid_size=12, grid_height=12, dump_size=6)
+
+
+@pytest.mark.parametrize("engine", ["arrays", "events"])
+def test_float32_run(engine):
+    seed_everything(1)
+    sim = make_simulation({**SMALL, 'engine': engine, 'precision': "float32", 'dx': 1,
+                           'D_food': 0.02, 'D_antibiotics': 0.02,
+                           'resource_steps_per_time_unit': 4, 'diffusion_backend': "stencil"})
+    for _ in range(5):
+        sim.advance()
+    assert sim.resources.food.dtype == np.float32
+    assert sim.resources.antibiotics.dtype == np.float32
+    assert np.isfinite(sim.resources.food).all()
+    dtypes = precision_dtypes("float32" if engine == "arrays" else "float64")
+    assert sim.grid.state.dtype == dtypes['state']
+    assert sim.grid.death_date.dtype == dtypes['timer']
+
+
+def test_accuracy_check():
+    result = accuracy_check(SMALL, time_units=10, seeds=(0, 1))
+    assert result['passed']
+    assert set(result['errors']) == {'alive_good', 'alive_bad', 'dead_good', 'dead_bad',
+                                     'antibiotics_concentration', 'food_field',
+                                     'antibiotics_field'}
+    assert 0 < result['errors']['food_field'] < 1e-5
+    with pytest.raises(ValueError):
+        accuracy_check(SMALL, time_units=1, seeds=(0,), precision="float16")
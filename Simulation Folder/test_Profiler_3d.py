@@ -0,0 +1,78 @@
+import json
+from types import SimpleNamespace
+import pandas as pd
+import Profiler_3d
+from Profiler_3d import Profiler
+from Trial_Runner_3d import make_simulation, seed_everything
+
+PARAMETERS = dict(grid_size=12, grid_height=12, engine="arrays", diffusion_backend="stencil",
+                  resource_steps_per_time_unit=4, dx=1, D_food=0.02, D_antibiotics=0.02,
+                  steps_per_time_unit=2, grid_interval=2, timeframe_start=1,
+                  timeframe_end=3)
+
+
+def fake_sim(alive):
+    bookkeeper = SimpleNamespace(counts={'alive_good': alive, 'alive_bad': 1}, nbytes=64)
+    return SimpleNamespace(bookkeeper=bookkeeper, history_nbytes=lambda: 128)
+
+
+def test_phase_accounting(monkeypatch):
+    clock = iter(range(100))
+    monkeypatch.setattr(Profiler_3d.time, "perf_counter", lambda: float(next(clock)))
+    profiler = Profiler()  # origin 0
+    with profiler.phase("time_unit"):  # 1 to 6
+        with profiler.phase("diffusion"):  # 2 to 5
+            with profiler.phase("diffusion/food"):  # 3 to 4
+                pass
+    with profiler.phase("cells"):  # 7 to 8
+        pass
+    profiler.end_step(1, fake_sim(3))  # at 9
+    with profiler.phase("cells"):  # 10 to 11
+        pass
+    with profiler.phase("cells"):  # 12 to 13
+        pass
+    profiler.end_step(2, fake_sim(5))  # at 14
+
+    table = profiler.step_table()
+    assert list(table['step']) == [1, 2]
+    assert list(table['wall_s']) == [8.0, 4.0]
+    assert list(table['alive_cells']) == [4, 6]
+    assert list(table['time_unit_s']) == [5.0, 0.0]
+    assert list(table['diffusion_s']) == [3.0, 0.0]
+    assert list(table['diffusion/food_s']) == [1.0, 0.0]
+    assert list(table['cells_s']) == [1.0, 2.0]
+    assert list(table['cells_calls']) == [1, 2]
+    summary = profiler.summary().set_index('phase')
+    assert list(summary.index) == ["diffusion/food", "diffusion", "time_unit", "cells"]
+    assert summary.loc['cells', 'calls'] == 3
+    assert summary.loc['cells', 'share'] == 3.0 / 12.0
+
+
+def test_simulation_profile_files(tmp_path):
+    seed_everything(3)
+    profiler = Profiler()
+    sim = make_simulation({**PARAMETERS, 'profiler': profiler})
+    for _ in range(3):
+        sim.advance()
+
+    table = profiler.step_table()
+    assert list(table['step']) == [1, 2, 3]
+    assert (table['cells_calls'] == PARAMETERS['steps_per_time_unit']).all()
+    assert (table['diffusion/stencil_calls'] == 1).all()
+    assert (table['time_unit_s'] >= table['diffusion_s'] + table['update_D_s']).all()
+    assert (table['wall_s'] >= table['time_unit_s']).all()
+
+    profiler.save_csv(tmp_path / "profile.csv")
+    saved = pd.read_csv(tmp_path / "profile.csv", sep=';', decimal=',')
+    assert list(saved.columns) == list(table.columns)
+    assert list(saved['cells_calls']) == list(table['cells_calls'])
+
+    profiler.save_trace(tmp_path / "profile.trace.json")
+    with open(tmp_path / "profile.trace.json") as f:
+        events = json.load(f)['traceEvents']
+    spans = [event for event in events if event['ph'] == "X"]
+    assert len(spans) == len(profiler.spans)
+    assert all(event['dur'] >= 0 for event in spans)
+    counters = [event for event in events if event['ph'] == "C"]
+    assert [event['args']['alive'] for event in counters if event['name'] == "cells"] == \
+        list(table['alive_cells'])
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+from Trial_Runner_3d import main, run_ensemble, run_trial, run_trials, trial_seeds
+
+SIZE = 12
+PARAMETERS = dict(grid_size=SIZE, grid_height=SIZE, engine="arrays",
+                  diffusion_backend="stencil", resource_steps_per_time_unit=4, dx=1,
+                  D_food=0.02, D_antibiotics=0.02, max_steps=10, timeframe_start=2,
+                  timeframe_end=8)
+
+
+def read_csv(path):
+    return pd.read_csv(path, sep=';', decimal=',')
+
+
+def test_pool_matches_serial_trials(tmp_path):
+    results = run_trials(PARAMETERS, 2, seed=4, processes=2, output_dir=tmp_path,
+                         threads_per_process=1)
+    seeds = trial_seeds(4, 2)
+    for i, result in enumerate(results):
+        assert result['trial'] == i + 1 and result['seed'] == seeds[i]
+        expected = run_trial(PARAMETERS, seeds[i], trial=i + 1)
+        np.testing.assert_equal(result, expected)
+
+    # The CSV files hold the last rewrite, after both trials
+    aggregated = read_csv(tmp_path / "aggregated_trial_data.csv")
+    assert list(aggregated.columns) == ["Metric", "Trial 1", "Trial 2", "Aggregated"]
+    deaths = aggregated.set_index("Metric").loc["total_death_counts_good_age"]
+    assert deaths["Aggregated"] == deaths["Trial 1"] + deaths["Trial 2"]
+    timeframe = read_csv(tmp_path / "timeframe_aggregated_data_2_8.csv")
+    assert list(timeframe.columns) == ["Metric", "Trial 1", "Trial 2", "Aggregated"]
+    for trial in (1, 2):
+        steps = read_csv(tmp_path / f"trial{trial}_data.csv")
+        assert list(steps['step']) == list(range(1, results[trial - 1]['steps'] + 1))
+
+
+def test_command_line(tmp_path):
+    main(["--trials", "2", "--seed", "4", "--processes", "2", "--threads-per-process", "1",
+          "--output-dir", str(tmp_path)] +
+         [f"--param={key}={value!r}" for key, value in PARAMETERS.items()])
+    aggregated = read_csv(tmp_path / "aggregated_trial_data.csv")
+    assert list(aggregated.columns) == ["Metric", "Trial 1", "Trial 2", "Aggregated"]
+    assert (tmp_path / "trial2_data.csv").exists()
+
+
+def test_ensemble_command_line(tmp_path):
+    main(["--trials", "2", "--seed", "4", "--ensemble", "--threads-per-process", "1",
+          "--output-dir", str(tmp_path)] +
+         [f"--param={key}={value!r}" for key, value in PARAMETERS.items()])
+    results = run_ensemble(PARAMETERS, 2, seed=4, output_dir=tmp_path / "api")
+    aggregated = read_csv(tmp_path / "aggregated_trial_data.csv")
+    assert list(aggregated.columns) == ["Metric", "Trial 1", "Trial 2", "Aggregated"]
+    assert aggregated.equals(read_csv(tmp_path / "api" / "aggregated_trial_data.csv"))
+    assert [result['seed'] for result in results] == trial_seeds(4, 2)
+    for trial in (1, 2):
+        steps = read_csv(tmp_path / f"trial{trial}_data.csv")
+        assert list(steps['step']) == list(range(1, results[trial - 1]['steps'] + 1))
+    assert (tmp_path / "timeframe_aggregated_data_2_8.csv").exists()